@@ -1,21 +1,67 @@
 from __future__ import annotations
 
 import socket
+import threading
 import time
+from concurrent.futures import Future, ThreadPoolExecutor
 import numpy
 import re
-from typing import Union
+from typing import Optional, Union
 
 from dynio import *
 
+from gpl_channel import GPLChannel, GPLError
+# NOTE gpl_channel put the hardware folder (where tracing lives) on the path
+import tracing
+from position_tracking import PositionTracker, StalenessPolicy
+
 DEFAULT_HOST = "10.10.10.40"
 DEFAULT_PORT = 10100
 
+# Seconds to wait for a motion (or powering up) to finish before we assume something went wrong
+DEFAULT_MOTION_TIMEOUT = 30.0
+DEFAULT_POWER_TIMEOUT = 10.0
+
+# Motion profile used for the intermediate points of blended paths. Its InRange is -1, which tells the controller
+# not to wait until the arm is in position before starting the next motion, so it flows through the point
+# instead of stopping there. Profile 1 (used by everything else) keeps stopping precisely.
+BLEND_PROFILE = 2
+# Profile for the last point of a blended path that stops: same speed as the blend profile, but InRange is
+# positive (the controller's default) so the arm comes to rest in position like with profile 1
+STOP_PROFILE = 3
+STOP_INRANGE = 10
+# How far (mm, along Z) above a pick/place pose we approach from and retract to
+DEFAULT_APPROACH_OFFSET = 30.0
+
+def approach_pose(pose: list[Union[int, float]], offset: float = DEFAULT_APPROACH_OFFSET) -> list[float]:
+    # The gripper points down so "above" is just +Z
+    return [pose[0], pose[1], pose[2] + offset] + list(pose[3:])
+
+class SafeZone:
+    """An axis-aligned box (mm) that the arm can move through freely without hitting anything, so paths that stay
+    inside of it don't need the extra trip home for safety. Since the box is convex a straight line between two
+    points in it never leaves it, so checking the waypoints is enough.
+    """
+    def __init__(self, low: list[float], high: list[float]):
+        assert len(low) == 3 and len(high) == 3
+        assert all(l <= h for l, h in zip(low, high))
+        self.low = low
+        self.high = high
+
+    def contains(self, pose: list[Union[int, float]]) -> bool:
+        return all(l <= v <= h for l, v, h in zip(self.low, pose[:3], self.high))
+
+    def contains_path(self, waypoints: list[list[Union[int, float]]]) -> bool:
+        return all(self.contains(pose) for pose in waypoints)
+
 class PA3400_ZeroTorque:
-    def __init__(self, address, port):
+    def __init__(self, address, port, verbose: bool = True):
         self.address = address
         self.port = port
+        # Print every response (this is mostly used interactively)
+        self.verbose = verbose
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.channel = GPLChannel(self.sock)
 
     def connect(self):
         try:
@@ -30,9 +76,10 @@ class PA3400_ZeroTorque:
 
     def send_command(self, command):
         if self.sock:
-            self.sock.sendall((command + '\n').encode())
-            response = self.sock.recv(1024).decode().strip()
-            print(f"Response: {response}")
+            # Errors get printed instead of raised since this is used interactively
+            response = self.channel.send(command, check=False)
+            if self.verbose:
+                print(f"Response: {response}")
             return response
         else:
             print("Not connected to robot")
@@ -48,17 +95,37 @@ class PA3400_ZeroTorque:
         return self.send_command("wherej")
 
 class PA3400:
-    def __init__(self, address, port):
+    """The arm over the Tcp_cmd_server. Positions are tracked client side (see position_tracking): `where` and
+    `where_joints` only ask the robot when `position_policy` does not trust the last known position (or with
+    `verify=True`).
+    """
+    def __init__(self, address, port, motion_timeout: float = DEFAULT_MOTION_TIMEOUT, debug: bool = False,
+                 position_policy: Optional[StalenessPolicy] = None):
         self.host = address
         self.port = port
+        # Print every command and reply. Off by default since it slows down the hot loop, every command is
+        # traced anyway (see tracing)
+        self.debug = debug
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.channel = GPLChannel(self.sock)
+
+        # How long (in seconds) we are willing to wait for a single motion to finish before giving up
+        self.motion_timeout = motion_timeout
         
         # Current position
         self.curpos = []
+        # Last commanded / confirmed cartesian and joint positions
+        self.position = PositionTracker(position_policy)
+        self.joint_position = PositionTracker(position_policy)
 
         # Maximum speed
         self.rapid = 10
 
+        # Speed of profile 1 (see set_linear_motion), blended paths default to the same speed
+        self.linear_speed = 10
+        # Speed the blend and stop profiles were last set up with (None until the first blended path)
+        self._blend_speed = None
+
         # Home position joint angles
         # self.homej = [750, 0, 180, -180]
         # self.homej = [675, 0, 180, 0]
@@ -71,14 +138,13 @@ class PA3400:
         except socket.error as msg:
             print('Socket Error: ', msg)
 
-    def enable(self):
-        self.sendcmd('mode 0')
-        self.sendcmd('hp 1')
-        time.sleep(4)
-        self.sendcmd('attach 1')
-        time.sleep(1)
-        self.sendcmd('home')
-        time.sleep(5)
+    def enable(self, timeout: Optional[float] = None):
+        self.sendcmds(['mode 0', 'hp 1'])
+        self.wait_for_power(DEFAULT_POWER_TIMEOUT if timeout is None else timeout)
+        # We don't know where home is in cartesian or joint terms until we ask
+        self._moving(None, None)
+        self.sendcmds(['attach 1', 'home'])
+        self.wait_for_motion(timeout)
 
     def disable(self):
         self.sendcmd('hp 0')
@@ -88,23 +154,33 @@ class PA3400:
 
     def set_linear_motion(self, speed=10):
         # Only allows linear motion
-        self.sendcmd(f'Straight 1 1')
-        self.sendcmd(f'Speed 1 {speed}')
+        self.sendcmds([f'Straight 1 1', f'Speed 1 {speed}'])
+        self.linear_speed = speed
 
-    def __move(self, pos: list[Union[int, float]], command_suffix: str):
+    def __move(self, pos: list[Union[int, float]], command_suffix: str, wait: bool = True, timeout: Optional[float] = None):
         assert command_suffix in ["j", "c", "a"]
         cmd = f"move{command_suffix} 1 " + ' '.join(str(n) for n in pos)
-        self.sendcmd(cmd)
-
-    def movec(self, pos, speed=10):
+        if command_suffix == "j":
+            self._moving(None, [float(n) for n in pos])
+        else:
+            self._moving([float(n) for n in pos], None)
+        try:
+            self.sendcmd(cmd)
+        except GPLError:
+            self._position_lost()
+            raise
+        if wait:
+            self.wait_for_motion(timeout)
+
+    def movec(self, pos, speed=10, wait: bool = True, timeout: Optional[float] = None):
         # Move cartisian
-        return self.__move(pos, "c")
+        return self.__move(pos, "c", wait=wait, timeout=timeout)
 
-    def movej(self, pos):
+    def movej(self, pos, wait: bool = True, timeout: Optional[float] = None):
         # Move robot to specified joint positions
         # pos = [H, A1, A2, A3, A4]
         # movej <profile#> <height> <angle2> <angle3> <angle4>
-        return self.__move(pos, "j")
+        return self.__move(pos, "j", wait=wait, timeout=timeout)
     # Unclear what movea is for
     # def movea(self, pos1, pos2):
     #     # Move robot to specified cartesian position, computing all joint
@@ -114,104 +190,180 @@ class PA3400:
     #     # movec <profile#> <X> <Y> <Z> <Yaw> <pitch> <roll> [<handedness>]
     #     return self.__move(pos, "a")
 
-    def gohome(self, speed: int = 10):
-        self.movec(self.homej, speed=speed)
-
-    def sendcmd(self, cmd):
-        cmd += '\n'
-        self.sock.send(cmd.encode())
-        print('Send command: ' + cmd)
-        ack = self.sock.recv(1024)
-        print(ack.decode())
+    def gohome(self, speed: int = 10, wait: bool = True, timeout: Optional[float] = None):
+        self.movec(self.homej, speed=speed, wait=wait, timeout=timeout)
+
+    def _moving(self, cartesian: Optional[list[float]], joints: Optional[list[float]]):
+        # Called right before sending a motion: until wait_for_motion returns we are on our way there
+        # (None: we can't tell where that is in these coordinates)
+        self.position.moved(cartesian, reached=False)
+        self.joint_position.moved(joints, reached=False)
+
+    def _position_lost(self):
+        self.position.invalidate()
+        self.joint_position.invalidate()
+
+    def where(self, verify: bool = False) -> list[float]:
+        """Cartesian position [X, Y, Z, yaw, pitch, roll]."""
+        if not verify:
+            pos = self.position.local()
+            if pos is not None:
+                return list(pos)
+        # wherec replies with `0 X Y Z yaw pitch roll config`
+        pos = [float(v) for v in self.sendcmd('wherec').split()[1:7]]
+        self.position.confirm(list(pos))
+        return pos
+
+    def where_joints(self, verify: bool = False) -> list[float]:
+        if not verify:
+            pos = self.joint_position.local()
+            if pos is not None:
+                return list(pos)
+        pos = [float(v) for v in self.sendcmd('wherej').split()[1:]]
+        self.joint_position.confirm(list(pos))
+        return pos
+
+    def sendcmd(self, cmd) -> str:
+        # Raises a GPLError if the robot did not like the command
+        if self.debug:
+            print('Send command: ' + cmd)
+        ack = self.channel.send(cmd)
+        if self.debug:
+            print(ack)
+        return ack
+
+    def sendcmds(self, cmds: list[str]) -> list[str]:
+        # Send several commands in one round trip, the replies come back in the same order
+        if self.debug:
+            print('Send commands: ' + ', '.join(cmds))
+        acks = self.channel.batch(cmds)
+        if self.debug:
+            print('\n'.join(acks))
+        return acks
+
+    def wait_for_motion(self, timeout: Optional[float] = None):
+        """Block until the robot has finished its current motion (and is in position) instead of guessing
+        with a sleep. This uses the GPL `waitForEom` command which the Tcp_cmd_server only acknowledges
+        once the end of motion is reached, so we just wait for the reply (up to `timeout` seconds).
+        """
+        timeout = self.motion_timeout if timeout is None else timeout
+        old_timeout = self.sock.gettimeout()
+        self.sock.settimeout(timeout)
+        try:
+            self.sendcmd('waitForEom')
+        except socket.timeout:
+            self._position_lost()
+            raise TimeoutError(f"Robot did not finish its motion within {timeout}s")
+        finally:
+            self.sock.settimeout(old_timeout)
+        self.position.reached_target()
+        self.joint_position.reached_target()
+
+    def wait_for_power(self, timeout: float = DEFAULT_POWER_TIMEOUT, interval: float = 0.1):
+        """Poll the high power state (`hp` replies with `0 1` once power is on) until it is enabled."""
+        deadline = time.monotonic() + timeout
+        while True:
+            ack = self.sendcmd('hp').split()
+            if len(ack) >= 2 and ack[1] == '1':
+                return
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"Robot high power did not come on within {timeout}s")
+            time.sleep(interval)
+
+    def move_path(self, waypoints: list[list[Union[int, float]]], speed=None, wait: bool = True, timeout: Optional[float] = None,
+                  stop: bool = True):
+        """Move through all `waypoints` (cartesian) as one continuous motion: the arm blends through every
+        intermediate point instead of decelerating to zero there, and only stops precisely at the last one.
+        All the commands go out in one round trip. `speed` defaults to the speed of normal linear moves.
+        With `stop=False` the last point is blended too, for a path that another `move_path` continues.
+        """
+        assert len(waypoints) > 0
+        speed = self.linear_speed if speed is None else speed
+        cmds = []
+        if self._blend_speed != speed:
+            cmds += [f'Straight {BLEND_PROFILE} 1', f'Speed {BLEND_PROFILE} {speed}', f'InRange {BLEND_PROFILE} -1',
+                     f'Straight {STOP_PROFILE} 1', f'Speed {STOP_PROFILE} {speed}',
+                     f'InRange {STOP_PROFILE} {STOP_INRANGE}']
+        for pos in waypoints[:-1]:
+            cmds.append(f"movec {BLEND_PROFILE} " + ' '.join(str(n) for n in pos))
+        cmds.append(f"movec {STOP_PROFILE if stop else BLEND_PROFILE} " + ' '.join(str(n) for n in waypoints[-1]))
+        self._moving([float(n) for n in waypoints[-1]], None)
+        try:
+            self.sendcmds(cmds)
+        except GPLError:
+            # Some of the path may have been queued
+            self._position_lost()
+            raise
+        self._blend_speed = speed
+        if wait:
+            self.wait_for_motion(timeout)
+
+    def pick_and_place_path(self, pick_position, intermediate_position, place_position, gripper, speed=None,
+                            approach: float = DEFAULT_APPROACH_OFFSET, safe_zone: Optional[SafeZone] = None) -> bool:
+        """Like `pick_and_place` but every stretch between two gripper actions is one blended path: come in from
+        above the pick pose, retract up through the intermediate point to above the place pose and back up after
+        letting go. Returns whether the whole thing stayed in `safe_zone` (so the caller can skip going home).
+        """
+        above_pick = approach_pose(pick_position, approach)
+        above_place = approach_pose(place_position, approach)
+        self._approach_and_grip(lambda wait: self.move_path([above_pick, pick_position], speed, wait=wait), gripper)
+        self.move_path([above_pick, intermediate_position, above_place, place_position], speed)
+        self._release(gripper, lambda: self.move_path([above_place], speed, wait=False))
+        self.wait_for_motion()
+        waypoints = [above_pick, pick_position, intermediate_position, above_place, place_position]
+        return safe_zone is not None and safe_zone.contains_path(waypoints)
+
+    def _approach_and_grip(self, approach, gripper):
+        """`approach(wait)` moves to the pick pose, then close on the slide. An `OverlappedGripper` opens on the
+        way in (so the jaw is open whatever it did before) instead of before or not at all.
+        """
+        if isinstance(gripper, OverlappedGripper):
+            opening = gripper.open_async()
+            approach(False)
+            opening.result()
+            self.wait_for_motion()
+        else:
+            approach(True)
+        # Returns as soon as the slide is gripped so the arm can go right away
+        gripper.close_gripper()
+
+    def _release(self, gripper, retract=None):
+        """Let go of the slide and start `retract()` (a non-blocking move). With an `OverlappedGripper` that is as
+        soon as the jaw cleared the slide, the rest of the opening overlaps with the retract.
+        """
+        if isinstance(gripper, OverlappedGripper):
+            released, opening = gripper.release_async()
+            released.wait()
+            if opening.done():
+                # It never let go (e.g. timed out): raise instead of pulling the slide off the stage
+                opening.result()
+        else:
+            opening = None
+            gripper.open_gripper()
+        if retract is not None:
+            retract()
+        if opening is not None:
+            opening.result()
 
     def pick_from_position(self, pick_position, gripper, speed=5):
         # modify to be above the pick position
         # self.movec(, speed)
-        time.sleep(1)
-        self.movec(pick_position, speed)  # Move to pick position
-        time.sleep(3)  # Wait for the robot to reach the pick position
-        gripper.close_gripper()  # Close the gripper to pick the object
+        # Move to pick position (returns once it is there) and close the gripper to pick the object
+        self._approach_and_grip(lambda wait: self.movec(pick_position, speed, wait=wait), gripper)
 
     def place_to_position(self, place_position, gripper, speed=5):
         # modify to be above the place position
         # self.movec(, speed)
-        # time.sleep(1)
-        self.movec(place_position, speed)  # Move to place position
-        time.sleep(3)  # Wait for the robot to reach the place position
-        gripper.open_gripper()  # Open the gripper to place the object
-
-    # Not clear if this works
-    # def parsegc(self, line):
-    #     # Attempt to convert gcode block to PA command
-    #     #
+        self.movec(place_position, speed)  # Move to place position (returns once it is there)
+        self._release(gripper)  # Open the gripper to place the object
 
-    #     blocks = line.split()
+    def pick_and_place(self, pick_position, intermediate_position, place_position, gripper, speed=5):
+        # Pick up at the first position, carry it via the intermediate position and put it down at the last one
+        self.pick_from_position(pick_position, gripper, speed)
+        self.movec(intermediate_position, speed)
+        self.place_to_position(place_position, gripper, speed)
 
-    #     if not len(blocks):
-    #         return None
-
-    #     # cmd = blocks[0]
-    #     #
-
-    #     # Extract letter coordinates
-    #     blockchars = ['G','M','F','X','Y','Z','I','J','K']
-    #     blockvals = dict.fromkeys(blockchars, 0)
-
-    #     for letter in blockvals:
-    #         block = re.search('(?<!\((?:(?!\))[\s\S\r])*?)' + letter + '-?\d*\.?\d*', line.upper())
-    #         if block:
-    #             if letter in ['G', 'M']:
-    #                 blockvals[letter] = int(block.group()[1:])
-    #             else:
-    #                 blockvals[letter] = float(block.group()[1:])
-
-    #     xyz = [blockvals['X'], blockvals['Y'], blockvals['Z']]
-    #     ijk = [blockvals['I'], blockvals['J'], blockvals['K']]
-    #     ypr = [90, -180, 1] # HACK
-    #     g = blockvals['G']
-
-    #     # bail if it's not a G command
-    #     if not re.search('(?<!\((?:(?!\))[\s\S\r])*?)' + 'G' + '-?\d*\.?\d*', line.upper()):
-    #         return None
-
-    #     if g is 0:
-    #         self.maxSpeed = 100
-    #         pos = xyz + ypr
-    #         self.movec(pos)
-
-    #     elif g is 1:
-    #         self.maxSpeed = 10
-    #         pos = xyz + ijk
-    #         self.movec(pos)
-
-    #     elif g is 2:
-    #         self.maxSpeed = 10
-
-    #         # Convert center point arc to 3 point arc
-    #         end = numpy.array(tuple(xyz))
-    #         cur = numpy.array(tuple(self.curpos[:3]))
-    #         cen = cur + numpy.array(tuple(ijk))
-    #         midchord = cur + ((end - cur ) / 2)
-    #         midarc = cen + ((midchord - cen) * numpy.linalg.norm(cur - cen) / numpy.linalg.norm(midchord - cen))
-
-    #         pos1 = midarc + ypr
-    #         pos2 = xyz + ypr
-    #         self.movea(pos1, pos2)
-
-
-    #     elif g is 3:
-    #         self.maxSpeed = 10
-    #         end = numpy.array(tuple(xyz))
-    #         cur = numpy.array(tuple(self.curpos[:3]))
-    #         cen = cur + numpy.array(tuple(ijk))
-    #         midchord = cur + ((end - cur ) / 2)
-    #         midarc = cen + ((midchord - cen) * numpy.linalg.norm(cur - cen) / numpy.linalg.norm(midchord - cen))
-    #         pos1 = midarc + ypr
-    #         pos2 = xyz + ypr
-    #         self.movea(pos1, pos2)
-
-    #     else:
-    #         return
+    # G-code runs through gcode.GcodeExecutor (streamed, with arcs turned into blended paths)
 
     @property
     def maxSpeed(self):
@@ -222,15 +374,166 @@ class PA3400:
         self.sendcmd('mspeed ' + str(speed))
         self.rapid = speed
 
+# Gripper goal positions (Dynamixel position units) and how close to the goal counts as there
+DEFAULT_OPEN_GRIP = 200
+DEFAULT_CLOSED_GRIP = 70
+DEFAULT_GRIP_TOLERANCE = 3
+# |Present load/current| above which a closing jaw is taken to be squeezing a slide (raw units, about 10%
+# of the motor's maximum)
+DEFAULT_GRIP_LOAD = 100
+# Give up on a gripper action after this long (the old fixed wait was 1s)
+DEFAULT_GRIPPER_TIMEOUT = 2.0
+# How far (position units) the jaw has to open before it has let go of a slide and the arm can pull away
+DEFAULT_RELEASE_CLEARANCE = 40
+
+
+class GripperAction:
+    """How a gripper action ended: `reason` is "reached" (the jaw got to the goal), "stopped" (it stopped short
+    of it, e.g. blocked) or "gripped" (closing and the load says it is holding something).
+    """
+    def __init__(self, action: str, goal: int, position: int, load: int, elapsed: float, reason: str):
+        self.action = action
+        self.goal = goal
+        self.position = position
+        self.load = load
+        self.elapsed = elapsed
+        self.reason = reason
+
+    def __repr__(self) -> str:
+        return (f"GripperAction({self.action} to {self.goal}: {self.reason} at {self.position} with load {self.load} "
+                f"after {self.elapsed * 1000:.0f}ms)")
+
+
 class Gripper:
-    def __init__(self, port='/dev/ttyUSB0', baud_rate=115200, gripper_id=1):
+    """The Dynamixel gripper. Actions set the goal position and then poll the present position, load and
+    moving flag, returning as soon as the jaw stops (or, when closing, as soon as it is squeezing a slide)
+    instead of waiting a fixed time.
+    """
+    def __init__(self, port='/dev/ttyUSB0', baud_rate=115200, gripper_id=1, protocol: int = 2,
+                 default_open_grip: int = DEFAULT_OPEN_GRIP, closed_grip: int = DEFAULT_CLOSED_GRIP,
+                 grip_load: int = DEFAULT_GRIP_LOAD, tolerance: int = DEFAULT_GRIP_TOLERANCE,
+                 timeout: float = DEFAULT_GRIPPER_TIMEOUT, poll_interval: float = 0.005):
         self.dxl_io = dxl.DynamixelIO(port, baud_rate=baud_rate)
         self.gripper_id = gripper_id
+        self.motor = self.dxl_io.new_mx28(gripper_id, protocol)
+        self.default_open_grip = default_open_grip
+        self.closed_grip = closed_grip
+        self.grip_load = grip_load
+        self.tolerance = tolerance
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        # Total time spent actuating and the last action, for reports
+        self.busy_time = 0.0
+        self.n_actions = 0
+        self.last_action: Optional[GripperAction] = None
+
+    def present_position(self) -> int:
+        return self.motor.get_position()
+
+    def present_load(self) -> int:
+        """Signed load (protocol 1) or current (protocol 2), the sign is the direction."""
+        load = self.motor.get_current()
+        # Protocol 2 current is a 16 bit two's complement value that dynio hands back unsigned
+        if self.motor.CONTROL_TABLE_PROTOCOL == 2 and load >= 0x8000:
+            load -= 0x10000
+        return load
+
+    def is_moving(self) -> bool:
+        return bool(self.motor.read_control_table("Moving"))
+
+    def _actuate(self, action: str, goal: int, detect_grip: bool, released: Optional[threading.Event] = None,
+                 clearance: int = DEFAULT_RELEASE_CLEARANCE) -> GripperAction:
+        start, t0 = time.time(), time.perf_counter()
+        origin = self.present_position() if released is not None else None
+        self.motor.set_position(goal)
+        deadline = t0 + self.timeout
+        first, last = None, None
+        while True:
+            position = self.present_position()
+            load = self.present_load()
+            elapsed = time.perf_counter() - t0
+            if released is not None and abs(position - origin) >= clearance:
+                released.set()
+            if abs(position - goal) <= self.tolerance:
+                reason = "reached"
+            elif detect_grip and abs(load) >= self.grip_load:
+                reason = "gripped"
+            # The moving flag can lag the goal write, so only trust it once the jaw has moved (or clearly can't)
+            elif last is not None and position == last and (position != first or elapsed > 0.1) and not self.is_moving():
+                reason = "stopped"
+            elif time.perf_counter() > deadline:
+                tracing.record("gripper." + action, "gripper", start, elapsed, {"id": self.gripper_id, "goal": goal, "reason": "timeout"})
+                raise TimeoutError(f"Gripper did not get to {goal} within {self.timeout}s (at {position}, load {load})")
+            else:
+                first = position if first is None else first
+                last = position
+                time.sleep(self.poll_interval)
+                continue
+            break
+        tracing.record("gripper." + action, "gripper", start, elapsed, {"id": self.gripper_id, "goal": goal, "reason": reason})
+        if released is not None:
+            released.set()
+        self.busy_time += elapsed
+        self.n_actions += 1
+        self.last_action = GripperAction(action, goal, position, load, elapsed, reason)
+        return self.last_action
+
+    def open_gripper(self, released: Optional[threading.Event] = None, clearance: int = DEFAULT_RELEASE_CLEARANCE) -> GripperAction:
+        """Open all the way. `released` is set as soon as the jaw opened by `clearance` (it let go of the slide)."""
+        return self._actuate("open", self.default_open_grip, detect_grip=False, released=released, clearance=clearance)
+
+    def close_gripper(self) -> GripperAction:
+        # Returns once the jaws are on the slide, well before they would get to the closed position
+        return self._actuate("close", self.closed_grip, detect_grip=True)
+
+    def grip_by_amount(self, amount: Union[int, float]) -> GripperAction:
+        """Close the jaw by `amount` position units from fully open (clamped to fully closed)."""
+        lo, hi = sorted((self.closed_grip, self.default_open_grip))
+        direction = 1 if self.closed_grip > self.default_open_grip else -1
+        goal = int(round(min(hi, max(lo, self.default_open_grip + direction * amount))))
+        return self._actuate("grip", goal, detect_grip=True)
+
+
+class OverlappedGripper:
+    """Runs a gripper's (serial) I/O on its own thread so gripper actions can overlap with arm motions on the
+    TCP channel. The `*_async` methods return right away with a Future, the plain ones wait like the gripper's
+    own. Actions run one at a time in the order they were asked for. `PA3400`'s pick and place methods use
+    this to pre-open during the approach and to pull away as soon as the jaw let go.
+    """
+    def __init__(self, gripper):
+        self.gripper = gripper
+        self._pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="gripper")
+
+    @property
+    def default_open_grip(self):
+        return self.gripper.default_open_grip
+
+    @property
+    def busy_time(self) -> float:
+        return self.gripper.busy_time
+
+    def open_async(self) -> Future:
+        return self._pool.submit(self.gripper.open_gripper)
+
+    def close_async(self) -> Future:
+        return self._pool.submit(self.gripper.close_gripper)
+
+    def release_async(self, clearance: int = DEFAULT_RELEASE_CLEARANCE) -> tuple[threading.Event, Future]:
+        """Open, the event is set once the jaw let go of the slide (or the action is over, also if it failed)."""
+        released = threading.Event()
+        future = self._pool.submit(self.gripper.open_gripper, released=released, clearance=clearance)
+        # Callbacks run once the future is done, so a failed action is already visible when this is set
+        future.add_done_callback(lambda f: released.set())
+        return released, future
 
     def open_gripper(self):
-        self.dxl_io.set_goal_position(self.gripper_id, 200)  # Open position
-        time.sleep(1)  # Wait for the gripper to open
+        return self.open_async().result()
 
     def close_gripper(self):
-        self.dxl_io.set_goal_position(self.gripper_id, 70)  # Closed position
-        time.sleep(1)  # Wait for the gripper to close
+        return self.close_async().result()
+
+    def grip_by_amount(self, amount: Union[int, float]):
+        return self._pool.submit(self.gripper.grip_by_amount, amount).result()
+
+    def shutdown(self):
+        self._pool.shutdown(wait=True)
@@ -1,3 +1,10 @@
+import sys
+from pathlib import Path
+
+if __name__ == "__main__":
+    # Run as a script from this folder: tracing and position_tracking live one folder up
+    sys.path.append(Path(__file__).resolve().parent.parent.as_posix())
+
 from dynio import *
 
 from arm_lib import PA3400, Gripper
@@ -0,0 +1,370 @@
+#!/usr/bin/env python3
+"""Streaming G-code execution on the PA3400.
+
+The file is read as a pipeline of generators, so it is never all in memory and the arm starts moving after
+the first window of blocks:
+- `tokenize` splits a line into its (letter, value) words with a single regex pass
+- `read_blocks` keeps the modal state (motion mode, G90/G91, G20/G21) and turns lines into motion `Block`s
+- `waypoint_groups` takes a window of blocks at a time, converts all of its G2/G3 arcs into points at once
+  (`arc_points`, numpy) and groups consecutive moves of the same kind (rapid or feed)
+- `GcodeExecutor` sends every group as blended paths (`PA3400.move_path`, many moves per round trip) without
+  waiting for the motion. It holds back one batch (lookahead) so that only the very last point of a group
+  stops precisely; the arm only waits when switching between rapid and feed speed.
+
+Only the XY plane (G17) is supported for arcs, given either with I/J (the center relative to the start point) or
+with R (the radius, negative for the long way round). Feed rates (F) are not used, feeds run at `feed_speed`
+and rapids at `rapid_speed` like the old `parsegc` did. A line with axis words and a G code that is not
+understood (G92 offsets, G28 homing, G53 machine coordinates, canned cycles, ...) is an error instead of being
+run as a plain move to somewhere else.
+
+Run with python3 gcode.py [file.nc] [--blocks 5000] to stream a file (or a generated test path) to the
+simulator and compare it with sending one blocking move per block.
+"""
+from __future__ import annotations
+
+import itertools
+import math
+import re
+import sys
+import time
+from pathlib import Path
+from typing import Iterable, Iterator, Optional
+
+import numpy as np
+
+if __name__ == "__main__":
+    # Run as a script from this folder: tracing and position_tracking live one folder up
+    sys.path.append(Path(__file__).resolve().parent.parent.as_posix())
+
+# Tool orientation (yaw, pitch, roll) for every pose, the gripper pointing down like in the cell
+DEFAULT_ORIENTATION = [180.0, 90.0, -180.0]
+# Max distance (mm) between an arc and the chords that replace it
+DEFAULT_ARC_TOLERANCE = 0.05
+# Blocks converted at once and moves per `move_path` round trip
+DEFAULT_WINDOW = 256
+DEFAULT_BATCH = 64
+
+RAPID, LINEAR, ARC = "rapid", "linear", "arc"
+# G codes that do not change where the moves on their line go, so they are fine next to axis words (plane and
+# compensation defaults, the default work offset, path control, feed mode, canceling canned cycles)
+_NEUTRAL_G = {17, 40, 49, 54, 61, 64, 80, 94}
+# G codes that move the machine even without axis words (to the home / second reference position)
+_HOMING_G = {28, 30}
+
+_WORD = re.compile(r"([A-Z])\s*([-+]?(?:\d+\.?\d*|\.\d+))")
+_COMMENT = re.compile(r"\([^)]*\)|;.*")
+
+def tokenize(line: str) -> list[tuple[str, float]]:
+    """The words of a line, e.g. "G1 X10 Y-2.5 (cut)" -> [("G", 1.0), ("X", 10.0), ("Y", -2.5)]."""
+    line = line.upper()
+    if "(" in line or ";" in line:
+        line = _COMMENT.sub(" ", line)
+    return [(m.group(1), float(m.group(2))) for m in _WORD.finditer(line)]
+
+
+class Block:
+    __slots__ = ("kind", "start", "end", "center", "clockwise", "line")
+
+    def __init__(self, kind: str, start: list[float], end: list[float], line: int, center: Optional[list[float]] = None,
+                 clockwise: bool = False):
+        self.kind = kind
+        self.start = start
+        self.end = end
+        self.center = center
+        self.clockwise = clockwise
+        self.line = line
+
+    def __repr__(self) -> str:
+        return f"Block({self.kind} to {self.end} line {self.line})"
+
+
+def read_blocks(lines: Iterable[str], start: Optional[list[float]] = None) -> Iterator[Block]:
+    """Motion blocks of a G-code program, positions are absolute mm. `start` is where the tool is at first."""
+    pos = [0.0, 0.0, 0.0] if start is None else [float(v) for v in start[:3]]
+    mode, absolute, scale, plane = None, True, 1.0, 17
+    for n, line in enumerate(lines, 1):
+        words = tokenize(line)
+        if not words:
+            continue
+        target: dict[str, float] = {}
+        offsets: dict[str, float] = {}
+        radius = None
+        unsupported = None
+        for letter, value in words:
+            if letter == "G":
+                if value in (0, 1, 2, 3):
+                    mode = int(value)
+                elif value == 90:
+                    absolute = True
+                elif value == 91:
+                    absolute = False
+                elif value == 20:
+                    scale = 25.4
+                elif value == 21:
+                    scale = 1.0
+                elif value in (18, 19):
+                    plane = int(value)
+                elif value not in _NEUTRAL_G:
+                    unsupported = value
+            elif letter in "XYZ":
+                target[letter] = value * scale
+            elif letter in "IJK":
+                offsets[letter] = value * scale
+            elif letter == "R":
+                radius = value * scale
+        if unsupported is not None and (target or unsupported in _HOMING_G):
+            raise ValueError(f"line {n}: G{unsupported:g} is not supported: {line.strip()}")
+        if mode is None or not (target or (mode >= 2 and (offsets or radius is not None))):
+            continue
+        if absolute:
+            end = [target.get(axis, pos[i]) for i, axis in enumerate("XYZ")]
+        else:
+            end = [pos[i] + target.get(axis, 0.0) for i, axis in enumerate("XYZ")]
+        if mode >= 2:
+            if plane != 17:
+                raise ValueError(f"line {n}: arcs are only supported in the XY plane (G17): {line.strip()}")
+            if radius is not None:
+                center = _radius_center(pos, end, radius, clockwise=mode == 2, line=n)
+            else:
+                center = [pos[0] + offsets.get("I", 0.0), pos[1] + offsets.get("J", 0.0), pos[2]]
+            yield Block(ARC, pos, end, n, center, clockwise=mode == 2)
+        else:
+            yield Block(RAPID if mode == 0 else LINEAR, pos, end, n)
+        pos = end
+
+
+def _radius_center(start: list[float], end: list[float], radius: float, clockwise: bool, line: int) -> list[float]:
+    """The center of an arc given with R: on the perpendicular bisector of the chord, to the right of it for a
+    clockwise arc (left for counterclockwise) when `radius` is positive (at most half a turn), across otherwise.
+    """
+    dx, dy = end[0] - start[0], end[1] - start[1]
+    chord = math.hypot(dx, dy)
+    if chord < 1e-9:
+        raise ValueError(f"line {line}: an arc given with R can not be a full circle")
+    # Allow for the rounding of a half circle's radius in the program
+    half = chord / 2
+    if half > abs(radius) + 1e-4:
+        raise ValueError(f"line {line}: R{radius:g} is too small to reach the end point")
+    h = math.sqrt(max(radius * radius - half * half, 0.0))
+    if clockwise != (radius < 0):
+        h = -h
+    # (-dy, dx) / chord is the unit vector to the left of the chord
+    return [start[0] + dx / 2 - h * dy / chord, start[1] + dy / 2 + h * dx / chord, start[2]]
+
+
+def arc_points(starts: np.ndarray, ends: np.ndarray, centers: np.ndarray, clockwise: np.ndarray,
+               tolerance: float = DEFAULT_ARC_TOLERANCE) -> list[np.ndarray]:
+    """Points along every arc (N x 3 arrays of start, end, center, N clockwise flags), all arcs at once. Each
+    arc gets enough chords to stay within `tolerance` of it and at least two, so its midpoint is always one of
+    the points. The last point of every arc is its programmed end. An arc that ends where it starts is a full
+    circle. Z moves linearly along the arc (helixes).
+    """
+    if len(starts) == 0:
+        return []
+    s = starts[:, :2] - centers[:, :2]
+    e = ends[:, :2] - centers[:, :2]
+    r = np.hypot(s[:, 0], s[:, 1])
+    a0 = np.arctan2(s[:, 1], s[:, 0])
+    a1 = np.arctan2(e[:, 1], e[:, 0])
+    sweep = np.where(clockwise, a0 - a1, a1 - a0) % (2 * np.pi)
+    sweep = np.where(sweep < 1e-9, 2 * np.pi, sweep)
+    # The chord of angle t is 2r sin(t/2) long and r(1 - cos(t/2)) away from the arc at its middle
+    max_step = 2 * np.arccos(np.clip(1 - tolerance / np.maximum(r, 1e-9), -1.0, 1.0))
+    n = np.maximum(2, np.ceil(sweep / np.maximum(max_step, 1e-6))).astype(np.int64)
+    which = np.repeat(np.arange(len(n)), n)
+    ends_at = np.cumsum(n)
+    k = np.arange(1, ends_at[-1] + 1) - np.repeat(ends_at - n, n)
+    frac = k / n[which]
+    angle = a0[which] + np.where(clockwise[which], -1.0, 1.0) * sweep[which] * frac
+    points = np.empty((len(which), 3))
+    points[:, 0] = centers[which, 0] + r[which] * np.cos(angle)
+    points[:, 1] = centers[which, 1] + r[which] * np.sin(angle)
+    points[:, 2] = starts[which, 2] + (ends[which, 2] - starts[which, 2]) * frac
+    points[ends_at - 1] = ends
+    return np.split(points, ends_at[:-1])
+
+
+def waypoint_groups(blocks: Iterable[Block], window: int = DEFAULT_WINDOW,
+                    tolerance: float = DEFAULT_ARC_TOLERANCE) -> Iterator[tuple[str, np.ndarray, int]]:
+    """(RAPID or LINEAR, points, number of blocks) for runs of consecutive moves of the same kind (arcs are
+    feed moves like G1). Runs are cut at window boundaries, the executor joins them again.
+    """
+    blocks = iter(blocks)
+    while True:
+        chunk = list(itertools.islice(blocks, window))
+        if not chunk:
+            return
+        arcs = [b for b in chunk if b.kind == ARC]
+        arc_pts = iter(arc_points(np.array([b.start for b in arcs], dtype=np.float64).reshape(-1, 3),
+                                  np.array([b.end for b in arcs], dtype=np.float64).reshape(-1, 3),
+                                  np.array([b.center for b in arcs], dtype=np.float64).reshape(-1, 3),
+                                  np.array([b.clockwise for b in arcs], dtype=bool), tolerance))
+        kind, parts, n_blocks = None, [], 0
+        for block in chunk:
+            block_kind = RAPID if block.kind == RAPID else LINEAR
+            if block_kind != kind and parts:
+                yield kind, np.concatenate(parts), n_blocks
+                parts, n_blocks = [], 0
+            kind = block_kind
+            parts.append(next(arc_pts) if block.kind == ARC else np.array([block.end], dtype=np.float64))
+            n_blocks += 1
+        if parts:
+            yield kind, np.concatenate(parts), n_blocks
+
+
+class GcodeStats:
+    def __init__(self):
+        self.n_blocks = 0
+        self.n_waypoints = 0
+        self.n_batches = 0
+        # Times we had to let the arm stop (switching between rapid and feed speed)
+        self.n_stops = 0
+        # Until the last batch was queued, and until the arm was done
+        self.stream_time = 0.0
+        self.elapsed = 0.0
+
+    @property
+    def blocks_per_second(self) -> float:
+        """Blocks read, converted and queued per second."""
+        return self.n_blocks / self.stream_time if self.stream_time > 0 else 0.0
+
+    def __str__(self) -> str:
+        return (f"{self.n_blocks} blocks ({self.n_waypoints} moves in {self.n_batches} batches, {self.n_stops} stops) streamed in "
+                f"{self.stream_time:.2f}s ({self.blocks_per_second:.0f} blocks/s), done after {self.elapsed:.2f}s")
+
+
+class GcodeExecutor:
+    """Streams G-code to a `PA3400`. G-code coordinates are relative to `origin` (robot cartesian mm)."""
+    def __init__(self, robot, origin: Optional[list[float]] = None, orientation: Optional[list[float]] = None,
+                 feed_speed: float = 10, rapid_speed: float = 100, window: int = DEFAULT_WINDOW, batch: int = DEFAULT_BATCH,
+                 tolerance: float = DEFAULT_ARC_TOLERANCE):
+        self.robot = robot
+        self.origin = np.array([0.0, 0.0, 0.0] if origin is None else origin[:3], dtype=np.float64)
+        self.orientation = list(DEFAULT_ORIENTATION if orientation is None else orientation)
+        self.feed_speed = feed_speed
+        self.rapid_speed = rapid_speed
+        self.window = window
+        self.batch = batch
+        self.tolerance = tolerance
+
+    def poses(self, points: np.ndarray) -> list[list[float]]:
+        return [p + self.orientation for p in (points + self.origin).round(4).tolist()]
+
+    def run(self, lines: Iterable[str]) -> GcodeStats:
+        """Run a program (any iterable of lines, e.g. an open file) and wait until the arm is done."""
+        stats = GcodeStats()
+        t0 = time.perf_counter()
+        start = np.array(self.robot.where()[:3]) - self.origin
+        # The batch we hold back until we know whether the path goes on after it, and its speed
+        held: Optional[list[list[float]]] = None
+        held_speed = None
+        for kind, points, n_blocks in waypoint_groups(read_blocks(lines, start.tolist()), self.window, self.tolerance):
+            speed = self.rapid_speed if kind == RAPID else self.feed_speed
+            poses = self.poses(points)
+            stats.n_blocks += n_blocks
+            stats.n_waypoints += len(poses)
+            for i in range(0, len(poses), self.batch):
+                if held is not None:
+                    if held_speed == speed:
+                        self._send(held, held_speed, False, stats)
+                    else:
+                        # A new speed only applies to moves queued after it, stop and wait for the old ones
+                        self._send(held, held_speed, True, stats)
+                        self.robot.wait_for_motion()
+                        stats.n_stops += 1
+                held, held_speed = poses[i:i + self.batch], speed
+        if held is not None:
+            self._send(held, held_speed, True, stats)
+        stats.stream_time = time.perf_counter() - t0
+        self.robot.wait_for_motion()
+        stats.elapsed = time.perf_counter() - t0
+        return stats
+
+    def _send(self, poses: list[list[float]], speed: float, stop: bool, stats: GcodeStats):
+        self.robot.move_path(poses, speed, wait=False, stop=stop)
+        stats.n_batches += 1
+
+
+def run_per_block(robot, lines: Iterable[str], origin: Optional[list[float]] = None, orientation: Optional[list[float]] = None) -> GcodeStats:
+    """The old way, for comparison: one blocking move per block, arcs as their midpoint and end."""
+    stats = GcodeStats()
+    origin = [0.0, 0.0, 0.0] if origin is None else list(origin[:3])
+    orientation = list(DEFAULT_ORIENTATION if orientation is None else orientation)
+    t0 = time.perf_counter()
+    start = [p - o for p, o in zip(robot.where()[:3], origin)]
+    for block in read_blocks(lines, start):
+        if block.kind == ARC:
+            mid, end = arc_points(np.array([block.start]), np.array([block.end]), np.array([block.center]),
+                                  np.array([block.clockwise]), tolerance=math.inf)[0]
+            points = [mid, end]
+        else:
+            points = [block.end]
+        for p in points:
+            robot.movec([float(v) + o for v, o in zip(p, origin)] + orientation)
+            stats.n_waypoints += 1
+        stats.n_blocks += 1
+    stats.stream_time = stats.elapsed = time.perf_counter() - t0
+    return stats
+
+
+def test_program(n_blocks: int, radius: float = 40.0) -> Iterator[str]:
+    """A path of about `n_blocks` blocks: rows of short G1 segments and G2/G3 arcs, with a rapid between rows."""
+    yield "G21 G90 (mm, absolute)"
+    row, n = 0, 1
+    while n < n_blocks:
+        y = row * 5.0
+        yield f"G0 X0 Y{y:.3f} Z5"
+        yield "G1 Z0"
+        x = 0.0
+        for i in range(48):
+            if i % 4 == 3:
+                # A half circle bump and back down
+                yield f"G{2 + (row % 2)} X{x + 2 * radius / 10:.3f} Y{y:.3f} I{radius / 10:.3f} J0"
+                x += 2 * radius / 10
+            else:
+                x += 1.5
+                yield f"G1 X{x:.3f} Y{y:.3f} ; segment {i}"
+        n += 50
+        row += 1
+    yield "G0 Z5"
+
+
+def main():
+    import argparse
+    from arm_lib import PA3400
+    from pa3400_sim import ArmModel, serve_in_background
+    parser = argparse.ArgumentParser(description="Stream G-code to the simulated arm and compare with one blocking move per block")
+    parser.add_argument("file", nargs="?", default=None, help="G-code file (default: a generated test path)")
+    parser.add_argument("--blocks", type=int, default=5000, help="Size of the generated test path")
+    parser.add_argument("--time-scale", type=float, default=1e-4, help="Real seconds per simulated second")
+    parser.add_argument("--origin", type=float, nargs=3, default=[0.0, -300.0, 200.0])
+    args = parser.parse_args()
+
+    def lines():
+        if args.file is None:
+            return test_program(args.blocks)
+        return open(args.file)
+
+    results = {}
+    for name in ("per block", "streamed"):
+        arm = ArmModel(time_scale=args.time_scale)
+        server = serve_in_background(arm=arm)
+        robot = PA3400("127.0.0.1", server.server_address[1])
+        robot.connect()
+        robot.enable()
+        robot.set_linear_motion()
+        robot.movec(list(args.origin) + DEFAULT_ORIENTATION)
+        arm_before = arm.motion_time
+        if name == "streamed":
+            stats = GcodeExecutor(robot, origin=args.origin).run(lines())
+        else:
+            stats = run_per_block(robot, lines(), origin=args.origin)
+        results[name] = (stats, arm.motion_time - arm_before)
+        robot.disconnect()
+        server.shutdown()
+    for name, (stats, motion) in results.items():
+        print(f"{name}: {stats}, {motion:.1f}s of simulated arm motion")
+    print(f"{results['streamed'][0].blocks_per_second / results['per block'][0].blocks_per_second:.1f}x the blocks/s")
+
+if __name__ == "__main__":
+    main()
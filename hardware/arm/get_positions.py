@@ -1,3 +1,10 @@
+import sys
+from pathlib import Path
+
+if __name__ == "__main__":
+    # Run as a script from this folder: tracing and position_tracking live one folder up
+    sys.path.append(Path(__file__).resolve().parent.parent.as_posix())
+
 from arm_lib import PA3400_ZeroTorque as PA3400
 
 if __name__ == "__main__":
@@ -0,0 +1,104 @@
+from __future__ import annotations
+
+import socket
+import time
+from typing import Optional
+
+import tracing
+
+class GPLError(RuntimeError):
+    """The Tcp_cmd_server answered a command with a non-zero status (GPL error codes are negative)."""
+    def __init__(self, command: str, code: int, message: str):
+        super().__init__(f"{command!r} failed with {code}: {message}")
+        self.command = command
+        self.code = code
+        self.message = message
+
+
+def parse_reply(command: str, line: str, check: bool = True) -> str:
+    """Replies look like `<status> [<data>]` where status 0 means success. Returns the line (without the
+    newline) and raises a GPLError if the status is non-zero and `check` is set.
+    """
+    line = line.strip()
+    status, _, rest = line.partition(" ")
+    try:
+        code = int(status)
+    except ValueError:
+        if check:
+            raise GPLError(command, -1, f"malformed reply {line!r}")
+        return line
+    if code != 0 and check:
+        raise GPLError(command, code, rest)
+    return line
+
+
+def _kind(command: str) -> str:
+    return "gpl." + command.split(" ", 1)[0].lower()
+
+
+class GPLChannel:
+    """A command channel to the PA3400 Tcp_cmd_server that frames replies by newline.
+
+    The server answers every command with exactly one line, so we can send several commands back to back and
+    read the replies in order (`batch`), which costs one round trip instead of one per command. Reading is
+    buffered so fragmented or coalesced replies are handled. If we gave up waiting for a reply (a socket
+    timeout) it is still owed to us, so it gets read and dropped before the next command to keep replies
+    matched up with their commands.
+    """
+    def __init__(self, sock: socket.socket, recv_size: int = 4096, actor: str = "arm"):
+        self.sock = sock
+        # Who the commands are traced as (there may be more than one arm)
+        self.actor = actor
+        self.recv_size = recv_size
+        self._buf = bytearray()
+        # Replies to commands we already sent but did not read yet (because of a timeout)
+        self._owed = 0
+
+    def _readline(self) -> str:
+        while True:
+            end = self._buf.find(b"\n")
+            if end >= 0:
+                line = bytes(self._buf[:end])
+                del self._buf[:end + 1]
+                return line.decode().rstrip("\r")
+            data = self.sock.recv(self.recv_size)
+            if not data:
+                raise ConnectionError("Robot closed the connection")
+            self._buf += data
+
+    def _drain_owed(self):
+        while self._owed > 0:
+            self._readline()
+            self._owed -= 1
+
+    def batch(self, commands: list[str], check: bool = True) -> list[str]:
+        """Send all `commands` at once and return their replies in order. Every reply is read before raising the
+        first error (if any), so the channel stays in sync.
+        """
+        self._drain_owed()
+        start, t0 = time.time(), time.perf_counter()
+        self.sock.sendall("".join(cmd + "\n" for cmd in commands).encode())
+        self._owed += len(commands)
+        replies = []
+        for cmd in commands:
+            try:
+                replies.append(self._readline())
+            except BaseException as e:
+                tracing.record(_kind(cmd), self.actor, start, time.perf_counter() - t0, {"cmd": cmd, "error": type(e).__name__})
+                raise
+            self._owed -= 1
+            # Commands of a batch are executed one after the other, so each one took from when the batch was sent
+            # until its reply came in
+            tracing.record(_kind(cmd), self.actor, start, time.perf_counter() - t0, {"cmd": cmd, "batch": len(commands)})
+        first_error: Optional[GPLError] = None
+        for cmd, reply in zip(commands, replies):
+            try:
+                parse_reply(cmd, reply, check=check)
+            except GPLError as e:
+                first_error = first_error or e
+        if first_error is not None:
+            raise first_error
+        return [reply.strip() for reply in replies]
+
+    def send(self, command: str, check: bool = True) -> str:
+        return self.batch([command], check=check)[0]
@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+"""Motion programs: taught arm routines saved as typed steps so they can be replayed, fast, without the REPL.
+
+A program is a list of steps, each one of
+- `Move(pose)`: a cartesian move to [X, Y, Z, yaw, pitch, roll]
+- `Speed(max_speed)`: set the arm's max speed (percent, like `mspeed`)
+- `Grip(action, amount)`: open, close or grip by an amount (see `arm_lib.Gripper`)
+and is stored as versioned JSON. `MotionProgram.from_recording` turns a REPL recording (the `{'input', 'output'}`
+pairs of `repl.py`) into one.
+
+`compile_program` gets a program ready to run: it drops what does not change anything (moves to where the arm
+already is, speeds it already has, opening an open gripper, ...) and merges the moves between two gripper actions
+into one blended path (`PA3400.move_path`), so the arm flows through the taught points instead of stopping at
+every one of them. `CompiledProgram.run` replays it with the recorded speeds scaled by `speed_scale`, so a routine
+can be checked slowly and then run at full speed.
+
+Run with python3 motion_program.py program.json [--speed-scale 0.25] [--sim] to replay a saved program.
+"""
+from __future__ import annotations
+
+import json
+import math
+import os
+import sys
+import time
+from pathlib import Path
+from typing import Optional, Union
+
+if __name__ == "__main__":
+    # Run as a script from this folder: tracing and position_tracking live one folder up
+    sys.path.append(Path(__file__).resolve().parent.parent.as_posix())
+
+PROGRAM_VERSION = 1
+# Percent, what `mspeed` accepts
+MIN_SPEED = 1.0
+MAX_SPEED = 100.0
+# Moves closer than this (mm, and degrees for the rotations) to where the arm already is are dropped
+DEFAULT_POSE_TOLERANCE = 0.01
+
+class Move:
+    def __init__(self, pose: list[float]):
+        assert len(pose) == 6, f"A pose needs 6 coordinates, got {pose}"
+        self.pose = [float(v) for v in pose]
+
+    def to_dict(self) -> dict:
+        return {"op": "move", "pose": self.pose}
+
+    def __repr__(self) -> str:
+        return f"Move({self.pose})"
+
+
+class Speed:
+    def __init__(self, max_speed: float):
+        assert MIN_SPEED <= max_speed <= MAX_SPEED, f"Speed must be between {MIN_SPEED} and {MAX_SPEED}, got {max_speed}"
+        self.max_speed = float(max_speed)
+
+    def to_dict(self) -> dict:
+        return {"op": "speed", "max_speed": self.max_speed}
+
+    def __repr__(self) -> str:
+        return f"Speed({self.max_speed:g})"
+
+
+class Grip:
+    ACTIONS = ("open", "close", "amount")
+
+    def __init__(self, action: str, amount: Optional[float] = None):
+        assert action in self.ACTIONS, f"Gripper action must be one of {self.ACTIONS}, got {action}"
+        assert (amount is not None) == (action == "amount"), "Only grips by an amount have an amount"
+        self.action = action
+        self.amount = None if amount is None else float(amount)
+
+    def to_dict(self) -> dict:
+        d = {"op": "grip", "action": self.action}
+        if self.amount is not None:
+            d["amount"] = self.amount
+        return d
+
+    def run(self, gripper):
+        if self.action == "open":
+            return gripper.open_gripper()
+        if self.action == "close":
+            return gripper.close_gripper()
+        return gripper.grip_by_amount(self.amount)
+
+    def __repr__(self) -> str:
+        return f"Grip({self.action}{'' if self.amount is None else f', {self.amount:g}'})"
+
+Step = Union[Move, Speed, Grip]
+
+def step_from_dict(d: dict) -> Step:
+    op = d.get("op")
+    if op == "move":
+        return Move(d["pose"])
+    if op == "speed":
+        return Speed(d["max_speed"])
+    if op == "grip":
+        return Grip(d["action"], d.get("amount"))
+    raise ValueError(f"Unknown motion program step {d}")
+
+
+class MotionProgram:
+    def __init__(self, steps: Optional[list[Step]] = None, name: str = "", created: Optional[float] = None):
+        self.steps: list[Step] = list(steps or [])
+        self.name = name
+        self.created = time.time() if created is None else created
+
+    @classmethod
+    def from_recording(cls, recording: list[dict], name: str = "") -> "MotionProgram":
+        """A REPL recording (`{'input': 'm 1 2 3 4 5 6', 'output': ...}` entries) as a program. Commands that
+        did not do anything in the REPL either (e.g. a move without 6 coordinates) are left out.
+        """
+        steps: list[Step] = []
+        for entry in recording:
+            parts = entry["input"].split()
+            if not parts:
+                continue
+            command, args = parts[0], [float(a) for a in parts[1:]]
+            if command == "m" and len(args) == 6:
+                steps.append(Move(args))
+            elif command == "v" and args:
+                steps.append(Speed(args[0]))
+            elif command == "g" and args:
+                steps.append(Grip("amount", args[0]))
+            elif command == "o":
+                steps.append(Grip("open"))
+            elif command == "c":
+                steps.append(Grip("close"))
+        return cls(steps, name)
+
+    def to_dict(self) -> dict:
+        return {"version": PROGRAM_VERSION, "name": self.name, "created": self.created,
+                "steps": [step.to_dict() for step in self.steps]}
+
+    @classmethod
+    def from_dict(cls, d: Union[dict, list]) -> "MotionProgram":
+        # A bare list is a recording the REPL dumped before there were programs
+        if isinstance(d, list):
+            return cls.from_recording(d)
+        version = d.get("version", 1)
+        if version > PROGRAM_VERSION:
+            raise ValueError(f"Motion program version {version} is newer than this code ({PROGRAM_VERSION})")
+        return cls([step_from_dict(s) for s in d["steps"]], d.get("name", ""), d.get("created"))
+
+    def save(self, path: Union[str, Path]):
+        path = Path(path)
+        tmp = path.with_name(path.name + ".tmp")
+        with open(tmp, "w") as f:
+            json.dump(self.to_dict(), f, indent=2)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path: Union[str, Path]) -> "MotionProgram":
+        with open(path) as f:
+            return cls.from_dict(json.load(f))
+
+
+class BlendedPath:
+    """Moves to run as one blended motion, at `max_speed` (None: whatever the arm is set to)."""
+    def __init__(self, waypoints: list[list[float]], max_speed: Optional[float]):
+        self.waypoints = waypoints
+        self.max_speed = max_speed
+
+    def __repr__(self) -> str:
+        return f"BlendedPath({len(self.waypoints)} points at {self.max_speed})"
+
+
+class CompiledProgram:
+    """A program as blended paths and gripper actions. `n_steps` is how many steps the source had."""
+    def __init__(self, segments: list[Union[BlendedPath, Grip]], n_steps: int, name: str = ""):
+        self.segments = segments
+        self.n_steps = n_steps
+        self.name = name
+
+    @property
+    def n_moves(self) -> int:
+        return sum(len(s.waypoints) for s in self.segments if isinstance(s, BlendedPath))
+
+    def run(self, robot, gripper, speed_scale: float = 1.0):
+        """Replay on `robot` (`arm_lib.PA3400`) with every recorded speed times `speed_scale` (capped at
+        100%, moves before the first recorded speed use the arm's current one). Returns how long it took.
+        """
+        assert speed_scale > 0
+        t0 = time.perf_counter()
+        initial = speed = float(robot.maxSpeed)
+        for segment in self.segments:
+            if isinstance(segment, Grip):
+                segment.run(gripper)
+                continue
+            recorded = initial if segment.max_speed is None else segment.max_speed
+            scaled = min(MAX_SPEED, max(MIN_SPEED, recorded * speed_scale))
+            if scaled != speed:
+                robot.maxSpeed = scaled
+                speed = scaled
+            robot.move_path(segment.waypoints)
+        return time.perf_counter() - t0
+
+    def __str__(self) -> str:
+        return (f"{self.name or 'program'}: {self.n_steps} steps -> {len(self.segments)} segments "
+                f"({self.n_moves} moves in {sum(isinstance(s, BlendedPath) for s in self.segments)} paths)")
+
+
+def _same_pose(a: Optional[list[float]], b: list[float], tolerance: float) -> bool:
+    return a is not None and all(math.isclose(x, y, abs_tol=tolerance) for x, y in zip(a, b))
+
+def compile_program(program: MotionProgram, blend: bool = True, tolerance: float = DEFAULT_POSE_TOLERANCE,
+                    start_pose: Optional[list[float]] = None) -> CompiledProgram:
+    """Drop steps that don't change anything and (with `blend`) merge the moves between two gripper actions into
+    blended paths. A speed change in the middle of a run of moves ends the path there, since one path has
+    one speed. `start_pose` is where the arm will be when the program starts, if known.
+    """
+    segments: list[Union[BlendedPath, Grip]] = []
+    pose = start_pose
+    # The speed in effect and the one the arm was last set to in the compiled program
+    speed, gripper_state = None, None
+    current: Optional[BlendedPath] = None
+    for step in program.steps:
+        if isinstance(step, Speed):
+            speed = step.max_speed
+            continue
+        if isinstance(step, Move):
+            if _same_pose(pose, step.pose, tolerance):
+                continue
+            if current is None or not blend or current.max_speed != speed:
+                current = BlendedPath([], speed)
+                segments.append(current)
+            current.waypoints.append(step.pose)
+            pose = step.pose
+            continue
+        # A gripper action: only repeat one if it could do something different (grips by an amount always can)
+        state = (step.action, step.amount)
+        if step.action != "amount" and state == gripper_state:
+            continue
+        gripper_state = state
+        current = None
+        segments.append(step)
+    return CompiledProgram(segments, len(program.steps), program.name)
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="Compile and replay a saved motion program")
+    parser.add_argument("program", help="A motion program (or REPL recording) JSON file")
+    parser.add_argument("--speed-scale", type=float, default=1.0, help="Multiply every recorded speed by this")
+    parser.add_argument("--no-blend", action="store_true", help="Stop at every taught point")
+    parser.add_argument("--host", default=None)
+    parser.add_argument("--port", type=int, default=None)
+    parser.add_argument("--sim", action="store_true", help="Run against the local simulator instead of the arm")
+    args = parser.parse_args()
+    compiled = compile_program(MotionProgram.load(args.program), blend=not args.no_blend)
+    print(compiled)
+    for segment in compiled.segments:
+        print(f"\t{segment}")
+    from arm_lib import PA3400, Gripper, DEFAULT_HOST, DEFAULT_PORT
+    if args.sim:
+        from pa3400_sim import serve_in_background, SimGripper
+        server = serve_in_background()
+        host, port, gripper = "127.0.0.1", server.server_address[1], SimGripper()
+    else:
+        host, port, gripper = args.host or DEFAULT_HOST, args.port or DEFAULT_PORT, Gripper()
+    robot = PA3400(host, port)
+    robot.connect()
+    robot.enable()
+    robot.set_linear_motion()
+    try:
+        elapsed = compiled.run(robot, gripper, args.speed_scale)
+        print(f"Replayed in {elapsed:.2f}s at {args.speed_scale:g}x speed")
+    finally:
+        robot.disable()
+        robot.disconnect()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+"""A local stand-in for the PA3400 Tcp_cmd_server so that arm code can be run and benchmarked without the arm.
+
+It speaks the same newline-delimited GPL command protocol that `arm_lib.PA3400` uses (`mode`, `hp`, `attach`,
+`home`, `movec`, `movej`, `wherec`, `wherej`, `mspeed`, `Speed`, `Straight`, `InRange`, `waitForEom`, ...) and
+models how long each motion takes from its distance and the current speed settings, with a trapezoidal velocity
+profile (motions with a negative InRange blend into the next one instead of stopping).
+`time_scale` makes the simulated world run faster than real time (0.01 = 100x) for benchmarks.
+
+There is also a `SimGripper` with the same interface as `arm_lib.Gripper`.
+"""
+from __future__ import annotations
+
+import math
+import socketserver
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import Optional
+
+if __name__ == "__main__":
+    # Run as a script from this folder: tracing and position_tracking live one folder up
+    sys.path.append(Path(__file__).resolve().parent.parent.as_posix())
+
+import tracing
+
+DEFAULT_SIM_PORT = 10100
+
+class ArmModel:
+    """The simulated arm. All durations are in simulated seconds, scaled by `time_scale` when we actually sleep."""
+    def __init__(self, time_scale: float = 1.0, max_linear_speed: float = 500.0, max_linear_accel: float = 2000.0,
+                 max_joint_speed: float = 180.0, max_joint_accel: float = 720.0, power_on_time: float = 2.0,
+                 settle_time: float = 0.05):
+        self.lock = threading.Lock()
+        self.time_scale = time_scale
+        # mm/s and mm/s^2 for cartesian moves, deg/s and deg/s^2 for joint moves (at 100% speed)
+        self.max_linear_speed = max_linear_speed
+        self.max_linear_accel = max_linear_accel
+        self.max_joint_speed = max_joint_speed
+        self.max_joint_accel = max_joint_accel
+        self.power_on_time = power_on_time
+        self.settle_time = settle_time
+
+        self.home_cartesian = [0.0, 0.0, 0.0, 0.0, 0.0, 0.0]
+        self.cartesian = list(self.home_cartesian)
+        self.joints = [0.0] * 6
+        self.power = 0
+        self.power_ready_at = 0.0
+        self.attached = False
+        # Percent speed: the global one from mspeed and the per profile one from Speed
+        self.mspeed = 100.0
+        self.profile_speed: dict[int, float] = {1: 100.0}
+        self.straight: dict[int, bool] = {1: False}
+        # -1 means blend into the next motion instead of stopping
+        self.inrange: dict[int, float] = {1: 10.0}
+        # Whether the motion queued last ends blended (so the next one starts at speed)
+        self._blending = False
+        # Monotonic (real) time at which the current motion is over
+        self.motion_end = 0.0
+        # Simulated time spent moving, for benchmarks
+        self.motion_time = 0.0
+        self.n_moves = 0
+
+    def _now(self) -> float:
+        return time.monotonic()
+
+    def motion_duration(self, distance: float, speed: float, accel: float, start_blended: bool = False, end_blended: bool = False) -> float:
+        """Trapezoidal (or triangular, for short moves) velocity profile. A blended start or end does not
+        accelerate from / decelerate to zero (and a blended end does not settle either).
+        """
+        if distance <= 0:
+            return 0.0
+        settle = 0.0 if end_blended else self.settle_time
+        accel_distance = speed * speed / accel
+        if distance < accel_distance:
+            return 2 * math.sqrt(distance / accel) + settle
+        ramps = (0 if start_blended else 1) + (0 if end_blended else 1)
+        return distance / speed + ramps * speed / (2 * accel) + settle
+
+    def start_motion(self, duration: float):
+        # Motions queue up behind the current one like they do on the controller
+        start = max(self._now(), self.motion_end)
+        self.motion_end = start + duration * self.time_scale
+        self.motion_time += duration
+        self.n_moves += 1
+
+    def scale(self, profile: int) -> float:
+        return self.mspeed / 100.0 * self.profile_speed.get(profile, 100.0) / 100.0
+
+    def _blend(self, profile: int) -> tuple[bool, bool]:
+        # Only blend into a motion that is queued right behind the previous one
+        start_blended = self._blending and self._now() < self.motion_end
+        self._blending = self.inrange.get(profile, 10.0) < 0
+        return start_blended, self._blending
+
+    def movec(self, profile: int, target: list[float]):
+        distance = math.dist(self.cartesian[:3], target[:3])
+        # Rotations are slow-ish too, count 1 degree like 1mm
+        distance = max(distance, max((abs(a - b) for a, b in zip(self.cartesian[3:6], target[3:6])), default=0.0))
+        speed = self.max_linear_speed * self.scale(profile)
+        self.start_motion(self.motion_duration(distance, speed, self.max_linear_accel, *self._blend(profile)))
+        self.cartesian = list(target[:6]) + self.cartesian[len(target):6]
+
+    def movej(self, profile: int, target: list[float]):
+        distance = max((abs(a - b) for a, b in zip(self.joints, target)), default=0.0)
+        speed = self.max_joint_speed * self.scale(profile)
+        self.start_motion(self.motion_duration(distance, speed, self.max_joint_accel, *self._blend(profile)))
+        self.joints = list(target) + self.joints[len(target):]
+
+    def wait_for_eom(self):
+        delay = self.motion_end - self._now()
+        if delay > 0:
+            time.sleep(delay)
+
+
+def _floats(args: list[str]) -> list[float]:
+    return [float(a) for a in args]
+
+def handle_command(arm: ArmModel, line: str) -> str:
+    """Run one GPL command against the model and return the reply line (without the newline)."""
+    parts = line.split()
+    if not parts:
+        return "-1 *Empty command*"
+    cmd, args = parts[0].lower(), parts[1:]
+    try:
+        if cmd == "waitforeom":
+            # NOTE this one blocks outside of the lock so queries still work while we wait
+            arm.wait_for_eom()
+            return "0"
+        with arm.lock:
+            if cmd in ("mode", "attach", "selectrobot", "zerotorque", "nop"):
+                if cmd == "attach":
+                    arm.attached = bool(int(args[0])) if args else True
+                return "0"
+            elif cmd == "hp":
+                if not args:
+                    on = arm.power and arm._now() >= arm.power_ready_at
+                    return f"0 {int(on)}"
+                arm.power = int(args[0])
+                arm.power_ready_at = arm._now() + arm.power_on_time * arm.time_scale
+                return "0"
+            elif cmd == "mspeed":
+                if not args:
+                    return f"0 {arm.mspeed:g}"
+                arm.mspeed = float(args[0])
+                return "0"
+            elif cmd == "speed":
+                arm.profile_speed[int(args[0])] = float(args[1])
+                return "0"
+            elif cmd == "inrange":
+                arm.inrange[int(args[0])] = float(args[1])
+                return "0"
+            elif cmd == "straight":
+                arm.straight[int(args[0])] = bool(int(args[1]))
+                return "0"
+            elif cmd in ("movec", "movej", "home"):
+                if not arm.power or not arm.attached:
+                    return "-1009 *No robot attached*"
+                if cmd == "home":
+                    arm.movec(1, arm.home_cartesian)
+                elif cmd == "movec":
+                    arm.movec(int(args[0]), _floats(args[1:]))
+                else:
+                    arm.movej(int(args[0]), _floats(args[1:]))
+                return "0"
+            elif cmd == "wherec":
+                return "0 " + " ".join(f"{v:.3f}" for v in arm.cartesian) + " 1"
+            elif cmd == "wherej":
+                return "0 " + " ".join(f"{v:.3f}" for v in arm.joints)
+            else:
+                return f"-1 *Unknown command {parts[0]}*"
+    except (IndexError, ValueError) as e:
+        return f"-2 *Invalid arguments: {e}*"
+
+
+class _GPLHandler(socketserver.StreamRequestHandler):
+    disable_nagle_algorithm = True
+    arm: ArmModel = None
+
+    def handle(self):
+        for raw in self.rfile:
+            line = raw.decode().strip()
+            if not line:
+                continue
+            self.wfile.write((handle_command(self.arm, line) + "\n").encode())
+
+
+class _Server(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+def serve_in_background(host: str = "127.0.0.1", port: int = 0, arm: Optional[ArmModel] = None) -> _Server:
+    """Start the simulated Tcp_cmd_server on a daemon thread. Use port 0 for a free port (`server.server_address`)."""
+    arm = ArmModel() if arm is None else arm
+    handler = type("BoundGPLHandler", (_GPLHandler,), {"arm": arm})
+    server = _Server((host, port), handler)
+    server.arm = arm
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class SimGripper:
+    """Stand-in for `arm_lib.Gripper` that just takes as long as the real one: `actuation_time` for a full
+    open or close, partial grips take their share of it.
+    """
+    def __init__(self, time_scale: float = 1.0, actuation_time: float = 0.6):
+        self.time_scale = time_scale
+        self.actuation_time = actuation_time
+        # arm_lib.DEFAULT_OPEN_GRIP / DEFAULT_CLOSED_GRIP (not imported so the simulator doesn't need dynio)
+        self.default_open_grip = 200
+        self.closed_grip = 70
+        self.busy_time = 0.0
+        self.n_actions = 0
+
+    def _actuate(self, action: str, fraction: float = 1.0, released: Optional[threading.Event] = None, clearance: float = 0.0):
+        # Traced like the real one
+        seconds = self.actuation_time * fraction
+        with tracing.span("gripper." + action, "gripper"):
+            if released is not None:
+                # The jaw moves at a constant speed, it let go once it opened by `clearance`
+                until_released = seconds * min(1.0, clearance / abs(self.default_open_grip - self.closed_grip))
+                time.sleep(until_released * self.time_scale)
+                released.set()
+                time.sleep((seconds - until_released) * self.time_scale)
+            else:
+                time.sleep(seconds * self.time_scale)
+        self.busy_time += seconds
+        self.n_actions += 1
+
+    def open_gripper(self, released: Optional[threading.Event] = None, clearance: float = 40):
+        self._actuate("open", released=released, clearance=clearance)
+
+    def close_gripper(self):
+        self._actuate("close")
+
+    def grip_by_amount(self, amount: float):
+        self._actuate("grip", min(1.0, abs(amount) / abs(self.default_open_grip - self.closed_grip)))
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="Run a simulated PA3400 Tcp_cmd_server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=DEFAULT_SIM_PORT)
+    parser.add_argument("--time-scale", type=float, default=1.0)
+    args = parser.parse_args()
+    server = serve_in_background(args.host, args.port, ArmModel(time_scale=args.time_scale))
+    print(f"Simulated PA3400 listening on {args.host}:{server.server_address[1]} (Ctrl+C to stop)")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,26 +1,38 @@
 from __future__ import annotations
 
 import json
+import sys
+from pathlib import Path
+
+if __name__ == "__main__":
+    # Run as a script from this folder: tracing and position_tracking live one folder up
+    sys.path.append(Path(__file__).resolve().parent.parent.as_posix())
 
 from arm_lib import PA3400, Gripper, DEFAULT_HOST, DEFAULT_PORT
+from motion_program import MotionProgram, compile_program
 import time
 
-def parse_command(self, _cmd: str) -> tuple[str, list[str]]:
-    _cmd = _cmd.strip()
-    keyword, cmd = _cmd.split(" ", 1)
-    cmd = cmd.strip()
-    cmd = cmd.split(" ")
-    cmd = [x.strip() for x in cmd]
-    cmd = [x for x in cmd if x != ""]
+def parse_command(_cmd: str) -> tuple[str, list[str]]:
+    keyword, *cmd = _cmd.split()
     return keyword, cmd
 
+def _step_command(step) -> str:
+    """The REPL command for a motion program step, so loaded programs can be edited like recordings."""
+    d = step.to_dict()
+    if d["op"] == "move":
+        return "m " + " ".join(f"{v:g}" for v in d["pose"])
+    if d["op"] == "speed":
+        return f"v {d['max_speed']:g}"
+    return {"open": "o", "close": "c"}.get(d["action"]) or f"g {d['amount']:g}"
+
 def run_command(command: str, args: list[str], robot: PA3400, gripper: Gripper) -> str:
     response = "Command format invalid"
     if command == "m":
         print("(NOTE these will have to be 6 coordinates or this will be ignored)")
         if len(args) == 6:
-            robot.move_cartesian_position(args)
-            loc = robot.query_cartesian_position()
+            robot.movec(args)
+            # Known without asking the robot since movec waits until it got there
+            loc = robot.where()
             response = f"Moved to position {str(args)}, ended up at {loc}"
     elif command == "v":
         print("(NOTE ignore all non-0 index values for speed)")
@@ -28,14 +40,14 @@ def run_command(command: str, args: list[str], robot: PA3400, gripper: Gripper)
         response = f"Set max speed to {args[0]}"
     elif command == "g":
         print("(NOTE ignore all non-0 index values for grip)")
-        gripper.grip_by_amount(args[0])
-        response = f"Gripped by {args[0]}"
+        result = gripper.grip_by_amount(args[0])
+        response = f"Gripped by {args[0]} ({result})"
     elif command == "o":
-        gripper.open_gripper()
-        response = "Opened gripper"
+        result = gripper.open_gripper()
+        response = f"Opened gripper ({result})"
     elif command == "c":
-        gripper.close_gripper()
-        response = "Closed gripper"
+        result = gripper.close_gripper()
+        response = f"Closed gripper ({result})"
     return response
 
 def main():
@@ -52,7 +64,9 @@ def main():
       j           = wherej
       r           = start recording
       s           = stop recording    
-      p           = play recording
+      p [float]   = play recording (compiled into blended paths, at the given speed scale, default 1)
+      save [path] = save the recording as a motion program (see motion_program.py)
+      load [path] = load a motion program as the recording
       g           = grip by amount
       o           = open gripper
       c           = close gripper
@@ -71,7 +85,7 @@ def main():
     robot.set_linear_motion()
     gripper = Gripper()
 
-    curr_loc = robot.query_cartesian_position()
+    curr_loc = robot.where(verify=True)
     current_position = curr_loc
 
     gripper.open_gripper()
@@ -84,14 +98,22 @@ def main():
     curr_command = None
     is_recording = False
     while curr_command != "exit":
-        curr_command = input("Enter a command: ")
-        curr_command = curr_command.lower()
+        raw_command = input("Enter a command: ")
+        curr_command = raw_command.lower()
         # Enable repetitions
         # set("rrr") = {"r"} (go back thrice)
         # These aint logged!
         if curr_command == "exit":
             break
-        elif curr_command == "r":
+        if set(curr_command) == {"t"}:
+            if len(curr_command) > len(command_history):
+                resp = "Invalid repetition (command stack does not go back that long)"
+                print(resp)
+                continue
+            end_idx = len(command_history) - len(curr_command)
+            curr_command = command_history[end_idx]['input']
+        keyword = curr_command.split()[0] if curr_command.strip() else ""
+        if curr_command == "r":
             is_recording = True
             current_recording = []
         elif curr_command == "s":
@@ -101,37 +123,36 @@ def main():
             print("\t\n".join(json.dumps(x, indent=4) for x in command_history))
         elif curr_command == "hp":
             print("\t\n".join(json.dumps(x, indent=4) for x in current_recording))
-        elif set(curr_command) == "t" and len(curr_command) <= len(command_history):
-            end_idx = len(command_history) - len(curr_command)
-            curr_command = command_history[end_idx]
-        elif set(curr_command) == "t" and len(curr_command) > len(command_history):
-            resp = "Invalid repetition (command stack does not go back that long)"
-            print(resp)
-            continue
         elif curr_command == "w":
-            print(robot.query_cartesian_position())
+            print(robot.where(verify=True))
         elif curr_command == "j":
-            print(robot.query_joint_position())
-        elif curr_command == "p":
-            # Shitty not tested
-            for c in current_recording:
-                inp = c['input']
-                out = c['output']
-                cmd_keyword, args = parse_command(inp)
-                print("Running: ", json.dumps(c, indent=4))
-                resp = run_command(cmd_keyword, args, robot, gripper)
-                print(json.dumps({
-                    "previous_out": out,
-                    "curr_out": resp
-                }, indent=4))
-                
-        elif curr_command in ["m", "v", "g", "o", "c"]:
+            print(robot.where_joints(verify=True))
+        elif keyword == "p":
+            # Replay compiled: redundant commands dropped and moves between gripper actions blended
+            _, args = parse_command(curr_command)
+            speed_scale = float(args[0]) if args else 1.0
+            compiled = compile_program(MotionProgram.from_recording(current_recording), start_pose=robot.where())
+            print(compiled)
+            elapsed = compiled.run(robot, gripper, speed_scale)
+            print(f"Replayed in {elapsed:.2f}s at {speed_scale:g}x speed")
+        elif keyword == "save":
+            # Paths keep their case
+            _, args = parse_command(raw_command)
+            path = args[0] if args else "recording.json"
+            MotionProgram.from_recording(current_recording, name=path).save(path)
+            print(f"Saved {len(current_recording)} commands to {path}")
+        elif keyword == "load":
+            _, args = parse_command(raw_command)
+            path = args[0] if args else "recording.json"
+            current_recording = [{'input': _step_command(step), 'output': None} for step in MotionProgram.load(path).steps]
+            print(f"Loaded {len(current_recording)} commands from {path}")
+        elif keyword in ["m", "v", "g", "o", "c"]:
             # These get  recorded!
             # Add to history and run this command
             command, args = parse_command(curr_command)
             args = [float(x) for x in args] # NOTE these are ALWAYS floats
 
-            response = run_command(command, args)
+            response = run_command(command, args, robot, gripper)
 
             print("Response: ", response)
             command_history.append({
@@ -143,7 +164,6 @@ def main():
                     'input': curr_command,
                     'output': response,
                 })
-            command_history.append(curr_command)
         else:
             print("Invalid command, read the docs")
     
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+"""Benchmark whole-cell runs (the `main.py` slide sequence) against the local arm and scope simulators.
+
+Runs the same slides strictly one step after the other (like the old linear `INSTR_SEQUENCE`), with the
+pipelined scheduler, with the pipelined scheduler plus blended pick-and-place paths, and with all of that plus
+the gripper overlapping the arm's moves, and reports the cycle time per slide, slides per hour and where each actor's
+time went. Times are simulated seconds: the simulators run `--time-scale` times real time.
+
+Run with python3 bench_cell.py [--slides 4] [--time-scale 0.05]
+"""
+from __future__ import annotations
+
+import contextlib
+import io
+import os
+import tempfile
+
+import main as cell_main
+from pa3400_sim import ArmModel, SimGripper
+from pa3400_sim import serve_in_background as serve_arm
+from fake_pyuscope import FakeScope
+from fake_pyuscope import serve_in_background as serve_scope
+from arm_lib import PA3400, OverlappedGripper, SafeZone
+from web_example import PyuscopeHTTPClient
+import tracing
+
+# The real positions in main.py are still TODO, these are roughly what the cell looks like (mm / degrees)
+_ORIENTATION = [180, 90, -180]
+BENCH_HOME = [0, -250, 300] + _ORIENTATION
+BENCH_TOP_SHELF = [-200, -155, 244] + _ORIENTATION
+BENCH_BOTTOM_SHELF = [-200, -411, 164] + _ORIENTATION
+BENCH_INTERMEDIATE_IN = [0, -300, 300] + _ORIENTATION
+BENCH_INTERMEDIATE_OUT = [0, -350, 320] + _ORIENTATION
+BENCH_STAGING = [150, -250, 250] + _ORIENTATION
+BENCH_SCOPE = [300, 0, 200] + _ORIENTATION
+BENCH_ARM_POSITIONS = {
+    'home': BENCH_HOME,
+    'pick-and-place-top-shelf-in-to-staging': [BENCH_TOP_SHELF, BENCH_INTERMEDIATE_IN, BENCH_STAGING],
+    'pick-and-place-staging-to-scope': [BENCH_STAGING, BENCH_INTERMEDIATE_IN, BENCH_SCOPE],
+    'pick-and-place-scope-to-bottom-shelf-out': [BENCH_SCOPE, BENCH_INTERMEDIATE_OUT, [-200, -411, 264] + _ORIENTATION],
+    'pick-and-and-place-bottom-shelf-in-to-staging': [BENCH_BOTTOM_SHELF, BENCH_INTERMEDIATE_IN, BENCH_STAGING],
+    'pick-and-place-scope-to-top-shelf-out': [BENCH_SCOPE, BENCH_INTERMEDIATE_OUT, [-200, -155, 344] + _ORIENTATION],
+}
+# Everything between the shelves and the scope is free space in the bench cell
+BENCH_SAFE_ZONE = SafeZone([-250, -450, 150], [350, 50, 400])
+BENCH_SCOPE_POSITIONS = {
+    'home': {'x': 0.0, 'y': 0.0, 'z': 0.0},
+    'image': {'x': 50.0, 'y': 100.0, 'z': -20.0},
+}
+
+class Cell:
+    """A simulated arm + gripper + scope, with clients connected to them."""
+    def __init__(self, time_scale: float, stage_speed: float = 10.0, exposure_time: float = 0.3):
+        self.time_scale = time_scale
+        self.arm = ArmModel(time_scale=time_scale)
+        self.arm.home_cartesian = list(BENCH_HOME)
+        self.arm.cartesian = list(BENCH_HOME)
+        self.arm_server = serve_arm(arm=self.arm)
+        self.scope = FakeScope(time_scale=time_scale, stage_speed=stage_speed, stage_accel=50.0, settle_time=0.2, exposure_time=exposure_time)
+        self.scope_server = serve_scope(scope=self.scope)
+        self.gripper = SimGripper(time_scale=time_scale)
+
+        self.robot = PA3400("127.0.0.1", self.arm_server.server_address[1])
+        self.robot.homej = list(BENCH_HOME)
+        self.robot.connect()
+        self.robot.enable()
+        self.robot.set_linear_motion()
+        self.robot.maxSpeed = 80
+        self.client = PyuscopeHTTPClient(host="127.0.0.1", port=self.scope_server.server_port)
+
+    def close(self):
+        self.client.close()
+        self.robot.disable()
+        self.robot.disconnect()
+        self.arm_server.shutdown()
+        self.scope_server.shutdown()
+
+def run(slides: int, time_scale: float, pipelined: bool, blended: bool, overlapped: bool = False, verbose: bool = False) -> dict:
+    sequence = [cell_main.SLIDE_SEQUENCE[i % len(cell_main.SLIDE_SEQUENCE)] for i in range(slides)]
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out) if not verbose else contextlib.nullcontext():
+        cell = Cell(time_scale)
+        arm_before, gripper_before = cell.arm.motion_time, cell.gripper.busy_time
+        # Gripper actions on their own thread, overlapping with the arm's approach and retract moves
+        gripper = OverlappedGripper(cell.gripper) if overlapped else cell.gripper
+        sched = cell_main.build_schedule(cell.robot, gripper, cell.client, slides=sequence, arm_positions=BENCH_ARM_POSITIONS,
+                                    scope_positions=BENCH_SCOPE_POSITIONS, pipelined=pipelined, blended=blended,
+                                    safe_zone=BENCH_SAFE_ZONE)
+        wall = sched.run()
+        if overlapped:
+            gripper.shutdown()
+        cell.close()
+    total = wall / time_scale
+    busy: dict[str, float] = {}
+    for step in sched.timeline():
+        busy[step.actor] = busy.get(step.actor, 0.0) + (step.end - step.start) / time_scale
+    return {
+        "total": total,
+        "cycle": total / slides,
+        "slides_per_hour": 3600 * slides / total,
+        "busy": busy,
+        "arm_motion": cell.arm.motion_time - arm_before,
+        "gripper": cell.gripper.busy_time - gripper_before,
+        "stage_motion": cell.scope.move_time,
+        "exposure": cell.scope.exposure_total,
+    }
+
+def report(name: str, r: dict):
+    print(f"{name}: {r['total']:.1f}s total, {r['cycle']:.1f}s/slide, {r['slides_per_hour']:.1f} slides/hour")
+    for actor, busy in sorted(r["busy"].items()):
+        print(f"\t{actor:>6} busy {busy:7.1f}s ({100 * busy / r['total']:5.1f}%), idle {r['total'] - busy:7.1f}s")
+    print(f"\t  arm motion {r['arm_motion']:.1f}s, gripper {r['gripper']:.1f}s, stage motion {r['stage_motion']:.1f}s, exposure {r['exposure']:.1f}s")
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="Benchmark cell runs against the simulators")
+    parser.add_argument("--slides", type=int, default=4)
+    parser.add_argument("--time-scale", type=float, default=0.05, help="Real seconds per simulated second")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+    # image_pos saves its frames in the working directory
+    with tempfile.TemporaryDirectory() as tmp:
+        cwd = os.getcwd()
+        os.chdir(tmp)
+        try:
+            linear = run(args.slides, args.time_scale, pipelined=False, blended=False, verbose=args.verbose)
+            pipelined = run(args.slides, args.time_scale, pipelined=True, blended=False, verbose=args.verbose)
+            blended = run(args.slides, args.time_scale, pipelined=True, blended=True, verbose=args.verbose)
+            tracing.tracer().reset()
+            overlapped = run(args.slides, args.time_scale, pipelined=True, blended=True, overlapped=True, verbose=args.verbose)
+        finally:
+            os.chdir(cwd)
+    report("linear", linear)
+    report("pipelined", pipelined)
+    report("pipelined + blended", blended)
+    report("pipelined + blended + overlapped gripper", overlapped)
+    print(f"speedup {linear['total'] / pipelined['total']:.2f}x pipelined, {linear['total'] / blended['total']:.2f}x pipelined + blended, "
+          f"{linear['total'] / overlapped['total']:.2f}x with the overlapped gripper")
+    # NOTE these are real (not simulated) times, so mostly the overhead of the clients and the simulators
+    print("Hot path latencies of the last run (ms):")
+    print(tracing.format_summary())
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,441 @@
+#!/usr/bin/env python3
+"""A cell with any number of arms and microscopes, described by a config instead of `main.py`'s constants.
+
+Every device (arm + gripper, or scope) runs in its own worker process with a command queue, so a slow or
+blocking device never holds up the others and the Python work of each one runs on its own core. The
+`Cell` in this process does the scheduling: every scope has a staging slot next to it and its stage, and
+every slide goes
+    fetch (arm: input shelf -> staging) -> load (arm: staging -> stage) -> image (scope, then home)
+    -> store (arm: stage -> output shelf)
+Slides are handed to whichever scope has a free staging slot, and jobs to whichever arm that can reach that
+scope is free, so with more arms and scopes more slides are in flight at once. Like in `main.py` an arm
+never reaches into a scope's stage area while that scope is imaging or moving home.
+
+The config (JSON, or a dict) looks like
+    {
+      "time_scale": 1.0,               # simulators only: real seconds per simulated second
+      "output_dir": "images",          # where the scope workers save frames
+      "catalog": "catalog.db",         # every frame is recorded here (see microscope/catalog.py), optional
+      "safe_zone": [[x, y, z], [x, y, z]],
+      "arms": [{"name": "arm0", "host": "10.10.10.40", "port": 10100, "home": [...6...],
+                "gripper": {"port": "/dev/ttyUSB0"}}],
+      "scopes": [{"name": "scope0", "host": "192.168.0.236", "port": 8401, "arms": ["arm0"],
+                  "home": {"x": ..}, "image": {"x": ..},
+                  "fetch": [pick, intermediate, place], "load": [...], "store": [...],
+                  "focus_maps": "focus_maps_scope0.json"}]   # optional, see microscope/focus_map.py
+    }
+A scope's `exposure` (its camera settings, as a dict) is recorded with every frame it takes in the catalog, and
+its `settle_tolerance` (mm, see `web_example.DEFAULT_SETTLE_TOLERANCE`) is how close the stage has to get to a
+field before it is imaged. With `focus_maps` the scope keeps a focus map per slide (by its name) in that file,
+so a slide that is imaged again goes straight to its in-focus z instead of autofocusing.
+A device with `"sim": true` instead runs against a simulator started inside its worker process. `fetch`,
+`load` and `store` are the pick-and-place poses (like `main.ARM_POSITIONS`) for that scope's station, in the
+frame of the arms that serve it. `arms` defaults to every arm.
+
+Run with python3 cell.py config.json [--slides 8] or python3 cell.py --sim 2 2 [--slides 8] to see how the
+throughput scales with the number of (simulated) arms and scopes.
+"""
+from __future__ import annotations
+
+import contextlib
+import json
+import multiprocessing
+import os
+import queue
+import sys
+import time
+from pathlib import Path
+from typing import Optional, Union
+
+# The arm and microscope modules import each other by file name, see main.py
+_HARDWARE_DIR = Path(__file__).resolve().parent
+sys.path.extend([(_HARDWARE_DIR / "arm").as_posix(), (_HARDWARE_DIR / "microscope").as_posix()])
+
+import tracing
+from catalog import new_run_id
+
+# Seconds without any news from the workers after which we assume one of them died
+DEFAULT_JOB_TIMEOUT = 600.0
+
+FETCH, LOAD, IMAGE, STORE = "fetch", "load", "image", "store"
+
+
+class _ArmDevice:
+    """An arm and its gripper, in a worker process."""
+    def __init__(self, config: dict, time_scale: float):
+        from arm_lib import PA3400, Gripper, OverlappedGripper, SafeZone
+        self.server = None
+        if config.get("sim"):
+            from pa3400_sim import ArmModel, SimGripper, serve_in_background
+            arm = ArmModel(time_scale=time_scale)
+            arm.home_cartesian = list(config["home"])
+            arm.cartesian = list(config["home"])
+            self.server = serve_in_background(arm=arm)
+            host, port = "127.0.0.1", self.server.server_address[1]
+            gripper = SimGripper(time_scale=time_scale)
+        else:
+            host, port = config["host"], config["port"]
+            gripper = Gripper(**config.get("gripper", {}))
+        self.gripper = OverlappedGripper(gripper)
+        self.robot = PA3400(host, port)
+        if "home" in config:
+            self.robot.homej = list(config["home"])
+        self.robot.connect()
+        self.robot.enable()
+        self.robot.set_linear_motion()
+        self.robot.maxSpeed = config.get("max_speed", 80)
+        safe_zone = config.get("safe_zone")
+        self.safe_zone = SafeZone(*safe_zone) if safe_zone is not None else None
+
+    def pick_and_place(self, poses: list[list[float]]):
+        from main import arm_pick_and_place
+        arm_pick_and_place(self.robot, self.gripper, "job", {"job": poses}, blended=True, safe_zone=self.safe_zone)
+
+    def close(self):
+        self.gripper.shutdown()
+        self.robot.disable()
+        self.robot.disconnect()
+        if self.server is not None:
+            self.server.shutdown()
+
+
+class _ScopeDevice:
+    """A scope, in a worker process."""
+    def __init__(self, config: dict, time_scale: float):
+        from web_example import DEFAULT_SETTLE_TOLERANCE, PyuscopeHTTPClient
+        from focus_map import FocusMapStore
+        self.server = None
+        if config.get("sim"):
+            from fake_pyuscope import FakeScope, serve_in_background
+            scope = FakeScope(time_scale=time_scale, stage_speed=10.0, stage_accel=50.0, settle_time=0.2, exposure_time=0.3)
+            self.server = serve_in_background(scope=scope)
+            host, port = "127.0.0.1", self.server.server_port
+        else:
+            host, port = config["host"], config["port"]
+        self.client = PyuscopeHTTPClient(host=host, port=port,
+                                         settle_tolerance=config.get("settle_tolerance", DEFAULT_SETTLE_TOLERANCE))
+        self.positions = {"home": config["home"], "image": config["image"]}
+        self.focus_store = FocusMapStore(config["focus_maps"]) if config.get("focus_maps") else None
+        # Every scope process records into the same catalog file, SQLite takes care of the locking
+        self.catalog = None
+        if config.get("catalog"):
+            from catalog import Catalog
+            self.catalog = Catalog(config["catalog"])
+        self.exposure = config.get("exposure")
+
+    def image(self, slot: str, slide: Optional[str] = None, run_id: Optional[str] = None):
+        from main import scope_image, scope_home
+        info = {"slide_id": slide, "run_id": run_id, "exposure": self.exposure}
+        scope_image(self.client, self.positions, self.focus_store, slot, self.catalog, info)
+        scope_home(self.client, self.positions)
+
+    def close(self):
+        self.client.close()
+        if self.catalog is not None:
+            self.catalog.close()
+        if self.server is not None:
+            self.server.shutdown()
+
+
+def _worker(kind: str, config: dict, time_scale: float, output_dir: Optional[str], verbose: bool,
+            commands: multiprocessing.Queue, results: multiprocessing.Queue):
+    """Runs one device: takes (job id, method, args) off `commands` until it gets None and reports
+    (device, job id, error or None, start, end) for every one of them on `results`.
+    """
+    name = config["name"]
+    trace = tracing.tracer().path
+    if trace is not None:
+        # One trace per process, they can't share the file
+        tracing.configure(trace.with_name(f"{trace.stem}-{name}{trace.suffix}"))
+    if output_dir is not None:
+        # image_pos saves into the working directory
+        Path(output_dir, name).mkdir(parents=True, exist_ok=True)
+        os.chdir(Path(output_dir, name))
+    with contextlib.redirect_stdout(open(os.devnull, "w")) if not verbose else contextlib.nullcontext():
+        try:
+            device = _ArmDevice(config, time_scale) if kind == "arm" else _ScopeDevice(config, time_scale)
+        except Exception as e:
+            results.put((name, None, f"{type(e).__name__}: {e}", 0.0, 0.0))
+            return
+        results.put((name, None, None, 0.0, 0.0))
+        try:
+            while True:
+                command = commands.get()
+                if command is None:
+                    break
+                job_id, method, args = command
+                start = time.time()
+                try:
+                    getattr(device, method)(*args)
+                    error = None
+                except Exception as e:
+                    error = f"{type(e).__name__}: {e}"
+                results.put((name, job_id, error, start, time.time()))
+        finally:
+            device.close()
+            tracing.tracer().close()
+
+
+class Slide:
+    def __init__(self, index: int, name: str, slide_id: Optional[str] = None):
+        self.index = index
+        self.name = name
+        # What the catalog records it as, only known if the slide was named
+        self.slide_id = slide_id
+        self.scope: Optional[str] = None
+        # (phase, device, start, end) in the order they ran
+        self.jobs: list[tuple[str, str, float, float]] = []
+
+
+class _Station:
+    """What the cell knows about one scope: the slides in its staging slot and on its stage."""
+    def __init__(self, name: str, config: dict, arms: list[str]):
+        self.name = name
+        self.config = config
+        self.arms = arms
+        self.staging: Optional[Slide] = None
+        self.stage: Optional[Slide] = None
+        self.imaged = False
+        # A slide on its way into the staging slot, an arm in the stage area, the scope busy
+        self.fetching = False
+        self.arm_in_stage_area = False
+        self.scope_busy = False
+
+
+class CellReport:
+    def __init__(self, slides: list[Slide], elapsed: float, busy: dict[str, float], time_scale: float):
+        self.slides = slides
+        self.elapsed = elapsed
+        self.busy = busy
+        self.time_scale = time_scale
+
+    @property
+    def simulated(self) -> float:
+        """Seconds in the devices' time (the same as `elapsed` on real hardware)."""
+        return self.elapsed / self.time_scale
+
+    @property
+    def slides_per_hour(self) -> float:
+        return 3600 * len(self.slides) / self.simulated if self.simulated > 0 else 0.0
+
+    def __str__(self) -> str:
+        lines = [f"{len(self.slides)} slides in {self.simulated:.1f}s ({self.simulated / max(1, len(self.slides)):.1f}s/slide, "
+                 f"{self.slides_per_hour:.1f} slides/hour)"]
+        for device, busy in sorted(self.busy.items()):
+            lines.append(f"\t{device:>8} busy {busy / self.time_scale:7.1f}s ({100 * busy / self.elapsed:5.1f}%)")
+        return "\n".join(lines)
+
+
+class Cell:
+    """Starts a worker process per device of `config` (a dict or a JSON file) and runs slides through them.
+    Use as a context manager, or call `start` and `close`.
+    """
+    def __init__(self, config: Union[dict, str, Path], verbose: bool = False, job_timeout: float = DEFAULT_JOB_TIMEOUT):
+        if not isinstance(config, dict):
+            with open(config) as f:
+                config = json.load(f)
+        self.config = config
+        self.verbose = verbose
+        self.job_timeout = job_timeout
+        self.time_scale = float(config.get("time_scale", 1.0))
+        arm_names = [a["name"] for a in config["arms"]]
+        self.stations = [_Station(s["name"], s, s.get("arms", arm_names)) for s in config["scopes"]]
+        for station in self.stations:
+            unknown = set(station.arms) - set(arm_names)
+            if unknown:
+                raise ValueError(f"Scope {station.name} is served by unknown arms {sorted(unknown)}")
+        # Spawned (not forked) workers, so they don't inherit our threads (e.g. the trace writer)
+        self._mp = multiprocessing.get_context("spawn")
+        self._results = self._mp.Queue()
+        self._commands: dict[str, multiprocessing.Queue] = {}
+        self._processes: dict[str, multiprocessing.Process] = {}
+
+    def start(self):
+        safe_zone = self.config.get("safe_zone")
+        devices = [("arm", dict(a, safe_zone=a.get("safe_zone", safe_zone))) for a in self.config["arms"]]
+        # Resolved here, the workers run in their own output folders
+        catalog = Path(self.config["catalog"]).resolve().as_posix() if self.config.get("catalog") else None
+        devices += [("scope", dict(s, catalog=s.get("catalog", catalog))) for s in self.config["scopes"]]
+        for kind, device in devices:
+            commands = self._mp.Queue()
+            process = self._mp.Process(target=_worker, name=device["name"], daemon=True,
+                                       args=(kind, device, self.time_scale, self.config.get("output_dir"), self.verbose, commands, self._results))
+            process.start()
+            self._commands[device["name"]] = commands
+            self._processes[device["name"]] = process
+        # Wait until every device is connected (and powered up) before timing anything
+        for _ in devices:
+            name, _, error, _, _ = self._results.get(timeout=self.job_timeout)
+            if error is not None:
+                self.close()
+                raise RuntimeError(f"{name} did not start: {error}")
+        return self
+
+    def close(self):
+        for commands in self._commands.values():
+            commands.put(None)
+        for process in self._processes.values():
+            process.join(timeout=10.0)
+            if process.is_alive():
+                process.terminate()
+        self._commands, self._processes = {}, {}
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def _jobs_for_arm(self, arm: str, waiting: list[Slide]) -> Optional[tuple[str, _Station]]:
+        """The most urgent thing `arm` can do: emptying a stage or loading one keeps a scope busy, so those come
+        before fetching a new slide.
+        """
+        stations = [s for s in self.stations if arm in s.arms]
+        for station in stations:
+            if station.stage is not None and station.imaged and not station.scope_busy and not station.arm_in_stage_area:
+                return STORE, station
+        for station in stations:
+            if station.stage is None and station.staging is not None and not station.scope_busy and not station.arm_in_stage_area:
+                return LOAD, station
+        if waiting:
+            # The emptiest station first, so slides spread over the scopes
+            free = [s for s in stations if s.staging is None and not s.fetching]
+            if free:
+                return FETCH, min(free, key=lambda s: (s.stage is not None, self.stations.index(s)))
+        return None
+
+    def run(self, slides: Union[int, list[str]]) -> CellReport:
+        """Run slides (a count, or their names) through the cell and return when all of them are stored.
+        If a job fails no new jobs are started, the running ones finish and a RuntimeError is raised.
+        Frames are recorded in the catalog under the names as slide ids. Slides that are only counted get none,
+        their stand-in names (slide-0, ...) would stand for a different slide every run.
+        """
+        if isinstance(slides, int):
+            all_slides = [Slide(i, f"slide-{i}") for i in range(slides)]
+        else:
+            all_slides = [Slide(i, name, name) for i, name in enumerate(slides)]
+        waiting = list(all_slides)
+        free_arms = [a["name"] for a in self.config["arms"]]
+        # job id -> (phase, station, slide, device)
+        running: dict[int, tuple[str, _Station, Slide, str]] = {}
+        busy = {name: 0.0 for name in self._processes}
+        n_done, next_id, error = 0, 0, None
+        t0 = time.time()
+        run_id = new_run_id()
+        with tracing.span("cell.run", "cell", slides=len(all_slides), arms=len(free_arms), scopes=len(self.stations)):
+            while n_done < len(all_slides):
+                if error is None:
+                    # Hand out jobs until nothing else can start
+                    for arm in list(free_arms):
+                        job = self._jobs_for_arm(arm, waiting)
+                        if job is None:
+                            continue
+                        phase, station = job
+                        if phase == FETCH:
+                            slide = waiting.pop(0)
+                            slide.scope = station.name
+                            station.fetching = True
+                        elif phase == LOAD:
+                            slide = station.staging
+                            station.arm_in_stage_area = True
+                        else:
+                            slide = station.stage
+                            station.arm_in_stage_area = True
+                        free_arms.remove(arm)
+                        running[next_id] = (phase, station, slide, arm)
+                        self._commands[arm].put((next_id, "pick_and_place", (station.config[phase],)))
+                        next_id += 1
+                    for station in self.stations:
+                        if station.stage is not None and not station.imaged and not station.scope_busy and not station.arm_in_stage_area:
+                            station.scope_busy = True
+                            running[next_id] = (IMAGE, station, station.stage, station.name)
+                            self._commands[station.name].put((next_id, "image", (f"{station.name}/{station.stage.name}", station.stage.slide_id, run_id)))
+                            next_id += 1
+                if not running:
+                    if error is not None:
+                        break
+                    raise RuntimeError(f"Cell is stuck with {len(waiting)} slides waiting")
+                try:
+                    device, job_id, job_error, start, end = self._results.get(timeout=self.job_timeout)
+                except queue.Empty:
+                    dead = [name for name, p in self._processes.items() if not p.is_alive()]
+                    raise RuntimeError(f"No job finished in {self.job_timeout}s (dead workers: {dead})")
+                phase, station, slide, _ = running.pop(job_id)
+                slide.jobs.append((phase, device, start - t0, end - t0))
+                busy[device] += end - start
+                if job_error is not None:
+                    error = error or RuntimeError(f"{phase} of {slide.name} on {device} failed: {job_error}")
+                if phase == IMAGE:
+                    station.scope_busy = False
+                    station.imaged = True
+                else:
+                    free_arms.append(device)
+                    if phase == FETCH:
+                        station.fetching = False
+                        station.staging = slide
+                    elif phase == LOAD:
+                        station.arm_in_stage_area = False
+                        station.staging, station.stage, station.imaged = None, slide, False
+                    else:
+                        station.arm_in_stage_area = False
+                        station.stage = None
+                        n_done += 1
+        if error is not None:
+            raise error
+        return CellReport(all_slides, time.time() - t0, busy, self.time_scale)
+
+
+def sim_config(n_arms: int, n_scopes: int, time_scale: float = 0.05) -> dict:
+    """A cell of simulated devices laid out like `bench_cell.py`'s, every scope served by one arm (round robin)."""
+    import bench_cell
+    arms = [{"name": f"arm{i}", "sim": True, "home": bench_cell.BENCH_HOME} for i in range(n_arms)]
+    scopes = [{
+        "name": f"scope{j}", "sim": True, "arms": [f"arm{j % n_arms}"],
+        "home": bench_cell.BENCH_SCOPE_POSITIONS["home"], "image": bench_cell.BENCH_SCOPE_POSITIONS["image"],
+        "fetch": bench_cell.BENCH_ARM_POSITIONS["pick-and-place-top-shelf-in-to-staging"],
+        "load": bench_cell.BENCH_ARM_POSITIONS["pick-and-place-staging-to-scope"],
+        "store": bench_cell.BENCH_ARM_POSITIONS["pick-and-place-scope-to-bottom-shelf-out"],
+    } for j in range(n_scopes)]
+    zone = bench_cell.BENCH_SAFE_ZONE
+    return {"time_scale": time_scale, "safe_zone": [zone.low, zone.high], "arms": arms, "scopes": scopes}
+
+
+def main():
+    import argparse
+    import tempfile
+    parser = argparse.ArgumentParser(description="Run slides through a cell of several arms and scopes")
+    parser.add_argument("config", nargs="?", default=None, help="Cell config (JSON)")
+    parser.add_argument("--sim", type=int, nargs=2, metavar=("ARMS", "SCOPES"), default=None,
+                        help="Use simulated devices instead of a config, and compare with a 1 arm 1 scope cell")
+    parser.add_argument("--slides", type=int, default=None, help="Default: 3 per scope")
+    parser.add_argument("--time-scale", type=float, default=0.05)
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+    if args.config is not None:
+        with Cell(args.config, verbose=args.verbose) as cell:
+            report = cell.run(args.slides or 3 * len(cell.stations))
+        print(report)
+        return
+    n_arms, n_scopes = args.sim or (2, 2)
+    slides = args.slides or 3 * n_scopes
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        n_named = 0
+        for arms, scopes, n in [(1, 1, max(1, slides // n_scopes)), (n_arms, n_scopes, slides)]:
+            config = dict(sim_config(arms, scopes, args.time_scale), output_dir=tmp, catalog=Path(tmp, "catalog.db").as_posix())
+            with Cell(config, verbose=args.verbose) as cell:
+                # Every physical slide has its own name, like the ids off their labels
+                report = cell.run([f"slide-{n_named + i}" for i in range(n)])
+                n_named += n
+            print(f"{arms} arm(s), {scopes} scope(s): {report}")
+            results.append(report)
+        from catalog import Catalog
+        with Catalog(Path(tmp, "catalog.db")) as catalog:
+            print(f"catalog: {len(catalog)} frames in {len(catalog.runs())} runs, "
+                  f"{len(catalog.by_slide('slide-0'))} of them of slide-0 "
+                  f"(in {len({c.run_id for c in catalog.by_slide('slide-0')})} run)")
+    print(f"{results[1].slides_per_hour / results[0].slides_per_hour:.2f}x the slides/hour of 1 arm and 1 scope")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,316 @@
+#!/usr/bin/env python3
+"""Post-run analysis of where the cycle time of a cell run (`main.py`, `bench_cell.py`) goes.
+
+Reads a trace written by `tracing` (run with HARDWARE_TRACE=trace.jsonl) and rebuilds every scheduler run
+from it: the steps with their dependencies and resources, and inside every step the arm moves, gripper
+actions, scope moves, exposures and decodes it did (image saves run in the background and are listed on
+their own). From that it finds the critical path, the chain of steps where each one had to wait for the one
+before it (a dependency or a resource it needed) and that ends with the last step, and the idle time of
+every actor. Only time on the critical path makes the run longer, so that is what gets ranked.
+
+Run with python3 critical_path.py trace.jsonl [--run -1] [--chrome run.json]
+The Chrome trace can be opened in chrome://tracing or https://ui.perfetto.dev
+"""
+from __future__ import annotations
+
+import json
+from pathlib import Path
+from typing import Optional, Union
+
+# Slack (seconds) for comparing times, spans store their start as wall-clock time and their duration from a
+# different clock so the ends are not exact
+_EPSILON = 1e-3
+
+def category(kind: str) -> str:
+    """What a traced call was spent on, for breakdowns."""
+    if kind == "gpl.waitforeom" or kind.startswith("gpl.move") or kind == "gpl.home":
+        return "arm motion"
+    if kind.startswith("gpl."):
+        return "arm commands"
+    if kind.startswith("gripper."):
+        return "gripper"
+    if kind.startswith("http./run/move"):
+        return "stage motion"
+    if kind == "scope.settle":
+        return "stage settle"
+    if kind == "http./get/image":
+        return "exposure + transfer"
+    if kind.startswith("http."):
+        return "scope queries"
+    if kind.startswith("decode."):
+        return "decode"
+    if kind.startswith("save."):
+        return "save"
+    return kind
+
+
+class Span:
+    def __init__(self, d: dict):
+        self.kind = d["kind"]
+        self.actor = d["actor"]
+        self.start = d["start"]
+        self.end = d["end"]
+        self.thread = d.get("thread")
+        self.args = d.get("args") or {}
+
+    @property
+    def duration(self) -> float:
+        return self.end - self.start
+
+
+class StepRecord:
+    """A scheduler step as it ran, with the traced calls it made."""
+    def __init__(self, span: Span):
+        self.span = span
+        self.name = span.args["name"]
+        self.phase = span.kind[len("step."):]
+        self.actor = span.actor
+        self.slide = span.args.get("slide")
+        self.after = span.args.get("after", [])
+        self.resources = set(span.args.get("resources", []))
+        self.start = span.start
+        self.end = span.end
+        self.children: list[Span] = []
+        self.critical = False
+
+    @property
+    def duration(self) -> float:
+        return self.end - self.start
+
+    def top_level_children(self) -> list[Span]:
+        """The traced calls not made from inside another one on the same thread (e.g. not the position queries
+        `scope.settle` polls with), so their durations add up to at most the step's.
+        """
+        out = []
+        # The outermost span open on every thread
+        outer: dict[Optional[int], Span] = {}
+        for child in sorted(self.children, key=lambda c: (c.start, -c.end)):
+            parent = outer.get(child.thread)
+            if parent is not None and child.start >= parent.start - _EPSILON and child.end <= parent.end + _EPSILON:
+                continue
+            outer[child.thread] = child
+            out.append(child)
+        return out
+
+    def breakdown(self) -> dict[str, float]:
+        """Seconds per category, whatever the calls don't cover (sleeps, Python, waiting on saves) is `other`."""
+        out: dict[str, float] = {}
+        for child in self.top_level_children():
+            c = category(child.kind)
+            out[c] = out.get(c, 0.0) + child.duration
+        out["other"] = max(0.0, self.duration - sum(out.values()))
+        return out
+
+
+class Run:
+    def __init__(self, start: float, end: float, steps: list[StepRecord], background: list[Span]):
+        self.start = start
+        self.end = end
+        self.steps = steps
+        # Traced calls that did not happen inside a step (e.g. image saves on the writer threads)
+        self.background = background
+        self.critical: list[StepRecord] = critical_path(steps)
+        for step in self.critical:
+            step.critical = True
+
+    @property
+    def duration(self) -> float:
+        return self.end - self.start
+
+    @property
+    def slides(self) -> list[int]:
+        return sorted({s.slide for s in self.steps if s.slide is not None})
+
+    def idle(self) -> dict[str, tuple[float, float]]:
+        """Busy and idle seconds per actor."""
+        intervals: dict[str, list[tuple[float, float]]] = {}
+        for step in self.steps:
+            intervals.setdefault(step.actor, []).append((step.start, step.end))
+        for span in self.background:
+            intervals.setdefault(span.actor, []).append((span.start, span.end))
+        out = {}
+        for actor, spans in intervals.items():
+            busy = _union_length(spans)
+            out[actor] = (busy, self.duration - busy)
+        return out
+
+    def ranked(self) -> list[tuple[str, str, float]]:
+        """(phase, category, seconds) on the critical path, largest first. Waits between steps on the path
+        (scheduler latency or a blocker we could not see) are `(wait, scheduling)`.
+        """
+        totals: dict[tuple[str, str], float] = {}
+        previous_end = self.start
+        for step in self.critical:
+            gap = step.start - previous_end
+            if gap > 0:
+                totals[("wait", "scheduling")] = totals.get(("wait", "scheduling"), 0.0) + gap
+            for cat, seconds in step.breakdown().items():
+                totals[(step.phase, cat)] = totals.get((step.phase, cat), 0.0) + seconds
+            previous_end = step.end
+        return sorted(((p, c, t) for (p, c), t in totals.items()), key=lambda x: -x[2])
+
+
+def _union_length(intervals: list[tuple[float, float]]) -> float:
+    total = 0.0
+    current_start, current_end = None, None
+    for start, end in sorted(intervals):
+        if current_end is None or start > current_end:
+            if current_end is not None:
+                total += current_end - current_start
+            current_start, current_end = start, end
+        else:
+            current_end = max(current_end, end)
+    if current_end is not None:
+        total += current_end - current_start
+    return total
+
+
+def critical_path(steps: list[StepRecord]) -> list[StepRecord]:
+    """Walk back from the step that finished last, each time to whatever it was waiting on: the dependency or
+    the step holding one of its resources that finished last before it started.
+    """
+    if not steps:
+        return []
+    by_name = {s.name: s for s in steps}
+    current = max(steps, key=lambda s: s.end)
+    path = [current]
+    while True:
+        candidates = [by_name[d] for d in current.after if d in by_name]
+        candidates += [s for s in steps if s is not current and s.resources & current.resources]
+        candidates = [s for s in candidates if s.end <= current.start + _EPSILON and s not in path]
+        if not candidates:
+            break
+        current = max(candidates, key=lambda s: s.end)
+        path.append(current)
+    return path[::-1]
+
+
+def trace_files(path: Union[str, Path]) -> list[Path]:
+    """The trace and its rotated backups, oldest first."""
+    path = Path(path)
+    backups = [p for p in path.parent.glob(path.name + ".*") if p.suffix[1:].isdigit()]
+    backups.sort(key=lambda p: int(p.suffix[1:]), reverse=True)
+    return backups + ([path] if path.exists() else [])
+
+def load_spans(path: Union[str, Path]) -> list[Span]:
+    spans = []
+    for file in trace_files(path):
+        with open(file) as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    spans.append(Span(json.loads(line)))
+    return sorted(spans, key=lambda s: s.start)
+
+def runs(spans: list[Span]) -> list[Run]:
+    """Split the trace into scheduler runs and attach every traced call to the step that made it (same
+    thread, inside the step's time).
+    """
+    run_spans = [s for s in spans if s.kind == "schedule.run"]
+    if not run_spans:
+        # A trace from before runs were traced (or cut off by the rotation): treat it all as one run
+        run_spans = [Span({"kind": "schedule.run", "actor": "cell", "start": spans[0].start, "end": max(s.end for s in spans)})] if spans else []
+    out = []
+    for run_span in run_spans:
+        inside = [s for s in spans if s is not run_span and s.start >= run_span.start and s.end <= run_span.end + _EPSILON]
+        steps = [StepRecord(s) for s in inside if s.kind.startswith("step.")]
+        by_thread: dict[Optional[str], list[StepRecord]] = {}
+        for step in steps:
+            by_thread.setdefault(step.span.thread, []).append(step)
+        background = []
+        for span in inside:
+            if span.kind.startswith("step.") or span.kind == "schedule.run":
+                continue
+            owner = next((st for st in by_thread.get(span.thread, []) if st.start <= span.start and span.end <= st.end + _EPSILON), None)
+            if owner is not None:
+                owner.children.append(span)
+            else:
+                background.append(span)
+        out.append(Run(run_span.start, run_span.end, steps, background))
+    return out
+
+
+def report(run: Run, top: int = 15) -> str:
+    lines = []
+    n_slides = len(run.slides)
+    per_slide = f", {run.duration / n_slides:.1f}s/slide" if n_slides else ""
+    lines.append(f"Run: {run.duration:.1f}s, {n_slides} slides{per_slide}")
+    on_path = sum(s.duration for s in run.critical)
+    lines.append(f"Critical path: {len(run.critical)} steps, {on_path:.1f}s of work ({100 * on_path / run.duration:.1f}% of the run)")
+    lines.append("    " + " -> ".join(s.name for s in run.critical))
+    lines.append("Where the cycle time goes (critical path):")
+    for i, (phase, cat, seconds) in enumerate(run.ranked()[:top]):
+        lines.append(f"  {i + 1:2d}. {phase:<12} {cat:<20} {seconds:8.2f}s {100 * seconds / run.duration:5.1f}%")
+    lines.append("Idle time per actor:")
+    for actor, (busy, idle) in sorted(run.idle().items()):
+        lines.append(f"  {actor:<8} busy {busy:8.2f}s ({100 * busy / run.duration:5.1f}%), idle {idle:8.2f}s")
+    lines.append("Per slide timeline (* = on the critical path):")
+    for slide in [None] + run.slides:
+        steps = [s for s in run.steps if s.slide == slide]
+        if not steps:
+            continue
+        lines.append(f"  slide {slide}:" if slide is not None else "  setup:")
+        for step in sorted(steps, key=lambda s: s.start):
+            parts = ", ".join(f"{c} {t:.2f}s" for c, t in sorted(step.breakdown().items(), key=lambda x: -x[1]) if t >= 0.005)
+            lines.append(f"   {'*' if step.critical else ' '} {step.start - run.start:8.2f}s +{step.duration:7.2f}s  {step.actor:<6} {step.name:<16} {parts}")
+    if run.background:
+        lines.append("Background work:")
+        totals: dict[str, list[float]] = {}
+        for span in run.background:
+            totals.setdefault(span.kind, []).append(span.duration)
+        for kind, durations in sorted(totals.items()):
+            lines.append(f"  {kind:<24} {len(durations):5d}x {sum(durations):8.2f}s")
+    return "\n".join(lines)
+
+
+def chrome_trace(run: Run) -> dict:
+    """The run in Chrome's trace event format: one row per actor, steps with their calls nested under them
+    and the critical path in red.
+    """
+    events = []
+    tids: dict[str, int] = {}
+
+    def tid(actor: str) -> int:
+        if actor not in tids:
+            tids[actor] = len(tids) + 1
+            events.append({"ph": "M", "name": "thread_name", "pid": 1, "tid": tids[actor], "args": {"name": actor}})
+        return tids[actor]
+
+    def event(span_name: str, cat: str, actor: str, start: float, end: float, args: dict, **extra) -> dict:
+        return dict({"ph": "X", "name": span_name, "cat": cat, "pid": 1, "tid": tid(actor),
+                     "ts": (start - run.start) * 1e6, "dur": max(0.0, end - start) * 1e6, "args": args}, **extra)
+
+    for step in run.steps:
+        extra = {"cname": "terrible"} if step.critical else {}
+        events.append(event(step.name, "step", step.actor, step.start, step.end,
+                            {"slide": step.slide, "after": step.after, "critical": step.critical}, **extra))
+        for child in step.children:
+            events.append(event(child.kind, category(child.kind), step.actor, child.start, child.end, child.args))
+    for span in run.background:
+        events.append(event(span.kind, category(span.kind), span.actor, span.start, span.end, span.args))
+    return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+def write_chrome_trace(run: Run, path: Union[str, Path]):
+    with open(path, "w") as f:
+        json.dump(chrome_trace(run), f)
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="Critical path and idle time report for a traced cell run")
+    parser.add_argument("trace", help="The trace file (HARDWARE_TRACE), rotated backups next to it are read too")
+    parser.add_argument("--run", type=int, default=-1, help="Which scheduler run in the trace (default the last one)")
+    parser.add_argument("--top", type=int, default=15)
+    parser.add_argument("--chrome", default=None, help="Also write the run as a Chrome/Perfetto trace to this file")
+    args = parser.parse_args()
+    all_runs = runs(load_spans(args.trace))
+    if not all_runs:
+        raise SystemExit(f"No spans in {args.trace}")
+    run = all_runs[args.run]
+    print(report(run, args.top))
+    if args.chrome is not None:
+        write_chrome_trace(run, args.chrome)
+        print(f"Wrote {args.chrome}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""A local stand-in for the `online` storage API so `uploader.py` can be run (and benchmarked) without it.
+
+It implements the two endpoints the uploader uses:
+- `POST /api/images/missing` with `{"sha256": [...]}` replies `{"missing": [...]}`, the hashes it does not have
+- `POST /api/images` with a multipart/form-data body: a `manifest` part (JSON list of `{"name", "sha256",
+  "size"}`) followed by one file part per entry, in the same order. Every file is checked against its hash
+  and kept (in memory, or in `root` if given). Replies `{"stored": [...]}`.
+`fail_every` makes every n-th upload fail with a 503 and `latency` delays every reply, to exercise retries.
+"""
+from __future__ import annotations
+
+import hashlib
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Optional, Union
+
+DEFAULT_FAKE_STORAGE_PORT = 8500
+
+class FakeStorage:
+    def __init__(self, root: Optional[Union[str, Path]] = None, fail_every: int = 0, latency: float = 0.0):
+        self.lock = threading.Lock()
+        self.root = Path(root) if root is not None else None
+        self.fail_every = fail_every
+        self.latency = latency
+        # sha256 -> (name, content) (content is None when it is kept on disk)
+        self.objects: dict[str, tuple[str, Optional[bytes]]] = {}
+        self.n_uploads = 0
+        self.n_files = 0
+        self.bytes_received = 0
+
+    def missing(self, hashes: list[str]) -> list[str]:
+        with self.lock:
+            return [h for h in hashes if h not in self.objects]
+
+    def store(self, name: str, sha256: str, content: bytes):
+        if hashlib.sha256(content).hexdigest() != sha256:
+            raise ValueError(f"{name} does not match its hash")
+        if self.root is not None:
+            path = self.root / sha256[:2] / sha256
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_bytes(content)
+        with self.lock:
+            self.objects[sha256] = (name, None if self.root is not None else content)
+            self.n_files += 1
+
+
+def parse_multipart(body: bytes, content_type: str) -> list[tuple[dict[str, str], bytes]]:
+    """(headers, content) of every part of a multipart body."""
+    boundary = content_type.split("boundary=", 1)[1].strip('"').encode()
+    parts = []
+    for chunk in body.split(b"--" + boundary)[1:]:
+        if chunk.startswith(b"--"):
+            break
+        head, _, content = chunk[2:].partition(b"\r\n\r\n")
+        headers = {}
+        for line in head.decode().split("\r\n"):
+            key, _, value = line.partition(":")
+            headers[key.strip().lower()] = value.strip()
+        # Every part ends with the CRLF in front of the next boundary
+        parts.append((headers, content[:-2]))
+    return parts
+
+
+class FakeStorageHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    wbufsize = -1
+    disable_nagle_algorithm = True
+    storage: FakeStorage = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, data: dict, code: int = 200):
+        body = json.dumps(data).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.storage.latency:
+            time.sleep(self.storage.latency)
+        if self.path == "/api/images/missing":
+            self._reply({"missing": self.storage.missing(json.loads(body)["sha256"])})
+        elif self.path == "/api/images":
+            with self.storage.lock:
+                self.storage.n_uploads += 1
+                self.storage.bytes_received += len(body)
+                fail = self.storage.fail_every and self.storage.n_uploads % self.storage.fail_every == 0
+            if fail:
+                self._reply({"error": "temporarily unavailable"}, code=503)
+                return
+            parts = parse_multipart(body, self.headers["Content-Type"])
+            manifest = json.loads(parts[0][1])
+            try:
+                for entry, (_, content) in zip(manifest, parts[1:]):
+                    self.storage.store(entry["name"], entry["sha256"], content)
+            except ValueError as e:
+                self._reply({"error": str(e)}, code=400)
+                return
+            self._reply({"stored": [entry["sha256"] for entry in manifest]})
+        else:
+            self._reply({"error": f"unknown page {self.path}"}, code=404)
+
+
+def serve_in_background(host: str = "127.0.0.1", port: int = 0, storage: Optional[FakeStorage] = None) -> ThreadingHTTPServer:
+    """Start the fake storage server on a daemon thread. Use port 0 to get a free port (see `server.server_port`)."""
+    storage = FakeStorage() if storage is None else storage
+    handler = type("BoundFakeStorageHandler", (FakeStorageHandler,), {"storage": storage})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    server.storage = storage
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="Run a fake image storage server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=DEFAULT_FAKE_STORAGE_PORT)
+    parser.add_argument("--root", default=None, help="Keep the files here instead of in memory")
+    args = parser.parse_args()
+    server = serve_in_background(args.host, args.port, FakeStorage(args.root))
+    print(f"Fake storage listening on http://{args.host}:{server.server_port} (Ctrl+C to stop)")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,24 +1,43 @@
 from __future__ import annotations
-import time
+import sys
+from pathlib import Path
 
-# Not clear if we should use arm_movement or sample_movement
-from arm.arm_movement import PA3400, Gripper
-from arm.sample_movement import DEFAULT_HOST as ARM_DEFAULT_HOST
-from arm.sample_movement import DEFAULT_PORT as ARM_DEFAULT_PORT
+# The arm and microscope modules import each other by file name (they are meant to be runnable from their
+# own folders) so put both folders on the path instead of importing them as packages
+_HARDWARE_DIR = Path(__file__).resolve().parent
+sys.path.extend([(_HARDWARE_DIR / "arm").as_posix(), (_HARDWARE_DIR / "microscope").as_posix()])
 
-from microscope.web_example import PyuscopeHTTPClient
-from microscope.microscope_moves import image_pos, DEFAULT_SCOPE_IP, DEFAULT_SCOPE_PORT
+from typing import Optional, Union
+
+from arm_lib import PA3400, Gripper, OverlappedGripper, SafeZone
+from arm_lib import DEFAULT_HOST as ARM_DEFAULT_HOST
+from arm_lib import DEFAULT_PORT as ARM_DEFAULT_PORT
+
+from web_example import PyuscopeHTTPClient
+from microscope_moves import image_pos, DEFAULT_SCOPE_IP, DEFAULT_SCOPE_PORT
+from focus_map import FocusMapStore, FocusedScan, DEFAULT_FOCUS_MAP_FILE
+from catalog import Catalog, DEFAULT_CATALOG_FILE, new_run_id
+from scheduler import Scheduler, ARM, SCOPE, STAGE_AREA
+import tracing
+import critical_path
 # Image position is going to image the position requested FROM THE REFERENCE FRAME OF THE MICROSCOPE
 
 ARM_INTERMEDIATE_IN_TO_SCOPE_POSITION = [0, 0, 0, 0, 0, 0] # TODO
 ARM_SCOPE_POSITION = [0, 0, 0, 0, 0, 0] # TODO
 ARM_INTERMEDIATE_SCOPE_TO_OUT_POSITION = [0, 0, 0, 0, 0, 0] # TODO
+# Somewhere next to the scope (but out of the way of the stage) where one slide can be parked while another is imaged
+ARM_STAGING_POSITION = [0, 0, 0, 0, 0, 0] # TODO
 ARM_POSITIONS = {
     'home': [0, 0, 0, 0, 0, 0], # TODO
     # Two places to pickup for now: top and bottom shelf
-    'pick-and-place-top-shelf-in-to-scope': [
+    'pick-and-place-top-shelf-in-to-staging': [
         [0, 0, 0, 0, 0, 0], # LOCATION OF TOP SHELF (IN) TODO
         ARM_INTERMEDIATE_IN_TO_SCOPE_POSITION,
+        ARM_STAGING_POSITION,
+    ],
+    'pick-and-place-staging-to-scope': [
+        ARM_STAGING_POSITION,
+        ARM_INTERMEDIATE_IN_TO_SCOPE_POSITION,
         ARM_SCOPE_POSITION,
     ],
     'pick-and-place-scope-to-bottom-shelf-out': [
@@ -26,10 +45,10 @@ ARM_POSITIONS = {
         ARM_INTERMEDIATE_SCOPE_TO_OUT_POSITION,
         [0, 0, 0, 0, 0, 0], # LOCATION OF BOTTOM SHELF (OUT) TODO
     ],
-    'pick-and-and-place-bottom-shelf-in-to-scope': [
+    'pick-and-and-place-bottom-shelf-in-to-staging': [
         [0, 0, 0, 0, 0, 0], # LOCATION OF BOTTOM SHELF (IN) TODO
         ARM_INTERMEDIATE_IN_TO_SCOPE_POSITION,
-        ARM_SCOPE_POSITION,
+        ARM_STAGING_POSITION,
     ],
     'pick-and-place-scope-to-top-shelf-out': [
         ARM_SCOPE_POSITION,
@@ -38,96 +57,143 @@ ARM_POSITIONS = {
     ],
 }
 
+# Box (xyz, mm) the arm can move through without hitting anything. Pick-and-place paths that stay inside it skip
+# the extra trip home "for safety". None means we don't know it yet so the arm always goes home.
+ARM_SAFE_ZONE: Optional[SafeZone] = None # TODO
+
 MICROSCOPE_POSITIONS = {
     'home': {'x': None, 'y': None, 'z': None}, # TODO)
     'image': {'x': None, 'y': None, 'z': None}, # TODO
 }
 
+# Each slide is fetched from its input shelf into the staging slot next to the scope, loaded onto the
+# stage, imaged and then stored in its output shelf. Because of the staging slot the arm can already
+# fetch the next slide while the current one is still being imaged.
 # TODO(Adriano) deal with image names
-INSTR_SEQUENCE: tuple[str, str] = [
-    # Start at home
-    ('arm', 'home'),
-    ('scope', 'home'),
-    # Pickup and place sequence
-    ('arm', 'pick-and-place-top-shelf-in-to-scope'),
-    # Wait at home
-    ('arm', 'home'),
-    # Image position
-    ('scope', 'image'), # NOTE that the "image" command both MOVES to the image location AND takes MULTIPLE IMAGES
-    ('scope', 'home'),
-    # Pickup and place in the output box sequence)
-    ('arm', 'pick-and-place-scope-to-bottom-shelf-out'),
-    # Home and repeat
-    ('arm', 'home')
-    ('arm', 'pick-and-and-place-bottom-shelf-in-to-scope'),
-    # Wait at home (second time)
-    ('arm', 'home')
-    # Now image again
-    ('scope', 'image'),
-    ('scope', 'home'),
-    # Now move it
-    ('arm', 'pick-and-place-scope-to-top-shelf-out'),
-    # Idle at home now
-    ('arm', 'home')
-    # Now we are done
+SLIDE_SEQUENCE: list[tuple[str, str]] = [
+    # (fetch: input shelf -> staging, store: scope -> output shelf)
+    ('pick-and-place-top-shelf-in-to-staging', 'pick-and-place-scope-to-bottom-shelf-out'),
+    ('pick-and-and-place-bottom-shelf-in-to-staging', 'pick-and-place-scope-to-top-shelf-out'),
 ]
+# The ids of the slides (e.g. off their labels) in the order of SLIDE_SEQUENCE, recorded with every frame in the
+# catalog. None records no slide id: the shelf slot and run id are all that is known then.
+SLIDE_IDS: Optional[list[str]] = None # TODO
+
+def arm_pick_and_place(robot: PA3400, gripper: Union[Gripper, OverlappedGripper], instruction: str, arm_positions: dict = ARM_POSITIONS,
+                       blended: bool = True, safe_zone: Optional[SafeZone] = ARM_SAFE_ZONE):
+    posses = arm_positions[instruction]
+    assert isinstance(posses, list)
+    assert len(posses) == 3
+    assert all(isinstance(pos, list) for pos in posses)
+    assert all(len(pos) == 6 for pos in posses)
+    assert all(all(isinstance(n, (int, float)) for n in pos) for pos in posses)
+    _ = '\t\n'.join(str(n) for n in posses)
+    print(f"ARM MOVING AND THEN PLACING DOWN TO/AT and then going to:\n{_}\n")
+    if blended:
+        # One continuous motion between gripper actions instead of stopping at every point
+        safe = robot.pick_and_place_path(posses[0], posses[1], posses[2], gripper, safe_zone=safe_zone)
+    else:
+        robot.pick_and_place(posses[0], posses[1], posses[2], gripper)
+        safe = False
+    if not safe:
+        robot.gohome() # For safety just in case
+
+def scope_image(scope: PyuscopeHTTPClient, scope_positions: dict = MICROSCOPE_POSITIONS, focus_store: Optional[FocusMapStore] = None,
+                slot: Optional[str] = None, catalog: Optional[Catalog] = None, capture_info: Optional[dict] = None):
+    print("IMAGING!")
+    # Every slide slot keeps its own focus map so a slide we already imaged needs no new focus work
+    focus = FocusedScan(scope, focus_store.get(slot), focus_store) if focus_store is not None else None
+    # image_pos modifies the position it is given so give it a copy
+    image_pos(dict(scope_positions['image']), client=scope, focus=focus, catalog=catalog, capture_info=dict(capture_info or {}, slot=slot))
+
+def scope_home(scope: PyuscopeHTTPClient, scope_positions: dict = MICROSCOPE_POSITIONS):
+    print("SCOPE GOING HOME!")
+    scope.move_absolute(scope_positions['home'])
+
+def build_schedule(robot: PA3400, gripper: Union[Gripper, OverlappedGripper], scope: PyuscopeHTTPClient, slides: list[tuple[str, str]] = SLIDE_SEQUENCE, debug: bool = False,
+                   arm_positions: dict = ARM_POSITIONS, scope_positions: dict = MICROSCOPE_POSITIONS, pipelined: bool = True,
+                   blended: bool = True, safe_zone: Optional[SafeZone] = ARM_SAFE_ZONE, focus_store: Optional[FocusMapStore] = None,
+                   catalog: Optional[Catalog] = None, slide_ids: Optional[list[str]] = None) -> Scheduler:
+    """Turn the slide sequence into a DAG of steps. The dependencies encode what physically has to happen
+    first (a slide has to be on the stage before it is imaged, the staging slot has to be empty before
+    the next slide is fetched, ...) and the resources make sure that the arm, the scope and the stage
+    area are never used by two steps at once. Everything else is free to overlap.
+
+    With `pipelined=False` every step also locks the whole cell, so the steps run one at a time in the
+    order they were added (like the old linear sequence), which is handy as a baseline. With `blended=False`
+    the arm stops at every point of a pick-and-place and always goes home afterwards. With a `focus_store` every
+    slide is imaged with the focus map of the input shelf slot it was fetched from. With a `catalog` every frame
+    is recorded in it under one run id, and under its slide's id if `slide_ids` (in the order of `slides`) are
+    given.
+    """
+    assert slide_ids is None or len(slide_ids) == len(slides)
+    sched = Scheduler(debug=debug)
+    run_id = new_run_id()
+    cell = [] if pipelined else ['cell']
+    arm_step = lambda instruction: (lambda: arm_pick_and_place(robot, gripper, instruction, arm_positions, blended, safe_zone))
+    sched.add('arm-home', robot.gohome, [ARM] + cell, actor='arm')
+    sched.add('scope-home', lambda: scope_home(scope, scope_positions), [SCOPE, STAGE_AREA] + cell, actor='scope')
+    prev_load, prev_scope_home, prev_store = None, 'scope-home', None
+    for i, (fetch, store) in enumerate(slides):
+        fetch_after = ['arm-home'] + ([prev_load] if prev_load is not None else [])
+        sched.add(f'fetch-{i}', arm_step(fetch), [ARM] + cell, after=fetch_after, actor='arm', slide=i)
+        if i > 0:
+            # The previous slide can only leave once the scope got out of the way
+            sched.add(f'store-{i - 1}', arm_step(prev_store), [ARM, STAGE_AREA] + cell, after=[prev_scope_home, f'load-{i - 1}'], actor='arm', slide=i - 1)
+        load_after = [f'fetch-{i}', prev_scope_home] + ([f'store-{i - 1}'] if i > 0 else [])
+        sched.add(f'load-{i}', arm_step('pick-and-place-staging-to-scope'), [ARM, STAGE_AREA] + cell, after=load_after, actor='arm', slide=i)
+        # The input shelf slot it came from, the same slot holds the same slide again next run
+        slot = fetch
+        info = {'run_id': run_id, 'slide_id': slide_ids[i] if slide_ids is not None else None}
+        sched.add(f'image-{i}', lambda slot=slot, info=info: scope_image(scope, scope_positions, focus_store, slot, catalog, info), [SCOPE, STAGE_AREA] + cell, after=[f'load-{i}'], actor='scope', slide=i)
+        sched.add(f'scope-home-{i}', lambda: scope_home(scope, scope_positions), [SCOPE, STAGE_AREA] + cell, after=[f'image-{i}'], actor='scope', slide=i)
+        prev_load, prev_scope_home, prev_store = f'load-{i}', f'scope-home-{i}', store
+    if prev_store is not None:
+        last = len(slides) - 1
+        sched.add(f'store-{last}', arm_step(prev_store), [ARM, STAGE_AREA] + cell, after=[prev_scope_home, f'load-{last}'], actor='arm', slide=last)
+    return sched
 
 def main():
     # Initialize arm!
-    preciseBoiAddress = {'host':ARM_DEFAULT_HOST,'port':ARM_DEFAULT_PORT}
-    robot = PA3400(preciseBoiAddress)
-    gripper = Gripper()
+    robot = PA3400(ARM_DEFAULT_HOST, ARM_DEFAULT_PORT)
+    # The gripper's serial I/O runs on its own thread so it overlaps with the arm's approach and retract moves
+    gripper = OverlappedGripper(Gripper())
 
     robot.connect()
     robot.enable()
-    robot.set_linear_motion()
-
-    robot.maxSpeed = 80
-
-    # Initialize scope
-    scope = PyuscopeHTTPClient(host=DEFAULT_SCOPE_IP, port=DEFAULT_SCOPE_PORT)
-
-    # Just go home
-    print("Going home!")
-    robot.gohome()
-
-    # NOTE that in each case the instruction is a POSITION and but it may implicitely imply doing certain more things!
-    for actor_name, instruction in INSTR_SEQUENCE:
-        if actor_name == 'arm':
-            if instruction == 'movec':
-                print(f"ARM MOVING TO: {' '.join(str(n) for n in ARM_POSITIONS[instruction])}")
-                robot.movec(ARM_POSITIONS[instruction])
-            elif 'pick-and-place' in instruction:
-                posses = ARM_POSITIONS[instruction]
-                assert isinstance(posses, list)
-                assert len(posses) == 3
-                assert all(isinstance(pos, list) for pos in posses)
-                assert all(len(pos) == 6 for pos in posses)
-                assert all(all(isinstance(n, (int, float)) for n in pos) for pos in posses)
-                _ = '\t\n'.join(str(n) for n in ARM_POSITIONS[instruction])
-                print(f"ARM MOVING AND THEN PLACING DOWN TO/AT and then going to:\n{_}\n")
-                robot.pick_and_place(posses[0], posses[1], posses[2], gripper)
-                robot.gohome() # For safety just in case
-        elif actor_name == 'scope':
-            if instruction == 'image':
-                print("IMAGING!")
-                image_pos(MICROSCOPE_POSITIONS[instruction], client=scope)
-            elif instruction == 'home':
-                print("SCOPE GOING HOME!")
-                scope.move_absolute(MICROSCOPE_POSITIONS[instruction])
-            else:
-                raise ValueError("GOT WRONG INSTRUCTION FOR MICROSCOPE")
-        else:
-            raise ValueError(f"Unknown actor name: {actor_name}")
-        
-    print("Done!")
-    print("Shutting down robot")
-    robot.gohome()
-    # time.sleep(8)
-    time.sleep(20)
+    try:
+        robot.set_linear_motion()
+
+        robot.maxSpeed = 80
+
+        # Initialize scope
+        scope = PyuscopeHTTPClient(host=DEFAULT_SCOPE_IP, port=DEFAULT_SCOPE_PORT)
+
+        # Focus maps are kept per shelf slot, so a slide we imaged before goes straight to its in-focus z
+        focus_store = FocusMapStore(DEFAULT_FOCUS_MAP_FILE)
+
+        # Every frame goes in the capture catalog so the images of a slide can be found without walking the folder
+        with Catalog(DEFAULT_CATALOG_FILE) as catalog:
+            # NOTE that in each case the instruction is a POSITION and but it may implicitely imply doing certain more things!
+            sched = build_schedule(robot, gripper, scope, debug=True, focus_store=focus_store, catalog=catalog, slide_ids=SLIDE_IDS)
+            total = sched.run()
+        print(f"Ran {len(SLIDE_SEQUENCE)} slides in {total:.1f}s ({3600 * len(SLIDE_SEQUENCE) / total:.1f} slides/hour)")
+        for step in sched.timeline():
+            print(f"\t{step.start:8.2f}s - {step.end:8.2f}s\t{step.actor}\t{step.name}")
+        print(tracing.format_summary())
+        if tracing.tracer().path is not None:
+            # Running with a trace (HARDWARE_TRACE), say where the cycle time went
+            tracing.tracer().flush()
+            print(critical_path.report(critical_path.runs(critical_path.load_spans(tracing.tracer().path))[-1]))
 
-    robot.disable()
-    robot.disconnect()
+        print("Done!")
+        print("Shutting down robot")
+        robot.gohome()
+    finally:
+        # Also when something failed: stop the gripper's I/O thread and power the arm down
+        gripper.shutdown()
+        robot.disable()
+        robot.disconnect()
     print("No steps for the scope to shut down!")
     print("Done!")
     print("ALL done! (exiting)")
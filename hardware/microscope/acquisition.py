@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+"""Pipelined image acquisition: the stage is already moving to the next field while the last frame is
+decoded, checked and handed to the writer.
+
+For every field we wait until the stage has settled (polling its position, see
+`PyuscopeHTTPClient.wait_until_settled`, instead of sleeping for a fixed time), take the frame without
+decoding it, immediately start the non-blocking move to the next field and only then decode, check and save
+the frame we just took. The stage travel hides the post-processing.
+
+Run with python3 acquisition.py to compare it with blocking moves on the fake scope.
+"""
+from __future__ import annotations
+
+import sys
+import time
+from pathlib import Path
+from typing import Callable, Optional
+
+import numpy as np
+
+if __name__ == "__main__":
+    # Run as a script from this folder: tracing and position_tracking live one folder up
+    sys.path.append(Path(__file__).resolve().parent.parent.as_posix())
+
+from web_example import PyuscopeHTTPClient, decode_array
+from image_writer import ImageWriter, unique_image_name
+
+class Frame:
+    def __init__(self, index: int, field: dict[str, float], image: np.ndarray):
+        self.index = index
+        self.field = field
+        self.image = image
+
+
+class AcquisitionReport:
+    def __init__(self):
+        self.n_frames = 0
+        self.elapsed = 0.0
+        # Time blocked waiting for the stage to settle, taking the frames and on post-processing (which overlaps
+        # with the stage moving to the next field)
+        self.settle_wait = 0.0
+        self.exposure = 0.0
+        self.processing = 0.0
+        # Frames that failed the quality check (not saved, the caller redoes them)
+        self.failed: list[Frame] = []
+
+    def __str__(self) -> str:
+        per_frame = self.elapsed / self.n_frames if self.n_frames else 0.0
+        return (f"{self.n_frames} frames in {self.elapsed:.2f}s ({per_frame * 1000:.0f}ms/frame): settle wait {self.settle_wait:.2f}s, "
+                f"exposure {self.exposure:.2f}s, processing {self.processing:.2f}s (while moving), {len(self.failed)} failed checks")
+
+
+def acquire(client: PyuscopeHTTPClient, fields: list[dict[str, float]], writer: Optional[ImageWriter] = None,
+            name: Callable[[int, dict[str, float]], str] = lambda i, field: unique_image_name("microscope_img", ".jpg"),
+            check: Optional[Callable[[np.ndarray, dict[str, float]], bool]] = None,
+            on_frame: Optional[Callable[[Frame], None]] = None, tolerance: Optional[float] = None,
+            on_saved: Optional[Callable[[Frame, str], None]] = None) -> AcquisitionReport:
+    """Image every field in order. Frames are saved through `writer` (one is made if neither it nor `on_frame`
+    is given) as `name(index, field)` and/or handed to `on_frame`. `check(image, field)` is a quality check,
+    frames that fail it are not saved but listed in the report so they can be redone. `on_saved(frame, filename)`
+    is called for every frame handed to the writer (e.g. to record it in a `catalog.Catalog`). `tolerance` is the
+    settle tolerance (mm), by default the client's `settle_tolerance`.
+    """
+    report = AcquisitionReport()
+    own_writer = writer is None and on_frame is None
+    if own_writer:
+        writer = ImageWriter()
+    t0 = time.perf_counter()
+    try:
+        if fields:
+            client.move_absolute(fields[0], block=False)
+        for i, field in enumerate(fields):
+            t = time.perf_counter()
+            client.wait_until_settled(field, tolerance)
+            report.settle_wait += time.perf_counter() - t
+
+            t = time.perf_counter()
+            data = client.image_encoded()
+            report.exposure += time.perf_counter() - t
+
+            # The exposure is done, the stage can go while we deal with the frame
+            if i + 1 < len(fields):
+                client.move_absolute(fields[i + 1], block=False)
+
+            t = time.perf_counter()
+            frame = Frame(i, field, decode_array(data))
+            if check is not None and not check(frame.image, field):
+                report.failed.append(frame)
+            else:
+                if writer is not None:
+                    filename = name(i, field)
+                    writer.save(frame.image, filename)
+                    if on_saved is not None:
+                        on_saved(frame, filename)
+                if on_frame is not None:
+                    on_frame(frame)
+            report.processing += time.perf_counter() - t
+            report.n_frames += 1
+    finally:
+        if own_writer:
+            writer.close()
+    report.elapsed = time.perf_counter() - t0
+    return report
+
+
+def acquire_blocking(client: PyuscopeHTTPClient, fields: list[dict[str, float]], writer: ImageWriter,
+                     name: Callable[[int, dict[str, float]], str], settle_time: float = 0.0) -> float:
+    """The old way (like `image_pos` used to do it), for comparison: sleep, blocking move, image, save."""
+    t0 = time.perf_counter()
+    for i, field in enumerate(fields):
+        time.sleep(settle_time)
+        client.move_absolute(field)
+        writer.save(client.image_array(), name(i, field))
+    return time.perf_counter() - t0
+
+
+def main():
+    import argparse
+    import tempfile
+    from pathlib import Path
+    from fake_pyuscope import FakeScope, serve_in_background
+    parser = argparse.ArgumentParser(description="Compare pipelined and blocking acquisition on the fake scope")
+    parser.add_argument("--fields", type=int, default=12)
+    parser.add_argument("--step", type=float, default=1.0, help="mm between fields")
+    parser.add_argument("--stage-speed", type=float, default=20.0)
+    parser.add_argument("--exposure-time", type=float, default=0.05)
+    parser.add_argument("--settle-time", type=float, default=0.05, help="Stage settle time (the fake stage's)")
+    parser.add_argument("--sleep", type=float, default=1.0, help="The fixed sleep between fields of the blocking loop")
+    args = parser.parse_args()
+    scope = FakeScope(width=1280, height=960, stage_speed=args.stage_speed, settle_time=args.settle_time, exposure_time=args.exposure_time)
+    server = serve_in_background(scope=scope)
+    fields = [{"x": i * args.step, "y": 0.0, "z": 0.0} for i in range(args.fields)]
+    with PyuscopeHTTPClient(host="127.0.0.1", port=server.server_port) as client, tempfile.TemporaryDirectory() as tmp:
+        with ImageWriter() as writer:
+            client.move_absolute({"x": 0.0, "y": 0.0, "z": 0.0})
+            blocking = acquire_blocking(client, fields, writer, lambda i, field: (Path(tmp) / f"blocking_{i:03d}.jpg").as_posix(), args.sleep)
+        with ImageWriter() as writer:
+            client.move_absolute({"x": 0.0, "y": 0.0, "z": 0.0})
+            report = acquire(client, fields, writer, name=lambda i, field: (Path(tmp) / f"pipelined_{i:03d}.jpg").as_posix())
+    print(f"blocking (with {args.sleep}s sleeps): {blocking:.2f}s ({blocking / args.fields * 1000:.0f}ms/frame)")
+    print(f"pipelined: {report}")
+
+if __name__ == "__main__":
+    main()
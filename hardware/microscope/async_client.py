@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+from __future__ import annotations
+
+import asyncio
+import sys
+from pathlib import Path
+from typing import Optional
+
+import aiohttp
+
+if __name__ == "__main__":
+    # Run as a script from this folder: tracing and position_tracking live one folder up
+    sys.path.append(Path(__file__).resolve().parent.parent.as_posix())
+
+from web_example import (
+    DEFAULT_BACKOFF,
+    DEFAULT_RETRIES,
+    DEFAULT_TIMEOUT,
+    ENDPOINT_TIMEOUTS,
+    RETRY_STATUSES,
+    decode_image,
+    image_query,
+    move_query,
+    parse_position,
+    resolve_address,
+)
+# NOTE web_example put the hardware folder (where tracing lives) on the path
+import tracing
+
+class AsyncPyuscopeHTTPClient:
+    """The asyncio version of `PyuscopeHTTPClient`: the same calls, but as coroutines over one pooled keep-alive
+    connection so several of them can be in flight at once. For example poll the position and fetch the last
+    frame while a non-blocking (`block=False`) move is still running:
+
+        async with AsyncPyuscopeHTTPClient() as client:
+            await client.move_absolute(pos, block=False)
+            pos, im = await asyncio.gather(client.get_position(), client.image())
+
+    Must be created (or entered) inside a running event loop.
+    """
+    def __init__(self, host: Optional[str]=None, port: Optional[int]=None, debug: bool = False, timeouts: Optional[dict[str, float]] = None, max_connections: int = 4, retries: int = DEFAULT_RETRIES, backoff: float = DEFAULT_BACKOFF):
+        self.host, self.port = resolve_address(host, port)
+        self.base_url = f"http://{self.host}:{self.port}"
+        self.debug = debug
+        self.timeouts = dict(ENDPOINT_TIMEOUTS)
+        if timeouts is not None:
+            self.timeouts.update(timeouts)
+        self.retries = retries
+        self.backoff = backoff
+        self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=max_connections))
+
+    async def close(self):
+        await self.session.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def request(self, page: str, query_args: dict[str, str]={}):
+        timeout = aiohttp.ClientTimeout(total=self.timeouts.get(page, DEFAULT_TIMEOUT))
+        # Same retry policy as the sync client: only retry if the request never reached the scope
+        # (or it told us it is temporarily unavailable), never after a possible partial send
+        with tracing.span("http." + page, "scope", **query_args):
+            for attempt in range(self.retries + 1):
+                if attempt > 0:
+                    await asyncio.sleep(self.backoff * 2 ** (attempt - 1))
+                try:
+                    async with self.session.get(self.base_url + page, params=query_args, timeout=timeout) as response:
+                        if response.status in RETRY_STATUSES and attempt < self.retries:
+                            continue
+                        response.raise_for_status()
+                        return await response.json()
+                except aiohttp.ClientConnectorError:
+                    if attempt >= self.retries:
+                        raise
+
+    async def get_position(self):
+        if self.debug:
+            print("DEBUG: GETTING POSITION")
+        return parse_position(await self.request("/get/position"))
+
+    async def move_absolute(self, pos: dict[str, float], block=True):
+        qargs = move_query(pos, block)
+        if self.debug:
+            print(f"DEBUG: MOVE ABSOLUTE WITH {qargs}")
+        await self.request("/run/move_absolute", qargs)
+
+    async def move_relative(self, pos: dict[str, float], block: bool=True):
+        qargs = move_query(pos, block)
+        if self.debug:
+            print(f"DEBUG: MOVE RELATIVE WITH {qargs}")
+        await self.request("/run/move_relative", qargs)
+
+    async def image(self, wait_imaging_ok: bool=True, raw: bool=False):
+        if self.debug:
+            print("DEBUG: IMAGE")
+        return decode_image(await self.request("/get/image", image_query(wait_imaging_ok, raw)))
+
+
+async def _demo(host: Optional[str], port: Optional[int]):
+    async with AsyncPyuscopeHTTPClient(host=host, port=port) as client:
+        pos = await client.get_position()
+        print(f"Initial position: {pos}")
+        # Start moving without waiting for it and grab the position and a frame in the meantime
+        await client.move_relative({"x": 2}, block=False)
+        pos, im = await asyncio.gather(client.get_position(), client.image())
+        print(f"Position while moving: {pos}, got image w/ size {im.size}, mode: {im.mode}")
+        await client.move_relative({"x": -2})
+        print(f"Final position: {await client.get_position()}")
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="Make some example moves with the async scope client")
+    parser.add_argument("--host", default=None)
+    parser.add_argument('--port', default=None)
+    parser.add_argument('--fake', action='store_true', help="Run against a local fake pyuscope server")
+    args = parser.parse_args()
+    host, port = args.host, args.port
+    if args.fake:
+        from fake_pyuscope import serve_in_background
+        server = serve_in_background()
+        host, port = "127.0.0.1", server.server_port
+    asyncio.run(_demo(host, port))
+
+if __name__ == "__main__":
+    main()
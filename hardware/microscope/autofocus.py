@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+"""Autofocus: find the z where the scope image is sharpest.
+
+A coarse scan over a z window finds the peak of the focus curve, then a golden-section search narrows it down
+inside the bracket around the best coarse point. Every step is scored by a sharpness metric (variance of the
+Laplacian or the Brenner gradient) computed with array slicing on a downsampled crop of the middle of the
+frame, so scoring a frame costs far less than acquiring it.
+
+Run with python3 autofocus.py [--host ...] [--port ...] [--span 0.2] or --fake to try it on the fake server.
+"""
+from __future__ import annotations
+
+import math
+import sys
+import time
+from pathlib import Path
+from typing import Callable, Optional
+
+import numpy as np
+
+if __name__ == "__main__":
+    # Run as a script from this folder: tracing and position_tracking live one folder up
+    sys.path.append(Path(__file__).resolve().parent.parent.as_posix())
+
+from web_example import PyuscopeHTTPClient
+
+# 1 / golden ratio
+_INV_PHI = (math.sqrt(5) - 1) / 2
+
+def focus_roi(image: np.ndarray, roi: float = 0.5, downsample: int = 4) -> np.ndarray:
+    """The middle `roi` fraction (per axis) of `image` as a float32 gray-scale array, block averaged by
+    `downsample` (averaging instead of striding keeps the noise down and the metric stable).
+    """
+    h, w = image.shape[:2]
+    ch, cw = max(1, int(h * roi)), max(1, int(w * roi))
+    top, left = (h - ch) // 2, (w - cw) // 2
+    # Round the crop down to whole blocks
+    ch, cw = max(downsample, ch - ch % downsample), max(downsample, cw - cw % downsample)
+    crop = image[top:top + ch, left:left + cw]
+    if crop.ndim == 3:
+        # RGB frames from image_array have a padding byte per pixel, only use the colour channels
+        crop = crop[..., :3].mean(axis=2, dtype=np.float32)
+    else:
+        crop = crop.astype(np.float32)
+    if downsample > 1:
+        crop = crop.reshape(ch // downsample, downsample, cw // downsample, downsample).mean(axis=(1, 3))
+    return crop
+
+def variance_of_laplacian(img: np.ndarray) -> float:
+    """Variance of the 4-neighbour Laplacian. Good all-round metric, a bit sensitive to noise."""
+    lap = img[1:-1, :-2] + img[1:-1, 2:] + img[:-2, 1:-1] + img[2:, 1:-1] - 4 * img[1:-1, 1:-1]
+    return float(lap.var())
+
+def brenner(img: np.ndarray) -> float:
+    """Brenner gradient: mean squared difference between pixels two apart (both directions)."""
+    dx = img[:, 2:] - img[:, :-2]
+    dy = img[2:, :] - img[:-2, :]
+    return float((dx * dx).mean() + (dy * dy).mean())
+
+METRICS: dict[str, Callable[[np.ndarray], float]] = {
+    "laplacian": variance_of_laplacian,
+    "brenner": brenner,
+}
+
+
+class FocusResult:
+    def __init__(self, z: float, score: float, n_images: int, elapsed: float, samples: list[tuple[float, float]], at_edge: bool):
+        self.z = z
+        self.score = score
+        # Frames taken (and stage moves made) to find the focus
+        self.n_images = n_images
+        self.elapsed = elapsed
+        # (z, score) for every frame in the order they were taken
+        self.samples = samples
+        # The best z was at the edge of the search window so the real focus may be outside it
+        self.at_edge = at_edge
+
+    def __str__(self) -> str:
+        s = f"focus at z={self.z:.4f} (score {self.score:.4g}) from {self.n_images} images in {self.elapsed:.2f}s"
+        if self.at_edge:
+            s += " (at the edge of the search window!)"
+        return s
+
+
+class Autofocus:
+    """Focuses `client` by moving z only. Frames are fetched with `image_array` (raw=False, so they are decoded
+    once into an array) and scored with `metric` (a name in METRICS or a function of a float32 gray array).
+    """
+    def __init__(self, client: PyuscopeHTTPClient, metric="laplacian", roi: float = 0.5, downsample: int = 4):
+        self.client = client
+        self.metric = METRICS[metric] if isinstance(metric, str) else metric
+        self.roi = roi
+        self.downsample = downsample
+        self._scores: dict[float, float] = {}
+        self._samples: list[tuple[float, float]] = []
+
+    def score(self, image: np.ndarray) -> float:
+        return self.metric(focus_roi(image, self.roi, self.downsample))
+
+    def score_at(self, z: float) -> float:
+        # Rounded so that the golden-section search reuses frames that it already took
+        z = round(z, 6)
+        if z not in self._scores:
+            self.client.move_absolute({"z": z})
+            self._scores[z] = self.score(self.client.image_array())
+            self._samples.append((z, self._scores[z]))
+        return self._scores[z]
+
+    def focus(self, z_center: Optional[float] = None, span: float = 0.2, coarse_steps: int = 7, tolerance: float = 0.002,
+              max_shifts: int = 2, move_to_focus: bool = True) -> FocusResult:
+        """Search z_center +- span (mm, z_center defaults to the current z) for the sharpest z, to within
+        `tolerance` mm. If the coarse scan peaks at the edge of the window, the window is moved over (at most
+        `max_shifts` times). Ends at the best z found unless `move_to_focus` is False.
+        """
+        t0 = time.monotonic()
+        self._scores = {}
+        self._samples = []
+        if z_center is None:
+            z_center = self.client.get_position()["z"]
+        step = 2 * span / (coarse_steps - 1)
+
+        # Coarse: scan the window, shift it if the peak is on the edge
+        for shift in range(max_shifts + 1):
+            zs = [z_center - span + i * step for i in range(coarse_steps)]
+            scores = [self.score_at(z) for z in zs]
+            best = int(np.argmax(scores))
+            at_edge = best in (0, coarse_steps - 1)
+            if not at_edge or shift == max_shifts:
+                break
+            z_center = zs[best]
+
+        # Fine: golden-section search between the neighbours of the best coarse point
+        a, b = zs[max(best - 1, 0)], zs[min(best + 1, coarse_steps - 1)]
+        c, d = b - _INV_PHI * (b - a), a + _INV_PHI * (b - a)
+        fc, fd = self.score_at(c), self.score_at(d)
+        while b - a > tolerance:
+            if fc >= fd:
+                b, d, fd = d, c, fc
+                c = b - _INV_PHI * (b - a)
+                fc = self.score_at(c)
+            else:
+                a, c, fc = c, d, fd
+                d = a + _INV_PHI * (b - a)
+                fd = self.score_at(d)
+
+        z, score = max(self._scores.items(), key=lambda kv: kv[1])
+        if move_to_focus:
+            self.client.move_absolute({"z": z})
+        return FocusResult(z, score, len(self._samples), time.monotonic() - t0, list(self._samples), at_edge)
+
+
+def autofocus(client: PyuscopeHTTPClient, z_center: Optional[float] = None, span: float = 0.2, metric="laplacian", **kwargs) -> FocusResult:
+    return Autofocus(client, metric).focus(z_center, span, **kwargs)
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="Autofocus the scope around its current z")
+    parser.add_argument("--host", default=None)
+    parser.add_argument('--port', default=None)
+    parser.add_argument('--fake', action='store_true', help="Run against a local fake pyuscope server (in focus at z=0.037)")
+    parser.add_argument("--span", type=float, default=0.2, help="Search z +- this many mm")
+    parser.add_argument("--tolerance", type=float, default=0.002, help="mm")
+    parser.add_argument("--metric", choices=sorted(METRICS), default="laplacian")
+    args = parser.parse_args()
+    host, port = args.host, args.port
+    if args.fake:
+        from fake_pyuscope import FakeScope, serve_in_background
+        server = serve_in_background(scope=FakeScope(focus_z=0.037))
+        host, port = "127.0.0.1", server.server_port
+    with PyuscopeHTTPClient(host=host, port=port) as client:
+        result = autofocus(client, span=args.span, metric=args.metric, tolerance=args.tolerance)
+        print(result)
+
+if __name__ == "__main__":
+    main()
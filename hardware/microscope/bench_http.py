@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+"""Micro-benchmark of the per-call latency of the scope HTTP client against the local fake pyuscope server.
+
+"before" is what `PyuscopeHTTPClient.request` used to do (a fresh `requests.get` with a hand-built query string,
+so a new TCP connection per call), "after" is the pooled keep-alive session it uses now.
+
+Run with python3 bench_http.py [--calls 500]
+"""
+from __future__ import annotations
+
+import statistics
+import sys
+import time
+from pathlib import Path
+
+import requests
+
+if __name__ == "__main__":
+    # Run as a script from this folder: tracing and position_tracking live one folder up
+    sys.path.append(Path(__file__).resolve().parent.parent.as_posix())
+
+from fake_pyuscope import serve_in_background
+from web_example import PyuscopeHTTPClient
+
+def _old_request(base_url: str, page: str, query_args: dict[str, str]={}):
+    query_str = ""
+    if len(query_args):
+        query_str = "?" + "&".join(f"{k}={v}" for k, v in query_args.items())
+    response = requests.get(base_url + page + query_str)
+    response.raise_for_status()
+    return response.json()
+
+def _time_calls(fn, calls: int) -> list[float]:
+    latencies = []
+    for _ in range(calls):
+        t0 = time.perf_counter()
+        fn()
+        latencies.append(time.perf_counter() - t0)
+    return latencies
+
+def _report(name: str, latencies: list[float]):
+    latencies = sorted(latencies)
+    p = lambda q: latencies[min(len(latencies) - 1, int(q * len(latencies)))] * 1e3
+    print(f"{name:>8}: mean {statistics.mean(latencies) * 1e3:7.3f}ms  p50 {p(0.5):7.3f}ms  p95 {p(0.95):7.3f}ms  p99 {p(0.99):7.3f}ms")
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="Benchmark scope client per-call latency")
+    parser.add_argument("--calls", type=int, default=500)
+    args = parser.parse_args()
+
+    server = serve_in_background()
+    client = PyuscopeHTTPClient(host="127.0.0.1", port=server.server_port)
+    move = {"block": 1, "axis.x": 1.5, "axis.y": 2.5}
+    try:
+        for page, qargs in [("/get/position", {}), ("/run/move_absolute", move)]:
+            print(f"{page} x {args.calls}")
+            # Warm up both paths first so we do not measure imports / the first connect
+            _old_request(client.base_url, page, qargs)
+            client.request(page, qargs)
+            _report("before", _time_calls(lambda: _old_request(client.base_url, page, qargs), args.calls))
+            _report("after", _time_calls(lambda: client.request(page, qargs), args.calls))
+    finally:
+        client.close()
+        server.shutdown()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""Benchmark of image acquisition throughput and memory per frame against the local fake pyuscope server.
+
+Compares `PyuscopeHTTPClient.image` (+ converting the PIL image to a NumPy array) with `image_array`, and
+`image_array(raw=True)`. Each mode runs in its own process so the peak RSS numbers do not pollute each other.
+
+Run with python3 bench_image.py [--frames 30] [--width 2592] [--height 1944]
+"""
+from __future__ import annotations
+
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+import numpy as np
+
+if __name__ == "__main__":
+    # Run as a script from this folder: tracing and position_tracking live one folder up
+    sys.path.append(Path(__file__).resolve().parent.parent.as_posix())
+
+from fake_pyuscope import FakeScope, serve_in_background
+from web_example import PyuscopeHTTPClient
+
+MODES = ["image", "image_array", "image_array_raw"]
+
+def _grab(client: PyuscopeHTTPClient, mode: str) -> np.ndarray:
+    if mode == "image":
+        return np.asarray(client.image())
+    elif mode == "image_array":
+        return client.image_array()
+    elif mode == "image_array_raw":
+        return client.image_array(raw=True)
+    raise ValueError(f"Unknown mode {mode}")
+
+def run_mode(mode: str, frames: int, width: int, height: int):
+    server = serve_in_background(scope=FakeScope(width, height))
+    client = PyuscopeHTTPClient(host="127.0.0.1", port=server.server_port)
+    # The first frames are slow because the fake server has to encode them, so warm it up
+    for _ in range(16):
+        client.image_array(raw=True)
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    tracemalloc.start()
+    peaks = []
+    t0 = time.perf_counter()
+    for _ in range(frames):
+        tracemalloc.reset_peak()
+        arr = _grab(client, mode)
+        peaks.append(tracemalloc.get_traced_memory()[1])
+        del arr
+    elapsed = time.perf_counter() - t0
+    tracemalloc.stop()
+
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    client.close()
+    server.shutdown()
+    # ru_maxrss is in KiB on linux
+    print(f"{mode:>16}: {frames / elapsed:7.1f} frames/s  {1e3 * elapsed / frames:7.2f}ms/frame  "
+          f"python peak/frame {max(peaks) / 2 ** 20:7.2f}MiB  peak RSS growth {(rss_after - rss_before) / 1024:7.2f}MiB")
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="Benchmark scope image acquisition")
+    parser.add_argument("--frames", type=int, default=30)
+    parser.add_argument("--width", type=int, default=2592)
+    parser.add_argument("--height", type=int, default=1944)
+    parser.add_argument("--mode", choices=MODES, default=None, help="Only run this mode (in this process)")
+    args = parser.parse_args()
+    if args.mode is not None:
+        run_mode(args.mode, args.frames, args.width, args.height)
+        return
+    print(f"{args.frames} frames of {args.width}x{args.height}")
+    for mode in MODES:
+        subprocess.run([sys.executable, __file__, "--mode", mode, "--frames", str(args.frames),
+                        "--width", str(args.width), "--height", str(args.height)], check=True)
+
+if __name__ == "__main__":
+    main()
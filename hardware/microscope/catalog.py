@@ -0,0 +1,315 @@
+#!/usr/bin/env python3
+"""A local SQLite catalog of every captured image, so finding "all images of slide 14" is a query instead of a
+directory walk.
+
+Every capture is a row with its file path, run id, slide id, shelf slot, stage x/y/z, when it was taken, the
+exposure settings it was taken with (JSON), its focus score and its size. There are indexes on run, slide and
+slot, and an R-tree on the stage footprint of every image (its x/y, widened by the field of view if given), so
+"what did we image in this part of the stage" is a range query too. Triggers keep the R-tree in step with the
+captures, so plain `executemany` inserts work.
+
+Recording is cheap enough for the acquisition loop: `record` only queues the row, rows are written in one
+transaction every `batch_size` captures (and before every query, and on `flush`/`close`). The database is in
+WAL mode so several processes (one per scope, see cell.py) can record into the same file and it can be read
+while they do.
+
+`export` writes the captures the online service does not have yet as JSON lines and marks them exported.
+
+Run with python3 catalog.py catalog.db [--slide slide-14 | --run RUN | --box X0 Y0 X1 Y1] to query a catalog,
+or python3 catalog.py --demo to time it on fake captures.
+"""
+from __future__ import annotations
+
+import json
+import sqlite3
+import threading
+import time
+import uuid
+from datetime import datetime
+from pathlib import Path
+from typing import Optional, Union
+
+DEFAULT_CATALOG_FILE = "catalog.db"
+DEFAULT_BATCH_SIZE = 64
+# Seconds to wait for another process's write to finish
+DEFAULT_BUSY_TIMEOUT = 30.0
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS captures (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE,
+    run_id TEXT,
+    slide_id TEXT,
+    slot TEXT,
+    x REAL NOT NULL,
+    y REAL NOT NULL,
+    z REAL,
+    fov_w REAL NOT NULL DEFAULT 0,
+    fov_h REAL NOT NULL DEFAULT 0,
+    captured REAL NOT NULL,
+    exposure TEXT,
+    focus_score REAL,
+    width INTEGER,
+    height INTEGER,
+    exported REAL
+);
+CREATE INDEX IF NOT EXISTS captures_run ON captures (run_id, captured);
+CREATE INDEX IF NOT EXISTS captures_slide ON captures (slide_id, captured);
+CREATE INDEX IF NOT EXISTS captures_slot ON captures (slot, captured);
+CREATE INDEX IF NOT EXISTS captures_unexported ON captures (id) WHERE exported IS NULL;
+CREATE VIRTUAL TABLE IF NOT EXISTS captures_area USING rtree (id, min_x, max_x, min_y, max_y);
+CREATE TRIGGER IF NOT EXISTS captures_area_insert AFTER INSERT ON captures BEGIN
+    INSERT INTO captures_area VALUES (new.id, new.x - new.fov_w / 2, new.x + new.fov_w / 2, new.y - new.fov_h / 2, new.y + new.fov_h / 2);
+END;
+CREATE TRIGGER IF NOT EXISTS captures_area_update AFTER UPDATE OF x, y, fov_w, fov_h ON captures BEGIN
+    UPDATE captures_area SET min_x = new.x - new.fov_w / 2, max_x = new.x + new.fov_w / 2,
+                             min_y = new.y - new.fov_h / 2, max_y = new.y + new.fov_h / 2 WHERE id = new.id;
+END;
+CREATE TRIGGER IF NOT EXISTS captures_area_delete AFTER DELETE ON captures BEGIN
+    DELETE FROM captures_area WHERE id = old.id;
+END;
+"""
+
+_COLUMNS = ("path", "run_id", "slide_id", "slot", "x", "y", "z", "fov_w", "fov_h", "captured", "exposure", "focus_score", "width", "height")
+
+def new_run_id() -> str:
+    """A run id that sorts by time, e.g. 2024-02-25_14-03-12_1a2b3c."""
+    return f"{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}_{uuid.uuid4().hex[:6]}"
+
+
+class Capture:
+    def __init__(self, id: int, path: str, run_id: Optional[str], slide_id: Optional[str], slot: Optional[str], x: float, y: float,
+                 z: Optional[float], fov_w: float, fov_h: float, captured: float, exposure: Optional[str], focus_score: Optional[float],
+                 width: Optional[int], height: Optional[int], exported: Optional[float]):
+        self.id = id
+        self.path = path
+        self.run_id = run_id
+        self.slide_id = slide_id
+        self.slot = slot
+        self.x, self.y, self.z = x, y, z
+        self.fov_w, self.fov_h = fov_w, fov_h
+        self.captured = captured
+        self.exposure = json.loads(exposure) if exposure else None
+        self.focus_score = focus_score
+        self.width, self.height = width, height
+        self.exported = exported
+
+    def to_dict(self) -> dict:
+        return {"id": self.id, "path": self.path, "run_id": self.run_id, "slide_id": self.slide_id, "slot": self.slot,
+                "x": self.x, "y": self.y, "z": self.z, "fov_w": self.fov_w, "fov_h": self.fov_h, "captured": self.captured,
+                "exposure": self.exposure, "focus_score": self.focus_score, "width": self.width, "height": self.height}
+
+    def __repr__(self) -> str:
+        return f"Capture({self.path!r}, slide={self.slide_id!r}, x={self.x:.3f}, y={self.y:.3f})"
+
+
+class Catalog:
+    """The capture catalog in the SQLite file at `path`, see the module docstring. `fov` is the (width, height)
+    in mm of the stage area one image covers, used for captures recorded without their own.
+    """
+    def __init__(self, path: Union[str, Path] = DEFAULT_CATALOG_FILE, fov: tuple[float, float] = (0.0, 0.0),
+                 batch_size: int = DEFAULT_BATCH_SIZE, busy_timeout: float = DEFAULT_BUSY_TIMEOUT):
+        self.path = Path(path)
+        self.fov = fov
+        self.batch_size = batch_size
+        # Recording happens from the acquisition loop and the image writer threads
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(self.path, timeout=busy_timeout, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        # In WAL mode this can only lose the last transactions on a power cut, never corrupt the file
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        with self.db:
+            self.db.executescript(_SCHEMA)
+        self._pending: list[tuple] = []
+
+    def record(self, path: Union[str, Path], field: dict[str, float], run_id: Optional[str] = None, slide_id: Optional[str] = None,
+               slot: Optional[str] = None, exposure: Optional[dict] = None, focus_score: Optional[float] = None,
+               shape: Optional[tuple[int, ...]] = None, captured: Optional[float] = None, fov: Optional[tuple[float, float]] = None):
+        """Queue a capture of `path` (stored absolute) at stage position `field`. `shape` is the image's
+        (height, width, ...).
+        """
+        fov_w, fov_h = self.fov if fov is None else fov
+        height, width = (shape[0], shape[1]) if shape is not None else (None, None)
+        row = (Path(path).resolve().as_posix(), run_id, slide_id, slot, field["x"], field["y"], field.get("z"), fov_w, fov_h,
+               time.time() if captured is None else captured, json.dumps(exposure) if exposure is not None else None,
+               None if focus_score is None else float(focus_score), width, height)
+        with self.lock:
+            self._pending.append(row)
+            if len(self._pending) >= self.batch_size:
+                self._flush()
+
+    def _flush(self):
+        if not self._pending:
+            return
+        updates = ", ".join(f"{c} = excluded.{c}" for c in _COLUMNS[1:])
+        with self.db:
+            self.db.executemany(f"INSERT INTO captures ({', '.join(_COLUMNS)}) VALUES ({', '.join('?' * len(_COLUMNS))}) "
+                                f"ON CONFLICT (path) DO UPDATE SET {updates}, exported = NULL", self._pending)
+        self._pending = []
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def _query(self, where: str = "", args: tuple = (), order: str = "c.captured", limit: Optional[int] = None, join: str = "") -> list[Capture]:
+        sql = f"SELECT c.* FROM captures c {join} {'WHERE ' + where if where else ''} ORDER BY {order}"
+        if limit is not None:
+            sql += f" LIMIT {int(limit)}"
+        with self.lock:
+            self._flush()
+            return [Capture(*row) for row in self.db.execute(sql, args)]
+
+    def by_run(self, run_id: str) -> list[Capture]:
+        return self._query("c.run_id = ?", (run_id,))
+
+    def by_slide(self, slide_id: str, run_id: Optional[str] = None) -> list[Capture]:
+        """Captures of a slide. Slide ids are whatever the run recorded: the real ids when it was given them
+        (`main.SLIDE_IDS`, the names passed to `Cell.run`), otherwise none. An id that only numbers the slides
+        of one run is only unique within that run, pass `run_id` for those.
+        """
+        if run_id is None:
+            return self._query("c.slide_id = ?", (slide_id,))
+        return self._query("c.slide_id = ? AND c.run_id = ?", (slide_id, run_id))
+
+    def by_slot(self, slot: str) -> list[Capture]:
+        return self._query("c.slot = ?", (slot,))
+
+    def in_box(self, min_x: float, min_y: float, max_x: float, max_y: float, run_id: Optional[str] = None,
+               slide_id: Optional[str] = None) -> list[Capture]:
+        """Captures whose footprint overlaps the stage box, optionally only those of a run and/or slide."""
+        where = ["a.min_x <= ? AND a.max_x >= ? AND a.min_y <= ? AND a.max_y >= ?"]
+        args = [max_x, min_x, max_y, min_y]
+        for column, value in (("run_id", run_id), ("slide_id", slide_id)):
+            if value is not None:
+                where.append(f"c.{column} = ?")
+                args.append(value)
+        return self._query(" AND ".join(where), tuple(args), join="JOIN captures_area a ON a.id = c.id")
+
+    def runs(self) -> list[tuple[str, int, float, float]]:
+        """(run id, captures, first, last capture time) of every run, oldest first."""
+        with self.lock:
+            self._flush()
+            return list(self.db.execute("SELECT run_id, COUNT(*), MIN(captured), MAX(captured) FROM captures "
+                                        "WHERE run_id IS NOT NULL GROUP BY run_id ORDER BY MIN(captured)"))
+
+    def unexported(self, limit: Optional[int] = None) -> list[Capture]:
+        return self._query("c.exported IS NULL", order="c.id", limit=limit)
+
+    def mark_exported(self, ids: list[int]):
+        with self.lock:
+            with self.db:
+                self.db.executemany("UPDATE captures SET exported = ? WHERE id = ?", [(time.time(), i) for i in ids])
+
+    def export(self, path: Union[str, Path], batch: int = 10000) -> int:
+        """Append every capture not exported yet to `path` as JSON lines (for the online service) and mark them
+        exported. Returns how many were written.
+        """
+        n = 0
+        with open(path, "a") as f:
+            while True:
+                captures = self.unexported(limit=batch)
+                if not captures:
+                    break
+                f.writelines(json.dumps(c.to_dict()) + "\n" for c in captures)
+                f.flush()
+                # Only once they are written, a crash in between exports them again instead of never
+                self.mark_exported([c.id for c in captures])
+                n += len(captures)
+        return n
+
+    def __len__(self) -> int:
+        with self.lock:
+            self._flush()
+            return self.db.execute("SELECT COUNT(*) FROM captures").fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            self._flush()
+        self.db.close()
+
+    def __enter__(self) -> "Catalog":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _demo(n_slides: int, fields_per_slide: int):
+    """Time recording and querying fake captures, against walking the folder for the same answer."""
+    import os
+    import random
+    import tempfile
+    rng = random.Random(0)
+    with tempfile.TemporaryDirectory() as tmp:
+        root = Path(tmp, "images")
+        with Catalog(Path(tmp, "catalog.db"), fov=(0.64, 0.48)) as catalog:
+            run_id = new_run_id()
+            t0 = time.perf_counter()
+            for s in range(n_slides):
+                slide_dir = root / f"slide-{s}"
+                slide_dir.mkdir(parents=True)
+                for i in range(fields_per_slide):
+                    path = slide_dir / f"microscope_img_{i:05d}.jpg"
+                    path.touch()
+                    field = {"x": 30.0 * (s % 4) + 0.5 * (i % 40), "y": 75.0 * (s // 4) + 0.4 * (i // 40), "z": rng.uniform(-23, -22)}
+                    catalog.record(path, field, run_id, f"slide-{s}", f"shelf/{s}", {"exposure_ms": 30}, rng.uniform(50, 150), (960, 1280))
+            catalog.flush()
+            n = n_slides * fields_per_slide
+            elapsed = time.perf_counter() - t0
+            print(f"recorded {n} captures in {elapsed:.2f}s ({elapsed / n * 1e6:.0f}us each, including creating the files)")
+            for label, query in (("slide-14", lambda: catalog.by_slide("slide-14")), ("run", lambda: catalog.by_run(run_id)),
+                                 ("box 5x3mm", lambda: catalog.in_box(10.0, 0.0, 15.0, 3.0)),
+                                 ("box 5x3mm without the R-tree", lambda: catalog._query(
+                                     "c.x - c.fov_w / 2 <= ? AND c.x + c.fov_w / 2 >= ? AND c.y - c.fov_h / 2 <= ? AND c.y + c.fov_h / 2 >= ?",
+                                     (15.0, 10.0, 3.0, 0.0)))):
+                # Best of 3, the first one also pays for reading the pages in
+                timings = []
+                for _ in range(3):
+                    t0 = time.perf_counter()
+                    result = query()
+                    timings.append(time.perf_counter() - t0)
+                print(f"{label}: {len(result)} captures in {min(timings) * 1000:.2f}ms")
+            t0 = time.perf_counter()
+            walk = [os.path.join(d, f) for d, _, files in os.walk(root) for f in files]
+            print(f"walking the folder: {len(walk)} files in {(time.perf_counter() - t0) * 1000:.2f}ms (and that is without knowing "
+                  f"which slide or position they are, which needs the EXIF of every file)")
+            t0 = time.perf_counter()
+            exported = catalog.export(Path(tmp, "export.jsonl"))
+            print(f"exported {exported} captures in {(time.perf_counter() - t0) * 1000:.0f}ms, {len(catalog.unexported())} left to export")
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="Query the capture catalog")
+    parser.add_argument("catalog", nargs="?", default=DEFAULT_CATALOG_FILE)
+    parser.add_argument("--slide", default=None)
+    parser.add_argument("--run", default=None)
+    parser.add_argument("--box", type=float, nargs=4, default=None, metavar=("X0", "Y0", "X1", "Y1"))
+    parser.add_argument("--export", default=None, help="Append the captures not exported yet to this JSON lines file")
+    parser.add_argument("--demo", action="store_true", help="Time it on fake captures")
+    parser.add_argument("--demo-slides", type=int, default=40)
+    parser.add_argument("--demo-fields", type=int, default=500)
+    args = parser.parse_args()
+    if args.demo:
+        _demo(args.demo_slides, args.demo_fields)
+        return
+    with Catalog(args.catalog) as catalog:
+        if args.export is not None:
+            print(f"Exported {catalog.export(args.export)} captures to {args.export}")
+            return
+        if args.box is not None:
+            captures = catalog.in_box(*args.box, run_id=args.run, slide_id=args.slide)
+        elif args.slide is not None:
+            captures = catalog.by_slide(args.slide, args.run)
+        elif args.run is not None:
+            captures = catalog.by_run(args.run)
+        else:
+            for run_id, n, first, last in catalog.runs():
+                print(f"{run_id}: {n} captures, {datetime.fromtimestamp(first)} - {datetime.fromtimestamp(last)}")
+            return
+        for c in captures:
+            print(f"{c.path}\tslide={c.slide_id}\tslot={c.slot}\tx={c.x:.3f} y={c.y:.3f} z={c.z}\tfocus={c.focus_score}")
+        print(f"{len(captures)} captures")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+"""A local stand-in for the pyuscope web server so the client can be exercised (and benchmarked) without a scope.
+
+It only implements the endpoints `PyuscopeHTTPClient` uses: `/get/position`, `/run/move_absolute`,
+`/run/move_relative` and `/get/image`. Images are a synthetic gray-scale PNG. By default moves and images are
+instant; give `FakeScope` a `stage_speed` / `exposure_time` to model how long they take on the real scope
+(`time_scale` makes the simulated world run faster than real time, 0.01 = 100x).
+"""
+from __future__ import annotations
+
+import base64
+import json
+import math
+import struct
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+from urllib.parse import urlparse, parse_qs
+
+DEFAULT_FAKE_PORT = 8401
+
+def encode_gray_png(width: int, height: int, rows) -> bytes:
+    """Encode 8 bit gray-scale `rows` (an iterable of `width` bytes each) as a PNG using only the standard library."""
+    # Each row starts with filter type 0 (None)
+    raw = b"".join(b"\x00" + bytes(row) for row in rows)
+
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xFFFFFFFF)
+
+    header = struct.pack(">IIBBBBB", width, height, 8, 0, 0, 0, 0)
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header) + chunk(b"IDAT", zlib.compress(raw, 1)) + chunk(b"IEND", b"")
+
+def synthetic_png(width: int = 640, height: int = 480, seed: int = 0) -> bytes:
+    """A gray-scale gradient (shifted by `seed`) as a PNG."""
+    row_pattern = bytes((x + seed) & 0xFF for x in range(width))
+    return encode_gray_png(width, height, (row_pattern[y % width:] + row_pattern[:y % width] for y in range(height)))
+
+def defocused_png(width: int, height: int, blur: int) -> bytes:
+    """A random speckle texture (like cells on a slide) box-blurred by `blur` pixels, to fake being out of focus."""
+    import numpy as np
+    rng = np.random.default_rng(0)
+    img = rng.integers(0, 256, size=(height, width)).astype(np.float32)
+    if blur > 0:
+        k = 2 * blur + 1
+        for axis in (0, 1):
+            # Separable box filter via cumulative sums (edges padded by repeating them)
+            padded = np.pad(img, [(blur, blur) if a == axis else (0, 0) for a in (0, 1)], mode="edge")
+            c = np.cumsum(padded, axis=axis, dtype=np.float64)
+            c = np.concatenate([np.zeros_like(c.take([0], axis=axis)), c], axis=axis)
+            img = ((c.take(range(k, c.shape[axis]), axis=axis) - c.take(range(0, c.shape[axis] - k), axis=axis)) / k).astype(np.float32)
+    return encode_gray_png(width, height, img.clip(0, 255).astype(np.uint8))
+
+
+class FakeScope:
+    """The state of the fake scope, shared by all request handler threads. Times are in simulated seconds."""
+    def __init__(self, width: int = 640, height: int = 480, time_scale: float = 1.0, stage_speed: Optional[float] = None,
+                 stage_accel: float = 100.0, settle_time: float = 0.0, exposure_time: float = 0.0,
+                 focus_z: Optional[float] = None, blur_per_mm: float = 100.0, focus_tilt: tuple[float, float] = (0.0, 0.0)):
+        self.lock = threading.Lock()
+        # Only one exposure at a time
+        self.camera_lock = threading.Lock()
+        self.position = {"x": 0.0, "y": 0.0, "z": 0.0}
+        self.width = width
+        self.height = height
+        self.n_images = 0
+        self._image_cache: dict[int, str] = {}
+
+        self.time_scale = time_scale
+        # mm/s and mm/s^2 of the (slowest) stage axis, None means moves are instant
+        self.stage_speed = stage_speed
+        self.stage_accel = stage_accel
+        self.settle_time = settle_time
+        self.exposure_time = exposure_time
+        # If set, images are a texture that is sharpest at this z and gets blurrier (by blur_per_mm pixels per mm)
+        # away from it, so that autofocus has something to find
+        self.focus_z = focus_z
+        self.blur_per_mm = blur_per_mm
+        # mm of focus z per mm of x and y, slides are never perfectly flat
+        self.focus_tilt = focus_tilt
+        # Where the current move started and when (real monotonic time) it will be done
+        self._move_from = dict(self.position)
+        self._move_start = 0.0
+        self._move_end = 0.0
+        # Simulated time spent moving / exposing, for benchmarks
+        self.move_time = 0.0
+        self.exposure_total = 0.0
+        self.n_moves = 0
+
+    def _duration(self, target: dict[str, float]) -> float:
+        if self.stage_speed is None:
+            return 0.0
+        # Axes move at the same time so the longest one decides
+        distance = max((abs(v - self.position.get(k, 0.0)) for k, v in target.items()), default=0.0)
+        if distance <= 0:
+            return 0.0
+        accel_distance = self.stage_speed ** 2 / self.stage_accel
+        if distance < accel_distance:
+            return 2 * math.sqrt(distance / self.stage_accel) + self.settle_time
+        return distance / self.stage_speed + self.stage_speed / self.stage_accel + self.settle_time
+
+    def current_position(self) -> dict[str, float]:
+        """Where the stage is right now, interpolated (linearly, good enough) while a move is running."""
+        with self.lock:
+            now = time.monotonic()
+            if now >= self._move_end or self._move_end <= self._move_start:
+                return dict(self.position)
+            frac = max(0.0, (now - self._move_start) / (self._move_end - self._move_start))
+            return {k: self._move_from.get(k, v) + frac * (v - self._move_from.get(k, v)) for k, v in self.position.items()}
+
+    def _start_move(self, target: dict[str, float]) -> float:
+        # Called with the lock held, returns when the move will be done
+        now = time.monotonic()
+        if now < self._move_end:
+            # NOTE a new move replaces the one in flight, we pretend it starts from where that one was headed
+            now = self._move_end
+        duration = self._duration(target)
+        self._move_from = dict(self.position)
+        self.position.update(target)
+        self._move_start = now
+        self._move_end = now + duration * self.time_scale
+        self.move_time += duration
+        self.n_moves += 1
+        return self._move_end
+
+    def wait_until_still(self):
+        delay = self._move_end - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    def move_absolute(self, axes: dict[str, float], block: bool = True):
+        with self.lock:
+            self._start_move(axes)
+        if block:
+            self.wait_until_still()
+
+    def move_relative(self, axes: dict[str, float], block: bool = True):
+        with self.lock:
+            self._start_move({k: self.position.get(k, 0.0) + v for k, v in axes.items()})
+        if block:
+            self.wait_until_still()
+
+    def expose(self, wait_imaging_ok: bool = True) -> str:
+        with self.camera_lock:
+            if wait_imaging_ok:
+                self.wait_until_still()
+            if self.exposure_time:
+                time.sleep(self.exposure_time * self.time_scale)
+                self.exposure_total += self.exposure_time
+            return self.image_base64()
+
+    def image_base64(self) -> str:
+        with self.lock:
+            self.n_images += 1
+            if self.focus_z is not None:
+                focus_z = self.focus_z + self.focus_tilt[0] * self.position.get("x", 0.0) + self.focus_tilt[1] * self.position.get("y", 0.0)
+                blur = int(round(abs(self.position.get("z", 0.0) - focus_z) * self.blur_per_mm))
+                key = -1 - blur
+                if key not in self._image_cache:
+                    self._image_cache[key] = base64.b64encode(defocused_png(self.width, self.height, blur)).decode()
+                return self._image_cache[key]
+            seed = self.n_images % 16
+            # Encoding is slow-ish in pure python so only ever do it once per distinct frame
+            if seed not in self._image_cache:
+                self._image_cache[seed] = base64.b64encode(synthetic_png(self.width, self.height, seed)).decode()
+            return self._image_cache[seed]
+
+
+class FakePyuscopeHandler(BaseHTTPRequestHandler):
+    # HTTP/1.1 so that clients can keep the connection alive like the real server allows
+    protocol_version = "HTTP/1.1"
+    # Send headers and body in one go, otherwise Nagle + delayed ACKs add ~40ms to every keep-alive call
+    wbufsize = -1
+    disable_nagle_algorithm = True
+    scope: FakeScope = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, data: dict, code: int = 200):
+        body = json.dumps({"data": data, "status": "ok"}).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        axes = {k[len("axis."):]: float(v) for k, v in query.items() if k.startswith("axis.")}
+        if url.path == "/get/position":
+            self._reply(self.scope.current_position())
+        elif url.path == "/run/move_absolute":
+            self.scope.move_absolute(axes, block=bool(int(query.get("block", 1))))
+            self._reply({})
+        elif url.path == "/run/move_relative":
+            self.scope.move_relative(axes, block=bool(int(query.get("block", 1))))
+            self._reply({})
+        elif url.path == "/get/image":
+            self._reply({"base64": self.scope.expose(bool(int(query.get("wait_imaging_ok", 1))))})
+        else:
+            self._reply({"error": f"unknown page {url.path}"}, code=404)
+
+
+def serve_in_background(host: str = "127.0.0.1", port: int = 0, scope: Optional[FakeScope] = None) -> ThreadingHTTPServer:
+    """Start a fake scope server on a daemon thread. Use port 0 to get a free port (see `server.server_port`)."""
+    scope = FakeScope() if scope is None else scope
+    handler = type("BoundFakePyuscopeHandler", (FakePyuscopeHandler,), {"scope": scope})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    server.scope = scope
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="Run a fake pyuscope web server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=DEFAULT_FAKE_PORT)
+    parser.add_argument("--stage-speed", type=float, default=None, help="mm/s, leave out for instant moves")
+    parser.add_argument("--exposure-time", type=float, default=0.0, help="Seconds per image")
+    parser.add_argument("--focus-z", type=float, default=None, help="Make images sharpest at this z (for autofocus)")
+    parser.add_argument("--time-scale", type=float, default=1.0)
+    args = parser.parse_args()
+    scope = FakeScope(stage_speed=args.stage_speed, exposure_time=args.exposure_time, time_scale=args.time_scale, focus_z=args.focus_z)
+    server = serve_in_background(args.host, args.port, scope)
+    print(f"Fake pyuscope listening on http://{args.host}:{server.server_port} (Ctrl+C to stop)")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+"""Focus maps: predict the in-focus z anywhere on a slide from a few autofocused anchor points.
+
+Autofocusing every field costs a dozen or more frames per field. Instead we autofocus at a few anchors spread
+over the slide, fit a plane (or a quadratic surface if there are enough anchors) through them with least
+squares and move straight to the predicted z for every field. Every frame is still scored, and if one comes
+out much less sharp than the anchors were, we autofocus there, add it as an anchor and refit.
+
+Maps are kept per slide slot (e.g. "top-shelf/3") in a JSON file, so imaging the same slide again needs no
+new focus work.
+"""
+from __future__ import annotations
+
+import json
+import os
+import sys
+import time
+from pathlib import Path
+from typing import Optional, Union
+
+import numpy as np
+
+if __name__ == "__main__":
+    # Run as a script from this folder: tracing and position_tracking live one folder up
+    sys.path.append(Path(__file__).resolve().parent.parent.as_posix())
+
+from web_example import PyuscopeHTTPClient
+from autofocus import Autofocus
+
+DEFAULT_FOCUS_MAP_FILE = "focus_maps.json"
+
+def _terms(x: np.ndarray, y: np.ndarray, order: int) -> np.ndarray:
+    cols = [np.ones_like(x)]
+    if order >= 1:
+        cols += [x, y]
+    if order >= 2:
+        cols += [x * x, x * y, y * y]
+    return np.stack(cols, axis=-1)
+
+# Anchors needed for a surface of each order
+_MIN_ANCHORS = {0: 1, 1: 3, 2: 6}
+
+
+class FocusMap:
+    """In-focus z as a function of stage x, y. `order` is the highest order surface to fit (1 = plane,
+    2 = quadratic), lower orders are used while there are not enough anchors for it.
+    """
+    def __init__(self, anchors: Optional[list[tuple[float, float, float]]] = None, order: int = 1, reference_score: Optional[float] = None):
+        assert order in _MIN_ANCHORS, f"order must be one of {sorted(_MIN_ANCHORS)}"
+        self.anchors: list[tuple[float, float, float]] = list(anchors or [])
+        self.order = order
+        # Typical sharpness of an in-focus frame on this slide, inline checks compare against it
+        self.reference_score = reference_score
+        self.coefficients: Optional[np.ndarray] = None
+        self.fitted_order = 0
+        if self.anchors:
+            self.fit()
+
+    def add_anchor(self, x: float, y: float, z: float):
+        self.anchors.append((x, y, z))
+        self.fit()
+
+    def fit(self):
+        pts = np.asarray(self.anchors, dtype=np.float64)
+        self.fitted_order = max(o for o, n in _MIN_ANCHORS.items() if o <= self.order and n <= len(pts))
+        # Fit around the anchors' centroid so the quadratic terms stay well conditioned in stage coordinates
+        self._origin = pts[:, :2].mean(axis=0)
+        a = _terms(pts[:, 0] - self._origin[0], pts[:, 1] - self._origin[1], self.fitted_order)
+        # NOTE lstsq gives the minimum norm solution if the anchors are collinear (e.g. one row of fields),
+        # which is exact along that line
+        self.coefficients, *_ = np.linalg.lstsq(a, pts[:, 2], rcond=None)
+
+    @property
+    def ready(self) -> bool:
+        return len(self.anchors) >= _MIN_ANCHORS[min(self.order, 1)]
+
+    def predict(self, x, y):
+        """z at x, y (scalars or arrays)."""
+        assert self.coefficients is not None, "No anchors yet"
+        x, y = np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+        z = _terms(x - self._origin[0], y - self._origin[1], self.fitted_order) @ self.coefficients
+        return float(z) if z.ndim == 0 else z
+
+    def residuals(self) -> np.ndarray:
+        pts = np.asarray(self.anchors, dtype=np.float64)
+        return pts[:, 2] - self.predict(pts[:, 0], pts[:, 1])
+
+    def to_dict(self) -> dict:
+        return {"order": self.order, "anchors": [list(a) for a in self.anchors], "reference_score": self.reference_score,
+                "updated": time.time()}
+
+    @classmethod
+    def from_dict(cls, d: dict) -> "FocusMap":
+        return cls([tuple(a) for a in d["anchors"]], d.get("order", 1), d.get("reference_score"))
+
+
+class FocusMapStore:
+    """Focus maps by slide slot, persisted to a JSON file (rewritten atomically on every change)."""
+    def __init__(self, path: Union[str, Path] = DEFAULT_FOCUS_MAP_FILE):
+        self.path = Path(path)
+        self.maps: dict[str, FocusMap] = {}
+        if self.path.exists():
+            with open(self.path) as f:
+                self.maps = {slot: FocusMap.from_dict(d) for slot, d in json.load(f).items()}
+
+    def get(self, slot: str, order: int = 1) -> FocusMap:
+        """The map for `slot`, a new empty one if we never focused that slide."""
+        if slot not in self.maps:
+            self.maps[slot] = FocusMap(order=order)
+        return self.maps[slot]
+
+    def forget(self, slot: str):
+        """Drop the map of a slot, e.g. when a different slide is put in it."""
+        if self.maps.pop(slot, None) is not None:
+            self.save()
+
+    def save(self):
+        tmp = self.path.with_name(self.path.name + ".tmp")
+        with open(tmp, "w") as f:
+            json.dump({slot: m.to_dict() for slot, m in self.maps.items() if m.anchors}, f, indent=2)
+        os.replace(tmp, self.path)
+
+
+def spread_points(positions: list[dict[str, float]], n: int) -> list[dict[str, float]]:
+    """Pick `n` of `positions` that are as far apart as possible (farthest point sampling), for anchors."""
+    if len(positions) <= n:
+        return list(positions)
+    xy = np.array([[p["x"], p["y"]] for p in positions], dtype=np.float64)
+    # Start with the point farthest from the centroid, i.e. a corner
+    chosen = [int(np.argmax(((xy - xy.mean(axis=0)) ** 2).sum(axis=1)))]
+    nearest = ((xy - xy[chosen[0]]) ** 2).sum(axis=1)
+    while len(chosen) < n:
+        i = int(np.argmax(nearest))
+        chosen.append(i)
+        nearest = np.minimum(nearest, ((xy - xy[i]) ** 2).sum(axis=1))
+    return [positions[i] for i in sorted(chosen)]
+
+
+class FocusedScan:
+    """Sets z from a focus map for every field of a scan and checks every frame's sharpness.
+
+    Call `anchor(fields)` once before the scan (it does nothing if the map is already good), move to
+    `position(field)` instead of the field itself, and pass every frame through `check(image, field)`, which
+    returns the frame to keep (a new one if the field had to be refocused).
+    """
+    def __init__(self, client: PyuscopeHTTPClient, focus_map: FocusMap, store: Optional[FocusMapStore] = None,
+                 autofocus: Optional[Autofocus] = None, threshold: float = 0.6, span: float = 0.1, refocus_span: float = 0.03):
+        self.client = client
+        self.map = focus_map
+        self.store = store
+        self.autofocus = Autofocus(client) if autofocus is None else autofocus
+        # Re-anchor when a frame scores below this fraction of the reference score
+        self.threshold = threshold
+        # Autofocus search window (+- mm) for new anchors and around the prediction when refocusing
+        self.span = span
+        self.refocus_span = refocus_span
+        # Focus work done, for reports
+        self.n_focus_images = 0
+        self.focus_time = 0.0
+        self.n_refocus = 0
+        # Sharpness of the last frame `is_sharp` or `check` scored (e.g. for the capture catalog)
+        self.last_score: Optional[float] = None
+
+    def _focus_at(self, pos: dict[str, float], z_center: float, span: float) -> float:
+        """Autofocus at `pos`, add it as an anchor and return its score."""
+        self.client.move_absolute({k: v for k, v in pos.items() if k != "z"})
+        result = self.autofocus.focus(z_center, span)
+        self.n_focus_images += result.n_images
+        self.focus_time += result.elapsed
+        self.map.add_anchor(pos["x"], pos["y"], result.z)
+        return result.score
+
+    def anchor(self, fields: list[dict[str, float]], n: Optional[int] = None):
+        if self.map.ready:
+            return
+        n = _MIN_ANCHORS[self.map.order] if n is None else n
+        scores = []
+        for pos in spread_points(fields, n):
+            # Start from the map once it has something, it is closer than the field's nominal z
+            z = self.map.predict(pos["x"], pos["y"]) if self.map.anchors else pos["z"]
+            scores.append(self._focus_at(pos, z, self.span))
+        self.map.reference_score = float(np.median(scores))
+        self._save()
+
+    def position(self, pos: dict[str, float]) -> dict[str, float]:
+        if not self.map.anchors:
+            return dict(pos)
+        return dict(pos, z=self.map.predict(pos["x"], pos["y"]))
+
+    def is_sharp(self, image, pos: Optional[dict[str, float]] = None) -> bool:
+        """Whether `image` is as sharp as the anchors were (always true until the map has a reference)."""
+        if self.map.reference_score is None:
+            return True
+        self.last_score = self.autofocus.score(np.asarray(image))
+        return self.last_score >= self.threshold * self.map.reference_score
+
+    def check(self, image, pos: dict[str, float]):
+        if self.map.reference_score is None:
+            return image
+        score = self.last_score = self.autofocus.score(np.asarray(image))
+        if score >= self.threshold * self.map.reference_score:
+            return image
+        print(f"Field at x={pos['x']:.3f} y={pos['y']:.3f} is out of focus (score {score:.4g}), re-anchoring")
+        self.n_refocus += 1
+        self.last_score = self._focus_at(pos, self.map.predict(pos["x"], pos["y"]), self.refocus_span)
+        self._save()
+        # autofocus left the stage at the new focus
+        return self.client.image()
+
+    def _save(self):
+        if self.store is not None:
+            self.store.save()
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="Scan a tilted fake slide with a focus map")
+    parser.add_argument("--map-file", default=DEFAULT_FOCUS_MAP_FILE)
+    parser.add_argument("--slot", default="demo")
+    args = parser.parse_args()
+    from fake_pyuscope import FakeScope, serve_in_background
+    # 20um of focus change across 10mm of x, like a slide that is not sitting flat
+    server = serve_in_background(scope=FakeScope(focus_z=0.05, focus_tilt=(0.002, 0.001)))
+    store = FocusMapStore(args.map_file)
+    fields = [{"x": 2.0 * i, "y": 1.5 * j, "z": 0.0} for j in range(4) for i in range(6)]
+    with PyuscopeHTTPClient(host="127.0.0.1", port=server.server_port) as client:
+        scan = FocusedScan(client, store.get(args.slot), store)
+        t0 = time.monotonic()
+        scan.anchor(fields)
+        for pos in fields:
+            client.move_absolute(scan.position(pos))
+            scan.check(client.image_array(), pos)
+        elapsed = time.monotonic() - t0
+    print(f"{len(fields)} fields in {elapsed:.2f}s, focus work {scan.n_focus_images} images in {scan.focus_time:.2f}s "
+          f"({scan.n_refocus} re-anchors), anchor residuals {np.abs(scan.map.residuals()).max() * 1000:.1f}um")
+
+if __name__ == "__main__":
+    main()
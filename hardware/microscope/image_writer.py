@@ -0,0 +1,150 @@
+from __future__ import annotations
+
+import itertools
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, Optional, Union
+
+import numpy as np
+from PIL import Image
+
+import tracing
+
+# NOTE the writers have to be module level functions so that they can also be sent to a process pool
+def _to_pil(image: Union[Image.Image, np.ndarray]) -> Image.Image:
+    return Image.fromarray(image) if isinstance(image, np.ndarray) else image
+
+def write_jpeg(image, path: str):
+    _to_pil(image).save(path, format="JPEG", quality=95)
+
+def write_png(image, path: str):
+    # Level 1 compresses almost as well as the default for microscope frames but is a lot faster
+    _to_pil(image).save(path, format="PNG", compress_level=1)
+
+def write_tiff(image, path: str):
+    _to_pil(image).save(path, format="TIFF")
+
+def write_npy(image, path: str):
+    np.save(path, np.asarray(image))
+
+# Format name -> (file extension, writer). Add your own with `register_format`
+FORMATS: dict[str, tuple[str, Callable]] = {
+    "jpeg": (".jpg", write_jpeg),
+    "png": (".png", write_png),
+    "tiff": (".tif", write_tiff),
+    "npy": (".npy", write_npy),
+}
+_EXTENSIONS = {".jpg": "jpeg", ".jpeg": "jpeg", ".png": "png", ".tif": "tiff", ".tiff": "tiff", ".npy": "npy"}
+
+def _timed_write(writer: Callable, image, path: str) -> tuple[float, float]:
+    # Returns when and how long the write took, the span is recorded in the main process (see ImageWriter._done)
+    start, t0 = time.time(), time.perf_counter()
+    writer(image, path)
+    return start, time.perf_counter() - t0
+
+def register_format(name: str, extension: str, writer: Callable):
+    FORMATS[name] = (extension, writer)
+    _EXTENSIONS[extension.lower()] = name
+
+def format_for(filename: str) -> str:
+    ext = Path(filename).suffix.lower()
+    if ext not in _EXTENSIONS:
+        raise ValueError(f"Don't know how to write {filename}, known extensions are {sorted(_EXTENSIONS)}")
+    return _EXTENSIONS[ext]
+
+_image_counter = itertools.count()
+_image_counter_lock = threading.Lock()
+
+def unique_image_name(prefix: str, extension: str) -> str:
+    """A timestamped file name that never repeats within this process, even for frames taken in the same second."""
+    with _image_counter_lock:
+        n = next(_image_counter)
+    return f"{prefix}_{datetime.now().strftime('%Y-%m-%d_%H-%M-%S-%f')}_{n:05d}{extension}"
+
+
+class ImageWriteError(RuntimeError):
+    pass
+
+
+class ImageWriter:
+    """Encodes and writes images in the background so that saving never blocks the stage.
+
+    At most `max_pending` images are queued or being written at once: `save` blocks once that many are
+    in flight, which keeps memory bounded if the disk can not keep up. Failures are collected in `errors`
+    (and passed to `on_error` if given) and `flush`/`close` raise an `ImageWriteError` if any write failed.
+    Use `processes=True` to encode in worker processes (frames are pickled over, but encoding does not
+    compete with the acquisition loop for the GIL).
+    """
+    def __init__(self, workers: int = 2, max_pending: int = 8, processes: bool = False, on_error: Optional[Callable[[str, BaseException], None]] = None):
+        self.pool = ProcessPoolExecutor(max_workers=workers) if processes else ThreadPoolExecutor(max_workers=workers)
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.on_error = on_error
+        self.errors: list[tuple[str, BaseException]] = []
+        self._pending: set[Future] = set()
+        self._lock = threading.Lock()
+        self._reported = 0
+
+    def save(self, image: Union[Image.Image, np.ndarray], filename: Union[str, Path], fmt: Optional[str] = None) -> Future:
+        """Queue `image` to be written to `filename` (in `fmt`, or guessed from the extension)."""
+        filename = Path(filename).as_posix()
+        fmt = format_for(filename) if fmt is None else fmt
+        _, writer = FORMATS[fmt]
+        # Backpressure: wait for a free slot instead of queueing without bound
+        self.slots.acquire()
+        try:
+            fut = self.pool.submit(_timed_write, writer, image, filename)
+        except BaseException:
+            self.slots.release()
+            raise
+        with self._lock:
+            self._pending.add(fut)
+        fut.add_done_callback(lambda f, filename=filename, fmt=fmt: self._done(f, filename, fmt))
+        return fut
+
+    def _done(self, fut: Future, filename: str, fmt: str):
+        with self._lock:
+            self._pending.discard(fut)
+        self.slots.release()
+        exc = fut.exception()
+        if exc is None:
+            start, duration = fut.result()
+            tracing.record("save." + fmt, "writer", start, duration, {"path": filename})
+        else:
+            with self._lock:
+                self.errors.append((filename, exc))
+            if self.on_error is not None:
+                self.on_error(filename, exc)
+            else:
+                print(f"Failed to write {filename}: {exc}")
+
+    def flush(self):
+        """Wait until everything queued so far is on disk."""
+        while True:
+            with self._lock:
+                pending = list(self._pending)
+            if not pending:
+                break
+            for fut in pending:
+                # Errors are collected in _done
+                fut.exception()
+        with self._lock:
+            new_errors = self.errors[self._reported:]
+            self._reported = len(self.errors)
+        if new_errors:
+            failed = ", ".join(name for name, _ in new_errors)
+            raise ImageWriteError(f"{len(new_errors)} image(s) failed to write: {failed}") from new_errors[0][1]
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self.pool.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
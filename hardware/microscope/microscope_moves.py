@@ -1,16 +1,34 @@
 #!/usr/bin/env python3
 from __future__ import annotations
 
-import time
+import sys
+from pathlib import Path
 from typing import Optional
-from datetime import datetime
+
+import numpy as np
+
+if __name__ == "__main__":
+    # Run as a script from this folder: tracing and position_tracking live one folder up
+    sys.path.append(Path(__file__).resolve().parent.parent.as_posix())
+
 from web_example import PyuscopeHTTPClient
-from typing import Optional
+from image_writer import ImageWriter, unique_image_name
+from focus_map import FocusedScan
+from acquisition import acquire
+from catalog import Catalog
 
 DEFAULT_SCOPE_IP = "192.168.0.236"
 DEFAULT_SCOPE_PORT = 8401
 
-def image_pos(right_pos: dict[str, float], client: Optional[PyuscopeHTTPClient] = None):
+def image_pos(right_pos: dict[str, float], client: Optional[PyuscopeHTTPClient] = None, writer: Optional[ImageWriter] = None,
+              focus: Optional[FocusedScan] = None, debug: bool = False, catalog: Optional[Catalog] = None,
+              capture_info: Optional[dict] = None):
+    """Image the 4 slides starting at `right_pos`. With `focus` the z of every field comes from its focus map
+    (anchored first if the map is new) instead of `right_pos`, and every frame is checked for sharpness.
+    `debug` prints every position and frame (every move and frame is traced either way, see tracing).
+    With `catalog` every saved frame is recorded in it, with `capture_info` (`Catalog.record` arguments like
+    run_id, slide_id, slot and exposure) and its focus score if there is one.
+    """
     if client is None:
         # Get the host and port if necessary
         import argparse
@@ -27,35 +45,51 @@ def image_pos(right_pos: dict[str, float], client: Optional[PyuscopeHTTPClient]
     assert client is not None
     delta = 30
 
-    pos = client.get_position()
-    print(f"(debug) Initial position: {pos}")
+    # Saving happens in the background so the stage can already move on. If we were not given a writer
+    # we make our own and make sure everything is on disk before returning.
+    own_writer = writer is None
+    if own_writer:
+        writer = ImageWriter()
 
-    #Go to right position 
-    client.move_absolute(right_pos)
+    if debug:
+        # Only ask for it when we print it, it is one more round trip to the scope
+        print(f"(debug) Initial position: {client.get_position()}")
 
-    im = client.image()
-    print(f"(debug) Got image w/ size {im.size}, mode: {im.mode}")
-    filename = get_img_filename()
-    im.save(filename)
-    
     #Iterate down the 4 slides
-    for i in range(3):
-        right_pos["x"] += delta
-        time.sleep(1)
-        client.move_absolute(right_pos)
-        print(f"(debug) Moved tp position: {right_pos}")
-        im = client.image()
-        print(f"(debug) Got image w/ size {im.size}, mode: {im.mode}")
-        filename = get_img_filename()
-        im.save(filename)
+    fields = [dict(right_pos, x=right_pos["x"] + i * delta) for i in range(4)]
+    if focus is not None:
+        focus.anchor(fields)
+
+    def record(image, field: dict[str, float], filename: str):
+        if catalog is not None:
+            catalog.record(filename, field, focus_score=focus.last_score if focus is not None else None,
+                           shape=np.shape(image), **(capture_info or {}))
+
+    try:
+        # The stage already moves on to the next slide while the last frame is decoded and saved, and we poll
+        # for it to settle instead of sleeping
+        report = acquire(client, [focus.position(f) for f in fields] if focus is not None else fields, writer,
+                         name=lambda i, field: get_img_filename(), check=focus.is_sharp if focus is not None else None,
+                         on_saved=lambda frame, filename: record(frame.image, frame.field, filename))
+        if debug:
+            print(f"(debug) {report}")
+        for frame in report.failed:
+            # Out of focus: refocus there (which updates the focus map) and take it again
+            filename = get_img_filename()
+            image = focus.check(frame.image, fields[frame.index])
+            writer.save(image, filename)
+            record(image, focus.position(fields[frame.index]), filename)
+        # Like the moves used to, leave right_pos at the last slide
+        right_pos["x"] = fields[-1]["x"]
+    finally:
+        if own_writer:
+            writer.close()
+        if catalog is not None:
+            catalog.flush()
 
-def get_img_filename():
-    now = datetime.now()
-    # Format the date and time as a string
-    timestamp = now.strftime("%Y-%m-%d_%H-%M-%S")
-    # Construct the filename
-    filename = f"microscope_img_{timestamp}.jpg"
-    return filename
+def get_img_filename(extension: str = ".jpg"):
+    # Timestamp (down to the microsecond) plus a counter so frames taken in the same second never overwrite each other
+    return unique_image_name("microscope_img", extension)
 
 if __name__ == "__main__":
     # Run script with python3 web_example.py
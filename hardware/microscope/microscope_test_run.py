@@ -1,15 +1,26 @@
+import sys
+from pathlib import Path
+
+if __name__ == "__main__":
+    # Run as a script from this folder: tracing and position_tracking live one folder up
+    sys.path.append(Path(__file__).resolve().parent.parent.as_posix())
+
 import microscope_moves as mm
+from stage_planner import Region, execute
 
 def main():
-    #example position A, define accordingly
+    #example position A and B, define accordingly
     posA = {'y': 118.73874999999998, 'z': -24.0725, 'x': 39.45625}
-    #move to posA and scan 4 slides
-    mm.image_pos(posA)
-
-    #example position A, define accordingly
-    posA = {'y': 118.73874999999998, 'z': -24.0725, 'x': 232.24874999999997}
-    #move to posB and scan 4 slides
-    mm.image_pos(posA)
+    posB = {'y': 118.73874999999998, 'z': -24.0725, 'x': 232.24874999999997}
+    # Scan the 4 slides at each position (same fields as image_pos) in a single planned pass instead of
+    # calling image_pos once per position, so the stage doesn't go back and forth
+    regions = [
+        Region("A", origin=posA, nx=4, dx=30),
+        Region("B", origin=posB, nx=4, dx=30),
+    ]
+    client = mm.PyuscopeHTTPClient(host=mm.DEFAULT_SCOPE_IP, port=mm.DEFAULT_SCOPE_PORT)
+    report = execute(regions, client)
+    print(report)
 
 if __name__ == "__main__":
     main()
@@ -2,13 +2,19 @@ from __future__ import annotations
 
 import os
 import requests 
+import sys
+from pathlib import Path
 from typing import Optional, Union
+
+if __name__ == "__main__":
+    # Run as a script from this folder: tracing and position_tracking live one folder up
+    sys.path.append(Path(__file__).resolve().parent.parent.as_posix())
+
 from web_example import PyuscopeHTTPClient
 from enum import Enum
-from datetime import datetime
-from pathlib import Path
 
 from microscope_moves import image_pos
+from image_writer import ImageWriter, unique_image_name
 
 # TODO(Adriano) add support for move relative vs. move absolute
 # TODO(Adriano) add support for imaging with a filename
@@ -51,7 +57,7 @@ class Command:
             raise ValueError(f"Invalid command type {self.ctype.value}")
 
 def generate_image_name() -> str:
-    return f"scope_image_{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}.png"
+    return unique_image_name("scope_image", ".png")
 
 # Valid keyword if starts with move and then has x | y | z and then has a number
 def valid_keyword(keyword: str) -> Optional[Command]:
@@ -76,7 +82,7 @@ def valid_keyword(keyword: str) -> Optional[Command]:
     except:
         return None
 
-def run(keyword, client, scope_folder):
+def run(keyword, client, scope_folder, writer: ImageWriter):
     keywords = [x.strip() for x in keyword.split("&&")]
     for keyword in keywords:
         keyword = keyword.lower()
@@ -100,12 +106,15 @@ def run(keyword, client, scope_folder):
             # NOTE that this is a PIL image
             im = client.image()
             im_name = kw.format()
+            if im_name is None:
+                im_name = generate_image_name()
             im_file = (scope_folder / im_name).as_posix()
-            im.save(im_file)
+            # Written in the background, failures get printed by the writer
+            writer.save(im, im_file)
         elif kw.ctype == CommandType.IMAGE_SEQ:
             fmt = kw.format()
             print("was type image_seq!", fmt)
-            image_pos(fmt, client=client)
+            image_pos(fmt, client=client, writer=writer)
         elif kw.ctype == CommandType.INFO:
             curr_pos = client.get_position()
             print(f"Current position:")
@@ -130,17 +139,22 @@ def main():
     # https://docs.google.com/document/d/1DeH7sRFJL5jzOhhswXLT6Msq-TXWYu_6sOhDkCAcsn0/edit#heading=h.ltc37h9sv735
     # ALSO reminder to self: you must be on LAN (no VPN AFAIK)
     client = PyuscopeHTTPClient(debug=True)
+    writer = ImageWriter()
     exit_keyword = "exit"
     last_keyword = None
     keyword = None
-    while keyword != exit_keyword:
-        keyword = input("Enter a command: ")
-        if keyword.startswith("forever"):
-            keyword = keyword[len("forever"):].strip()
-            while True:
-                run(keyword, client, scope_folder)
-        else:
-            run(keyword, client, scope_folder)
+    try:
+        while keyword != exit_keyword:
+            keyword = input("Enter a command: ")
+            if keyword.startswith("forever"):
+                keyword = keyword[len("forever"):].strip()
+                while True:
+                    run(keyword, client, scope_folder, writer)
+            else:
+                run(keyword, client, scope_folder, writer)
+    finally:
+        # Make sure every image that was taken actually ends up on disk
+        writer.close()
     print("")
     print("Done!")
 
@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+"""Plans the order in which the stage visits every field of every slide so that it travels as little as possible.
+
+Within a slide fields are visited in a serpentine raster (no fly-back at the end of every row). Across slides we
+pick an order with nearest neighbour + 2-opt, and enter every slide from the corner closest to where the stage
+came from. Distances are Chebyshev (the largest per-axis move) since the stage axes move at the same time and the
+longest one decides how long a move takes.
+"""
+from __future__ import annotations
+
+import time
+from typing import Callable, Optional
+
+from web_example import PyuscopeHTTPClient
+from image_writer import ImageWriter, unique_image_name
+
+AXES = ("x", "y", "z")
+
+def distance(a: dict[str, float], b: dict[str, float]) -> float:
+    return max((abs(a[k] - b[k]) for k in AXES if k in a and k in b), default=0.0)
+
+def path_length(points: list[dict[str, float]], start: Optional[dict[str, float]] = None) -> float:
+    points = ([start] if start is not None else []) + list(points)
+    return sum(distance(a, b) for a, b in zip(points, points[1:]))
+
+
+class Region:
+    """The fields to image on one slide: either a grid of `nx` x `ny` fields `dx`/`dy` mm apart starting at
+    `origin`, or an explicit list of `points`. Every field is imaged at every z in `z_levels` (offsets from the
+    field's z) if given.
+    """
+    def __init__(self, name: str, origin: Optional[dict[str, float]] = None, nx: int = 1, ny: int = 1, dx: float = 0.0, dy: float = 0.0,
+                 points: Optional[list[dict[str, float]]] = None, z_levels: Optional[list[float]] = None):
+        assert (origin is None) != (points is None), "Give either a grid origin or a list of points"
+        self.name = name
+        self.origin = origin
+        self.nx, self.ny, self.dx, self.dy = nx, ny, dx, dy
+        self.points = points
+        self.z_levels = z_levels
+
+    def rows(self) -> list[list[dict[str, float]]]:
+        if self.points is not None:
+            return [list(self.points)]
+        return [
+            [dict(self.origin, x=self.origin["x"] + i * self.dx, y=self.origin["y"] + j * self.dy) for i in range(self.nx)]
+            for j in range(self.ny)
+        ]
+
+    def corners(self) -> list[dict[str, float]]:
+        rows = self.rows()
+        return [rows[0][0], rows[0][-1], rows[-1][0], rows[-1][-1]]
+
+    def center(self) -> dict[str, float]:
+        corners = self.corners()
+        return {k: sum(c[k] for c in corners) / len(corners) for k in corners[0]}
+
+    def fields_from(self, entry: dict[str, float]) -> list[dict[str, float]]:
+        """All fields in visiting order when entering from the corner closest to `entry`."""
+        if self.points is not None:
+            # No grid, order the points greedily and improve with 2-opt like we do for slides
+            return _two_opt(_nearest_neighbour(self.points, entry), entry)
+        rows = self.rows()
+        best = None
+        for flip_rows in (False, True):
+            for flip_cols in (False, True):
+                ordered = rows[::-1] if flip_rows else rows
+                fields = []
+                for j, row in enumerate(ordered):
+                    # Serpentine: every other row is traversed backwards
+                    row = row[::-1] if (j % 2 == 1) != flip_cols else row
+                    fields.extend(row)
+                cost = distance(entry, fields[0]) + path_length(fields)
+                if best is None or cost < best[0]:
+                    best = (cost, fields)
+        return best[1]
+
+
+def _nearest_neighbour(items: list, start: dict[str, float], key: Callable = lambda p: p) -> list:
+    """Greedy open tour from `start`. `key` maps an item to its position."""
+    remaining = list(items)
+    order = []
+    current = start
+    while remaining:
+        i = min(range(len(remaining)), key=lambda i: distance(current, key(remaining[i])))
+        item = remaining.pop(i)
+        current = key(item)
+        order.append(item)
+    return order
+
+def _two_opt(order: list, start: dict[str, float], key: Callable = lambda p: p, max_rounds: int = 50) -> list:
+    """Reverse segments of the (open) tour while that makes it shorter. `key` maps a tour element to its position."""
+    order = list(order)
+    pos = lambda i: start if i < 0 else key(order[i])
+    for _ in range(max_rounds):
+        improved = False
+        for i in range(len(order) - 1):
+            for j in range(i + 1, len(order)):
+                # Reversing order[i..j] swaps edges (i-1, i) + (j, j+1) for (i-1, j) + (i, j+1)
+                before = distance(pos(i - 1), pos(i)) + (distance(pos(j), pos(j + 1)) if j + 1 < len(order) else 0.0)
+                after = distance(pos(i - 1), pos(j)) + (distance(pos(i), pos(j + 1)) if j + 1 < len(order) else 0.0)
+                if after < before - 1e-9:
+                    order[i:j + 1] = order[i:j + 1][::-1]
+                    improved = True
+        if not improved:
+            break
+    return order
+
+
+class PlannedField:
+    def __init__(self, region: str, index: int, pos: dict[str, float]):
+        self.region = region
+        self.index = index
+        self.pos = pos
+
+    def __repr__(self) -> str:
+        return f"PlannedField({self.region!r}, {self.index}, {self.pos})"
+
+
+def plan(regions: list[Region], start: dict[str, float]) -> list[PlannedField]:
+    """The order to image every field of every region in, starting from the stage position `start`."""
+    # Slide order: nearest neighbour on the slide centers, then 2-opt
+    centers = {id(r): r.center() for r in regions}
+    center = lambda r: centers[id(r)]
+    ordered_regions = _two_opt(_nearest_neighbour(regions, start, key=center), start, key=center)
+    fields = []
+    current = start
+    # Fields visited so far (not planned fields, a z stack is several of those)
+    n_visited = 0
+    for region in ordered_regions:
+        for i, pos in enumerate(region.fields_from(current)):
+            # z stacks also go back and forth: every other field runs its stack top down
+            levels = region.z_levels or [None]
+            for dz in (levels if n_visited % 2 == 0 else levels[::-1]):
+                field_pos = dict(pos) if dz is None else dict(pos, z=pos["z"] + dz)
+                fields.append(PlannedField(region.name, i, field_pos))
+            n_visited += 1
+        current = fields[-1].pos
+    return fields
+
+
+class PlanReport:
+    def __init__(self, n_fields: int, naive_travel: float, estimated_travel: float):
+        self.n_fields = n_fields
+        # Travel if we visited the regions as given, row by row (like image_pos does)
+        self.naive_travel = naive_travel
+        self.estimated_travel = estimated_travel
+        # Filled in by execute
+        self.actual_travel: Optional[float] = None
+        self.elapsed: Optional[float] = None
+
+    def __str__(self) -> str:
+        s = f"{self.n_fields} fields, planned travel {self.estimated_travel:.2f}mm (naive order {self.naive_travel:.2f}mm)"
+        if self.actual_travel is not None:
+            s += f", actual travel {self.actual_travel:.2f}mm in {self.elapsed:.1f}s"
+        return s
+
+
+def naive_order(regions: list[Region]) -> list[dict[str, float]]:
+    fields = []
+    for region in regions:
+        for row in region.rows():
+            for pos in row:
+                for dz in (region.z_levels or [None]):
+                    fields.append(dict(pos) if dz is None else dict(pos, z=pos["z"] + dz))
+    return fields
+
+
+def execute(regions: list[Region], client: PyuscopeHTTPClient, writer: Optional[ImageWriter] = None,
+            on_frame: Optional[Callable[[PlannedField, object], None]] = None, measure: bool = True) -> PlanReport:
+    """Plan and image every field. Frames are saved through `writer` (one is made if not given) and/or handed to
+    `on_frame(field, image)`. With `measure` the stage position is read back after every move to compute the
+    travel the stage actually did.
+    """
+    start = client.get_position()
+    fields = plan(regions, start)
+    report = PlanReport(len(fields), path_length(naive_order(regions), start), path_length([f.pos for f in fields], start))
+    own_writer = writer is None and on_frame is None
+    if own_writer:
+        writer = ImageWriter()
+    t0 = time.monotonic()
+    actual = 0.0
+    last = start
+    try:
+        for field in fields:
+            client.move_absolute(field.pos)
+            if measure:
+                # The real position, not the one the client tracks
+                now = client.get_position(verify=True)
+                actual += distance(last, now)
+                last = now
+            im = client.image()
+            if on_frame is not None:
+                on_frame(field, im)
+            if writer is not None:
+                writer.save(im, unique_image_name(f"microscope_img_{field.region}", ".jpg"))
+    finally:
+        if own_writer:
+            writer.close()
+    report.elapsed = time.monotonic() - t0
+    report.actual_travel = actual if measure else None
+    return report
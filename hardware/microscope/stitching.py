@@ -0,0 +1,299 @@
+#!/usr/bin/env python3
+"""Stitches the frames of a scan into one slide-level mosaic while the scan is still running.
+
+Every frame is placed where the stage says it was (the field's x, y is the center of the frame, converted to
+pixels with `mm_per_pixel`) and then nudged by FFT phase correlation against what is already on the canvas
+where it overlaps (stage positions are only good to a few microns, which is many pixels). The overlap used is
+the band of the frame that is fully covered by earlier frames: the rows along its top or bottom edge or the
+columns along its left or right edge, whichever is bigger. If there is no such band (the first frame, frames
+that don't overlap anything) or the correlation peak is weak (a blank area of the slide) the stage position
+is kept.
+
+The canvas is a `.npy` file opened as a memory map (uint8, like the frames), with a second one for the blend
+weights, so the mosaic can be much bigger than the Jetson's RAM: only the windows frames land on are touched.
+Frames are feathered into it (their weight falls off linearly towards their edges) with a running weighted
+average, so the canvas is a finished image after every frame and nothing has to happen at the end but
+flushing it. Frame placements are saved next to the canvas as JSON.
+
+Frames are added with `add` or, from the acquisition loop, with `submit`, which stitches on a background
+thread so the scan does not wait for it (numpy's FFTs and copies release the GIL). `acquire_mosaic` does
+both: it images a list of fields and stitches them as they come in.
+
+Run with python3 stitching.py to stitch a synthetic slide imaged with stage errors and see how far off the
+placements are with and without the phase correlation.
+"""
+from __future__ import annotations
+
+import json
+import os
+import sys
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Optional, Union
+
+import numpy as np
+
+if __name__ == "__main__":
+    # Run as a script from this folder: tracing and position_tracking live one folder up
+    sys.path.append(Path(__file__).resolve().parent.parent.as_posix())
+
+# Pixels the phase correlation may move a frame away from its stage position
+DEFAULT_MAX_SHIFT = 64
+# Thinnest overlap band (pixels) worth correlating
+DEFAULT_MIN_OVERLAP = 24
+# Correlation peaks (of the normalized cross power spectrum, 1 is a perfect match) below this are ignored
+DEFAULT_MIN_PEAK = 0.05
+# Pixels over which a frame's weight ramps up from its edge
+DEFAULT_FEATHER = 32
+# A band row/column counts as covered if this much of it already has pixels
+_COVERED = 0.98
+
+def phase_correlate(reference: np.ndarray, moving: np.ndarray) -> tuple[int, int, float]:
+    """The (dy, dx) such that `moving` shifted by it matches `reference` (reference[y, x] ~ moving[y - dy, x - dx]),
+    and the height of the correlation peak (1 for a perfect match).
+    """
+    h, w = reference.shape
+    window = np.outer(np.hanning(h), np.hanning(w)).astype(np.float32)
+    a = np.fft.rfft2((reference - reference.mean()) * window)
+    b = np.fft.rfft2((moving - moving.mean()) * window)
+    cross = a * np.conj(b)
+    cross /= np.abs(cross) + 1e-9
+    surface = np.fft.irfft2(cross, s=(h, w))
+    peak = int(np.argmax(surface))
+    dy, dx = divmod(peak, w)
+    # The surface wraps around, shifts past the middle are negative
+    dy = dy - h if dy > h // 2 else dy
+    dx = dx - w if dx > w // 2 else dx
+    return dy, dx, float(surface.flat[peak])
+
+def _gray(image: np.ndarray) -> np.ndarray:
+    return image.astype(np.float32) if image.ndim == 2 else image.astype(np.float32).mean(axis=2)
+
+def _feather(height: int, width: int, feather: int) -> np.ndarray:
+    ramp = lambda n: np.minimum(np.minimum(np.arange(n), np.arange(n)[::-1]) + 1, feather).astype(np.float32) / feather
+    return np.outer(ramp(height), ramp(width))
+
+
+class Placement:
+    """Where a frame went: the top left pixel from the stage position, the one used, and the correlation peak
+    (None if it was not correlated).
+    """
+    def __init__(self, index: int, field: dict[str, float], nominal: tuple[int, int], position: tuple[int, int], peak: Optional[float]):
+        self.index = index
+        self.field = field
+        self.nominal = nominal
+        self.position = position
+        self.peak = peak
+
+    @property
+    def correction(self) -> tuple[int, int]:
+        return self.position[0] - self.nominal[0], self.position[1] - self.nominal[1]
+
+    def to_dict(self) -> dict:
+        return {"index": self.index, "field": self.field, "nominal": list(self.nominal), "position": list(self.position), "peak": self.peak}
+
+
+class Stitcher:
+    """Stitches frames of `frame_shape` ((height, width) or (height, width, channels)) taken at `fields` (stage
+    positions, mm) into the canvas at `path` (a .npy file), see the module docstring. `x_sign`/`y_sign` flip an
+    axis if the stage and the camera count it in opposite directions.
+    """
+    def __init__(self, path: Union[str, Path], fields: list[dict[str, float]], frame_shape: tuple[int, ...],
+                 mm_per_pixel: float, x_sign: int = 1, y_sign: int = 1, max_shift: int = DEFAULT_MAX_SHIFT,
+                 min_overlap: int = DEFAULT_MIN_OVERLAP, min_peak: float = DEFAULT_MIN_PEAK, feather: int = DEFAULT_FEATHER):
+        assert fields, "Need the fields to know how big the canvas is"
+        self.path = Path(path)
+        self.frame_shape = tuple(frame_shape)
+        self.mm_per_pixel = mm_per_pixel
+        self.x_sign, self.y_sign = x_sign, y_sign
+        self.max_shift = max_shift
+        self.min_overlap = min_overlap
+        self.min_peak = min_peak
+        h, w = self.frame_shape[:2]
+        self.weights = _feather(h, w, min(feather, h // 2, w // 2))
+        # Canvas pixel (0, 0) is this many pixels from the stage origin, with room for corrections on every side
+        centers = [self._stage_pixels(f) for f in fields]
+        self.origin = (min(y for y, _ in centers) - h // 2 - max_shift, min(x for _, x in centers) - w // 2 - max_shift)
+        height = max(y for y, _ in centers) - self.origin[0] + h - h // 2 + max_shift
+        width = max(x for _, x in centers) - self.origin[1] + w - w // 2 + max_shift
+        self.canvas = np.lib.format.open_memmap(self.path, mode="w+", dtype=np.uint8, shape=(height, width) + self.frame_shape[2:])
+        self._weight_path = self.path.with_name(self.path.stem + ".weights.npy")
+        self.weight = np.lib.format.open_memmap(self._weight_path, mode="w+", dtype=np.float32, shape=(height, width))
+        self.placements: list[Placement] = []
+        self.stitch_time = 0.0
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._futures: list[Future] = []
+
+    def _stage_pixels(self, field: dict[str, float]) -> tuple[int, int]:
+        return round(self.y_sign * field["y"] / self.mm_per_pixel), round(self.x_sign * field["x"] / self.mm_per_pixel)
+
+    def nominal_position(self, field: dict[str, float]) -> tuple[int, int]:
+        """Canvas pixel of the top left of a frame taken at `field`, going by the stage alone."""
+        y, x = self._stage_pixels(field)
+        h, w = self.frame_shape[:2]
+        return y - h // 2 - self.origin[0], x - w // 2 - self.origin[1]
+
+    def _overlap_band(self, y: int, x: int) -> Optional[tuple[slice, slice]]:
+        """The biggest band along an edge of the frame at (y, x) that earlier frames fully cover, in frame pixels."""
+        h, w = self.frame_shape[:2]
+        covered = self.weight[y:y + h, x:x + w] > 0
+        if covered.shape != (h, w) or not covered.any():
+            return None
+        rows = covered.mean(axis=1) >= _COVERED
+        cols = covered.mean(axis=0) >= _COVERED
+        candidates = []
+        for full, n in ((rows, w), (cols, h)):
+            # Length of the run of covered rows (columns) from the top (left) and from the bottom (right)
+            lead = int(np.argmin(full)) if not full.all() else len(full)
+            trail = int(np.argmin(full[::-1])) if not full.all() else len(full)
+            candidates.append((lead * n, full is rows, 0, lead))
+            candidates.append((trail * n, full is rows, len(full) - trail, len(full)))
+        area, along_rows, start, stop = max(candidates)
+        if stop - start < self.min_overlap:
+            return None
+        return (slice(start, stop), slice(0, w)) if along_rows else (slice(0, h), slice(start, stop))
+
+    def _register(self, gray: np.ndarray, nominal: tuple[int, int]) -> tuple[tuple[int, int], Optional[float]]:
+        band = self._overlap_band(*nominal)
+        if band is None:
+            return nominal, None
+        ys, xs = band
+        y, x = nominal
+        reference = _gray(self.canvas[y + ys.start:y + ys.stop, x + xs.start:x + xs.stop])
+        dy, dx, peak = phase_correlate(reference, gray[ys, xs])
+        if peak < self.min_peak or abs(dy) > self.max_shift or abs(dx) > self.max_shift:
+            return nominal, peak
+        # The canvas there is the frame moved by (dy, dx): the frame really starts (dy, dx) further down/right
+        return (y + dy, x + dx), peak
+
+    def _blend(self, image: np.ndarray, y: int, x: int):
+        h, w = self.frame_shape[:2]
+        # Clip to the canvas (only matters if a correction went past the margin)
+        y0, x0 = max(y, 0), max(x, 0)
+        y1, x1 = min(y + h, self.canvas.shape[0]), min(x + w, self.canvas.shape[1])
+        if y0 >= y1 or x0 >= x1:
+            return
+        frame = image[y0 - y:y1 - y, x0 - x:x1 - x].astype(np.float32)
+        weight = self.weights[y0 - y:y1 - y, x0 - x:x1 - x]
+        old_weight = self.weight[y0:y1, x0:x1]
+        total = old_weight + weight
+        if frame.ndim == 3:
+            old = self.canvas[y0:y1, x0:x1].astype(np.float32)
+            blended = (old * old_weight[..., None] + frame * weight[..., None]) / total[..., None]
+        else:
+            old = self.canvas[y0:y1, x0:x1].astype(np.float32)
+            blended = (old * old_weight + frame * weight) / total
+        self.canvas[y0:y1, x0:x1] = np.clip(blended + 0.5, 0, 255).astype(np.uint8)
+        self.weight[y0:y1, x0:x1] = total
+
+    def add(self, image: np.ndarray, field: dict[str, float]) -> Placement:
+        """Register `image` (taken at stage position `field`) against the canvas and blend it in."""
+        assert image.shape == self.frame_shape, f"Expected a {self.frame_shape} frame, got {image.shape}"
+        t0 = time.perf_counter()
+        nominal = self.nominal_position(field)
+        position, peak = self._register(_gray(image), nominal)
+        self._blend(image, *position)
+        placement = Placement(len(self.placements), dict(field), nominal, position, peak)
+        self.placements.append(placement)
+        self.stitch_time += time.perf_counter() - t0
+        return placement
+
+    def submit(self, image: np.ndarray, field: dict[str, float]) -> Future:
+        """`add` on the stitching thread (one, so frames go in in order). Use `finish` to wait for them all."""
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="stitcher")
+        future = self._executor.submit(self.add, image, field)
+        self._futures.append(future)
+        return future
+
+    def finish(self) -> list[Placement]:
+        """Wait for every submitted frame, flush the canvas and save the placements next to it."""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        futures, self._futures = self._futures, []
+        for future in futures:
+            # Raises if stitching a frame failed
+            future.result()
+        self.canvas.flush()
+        del self.weight
+        os.remove(self._weight_path)
+        info = {"mm_per_pixel": self.mm_per_pixel, "origin": list(self.origin), "shape": list(self.canvas.shape),
+                "frames": [p.to_dict() for p in self.placements]}
+        tmp = self.path.with_name(self.path.stem + ".json.tmp")
+        with open(tmp, "w") as f:
+            json.dump(info, f, indent=2)
+        os.replace(tmp, self.path.with_suffix(".json"))
+        return self.placements
+
+
+def acquire_mosaic(client, fields: list[dict[str, float]], path: Union[str, Path], mm_per_pixel: float, **kwargs):
+    """Image `fields` (see `acquisition.acquire`, e.g. a `stage_planner.Region`'s fields) and stitch them into
+    the canvas at `path` while the scan runs. Takes a first frame to get the frame size. Extra arguments go to
+    `Stitcher`. Returns the acquisition report and the placements.
+    """
+    from acquisition import acquire
+    client.move_absolute(fields[0])
+    stitcher = Stitcher(path, fields, client.image_array().shape, mm_per_pixel, **kwargs)
+    report = acquire(client, fields, on_frame=lambda frame: stitcher.submit(frame.image, frame.field))
+    return report, stitcher.finish()
+
+
+def _synthetic_slide(height: int, width: int, seed: int = 0) -> np.ndarray:
+    """Blobs of different sizes, like cells, on a light background."""
+    rng = np.random.default_rng(seed)
+    slide = np.full((height, width), 220.0, dtype=np.float32)
+    for radius, n in ((3, height * width // 400), (8, height * width // 4000), (20, height * width // 40000)):
+        ys, xs = rng.integers(0, height, n), rng.integers(0, width, n)
+        yy, xx = np.mgrid[-radius:radius + 1, -radius:radius + 1]
+        disk = (yy ** 2 + xx ** 2 <= radius ** 2) * rng.uniform(30, 90)
+        for y, x in zip(ys, xs):
+            y0, x0 = max(y - radius, 0), max(x - radius, 0)
+            patch = disk[y0 - (y - radius):, x0 - (x - radius):][:height - y0, :width - x0]
+            slide[y0:y0 + patch.shape[0], x0:x0 + patch.shape[1]] -= patch
+    return np.clip(slide + rng.normal(0, 4, slide.shape), 0, 255).astype(np.uint8)
+
+def main():
+    import argparse
+    import tempfile
+    parser = argparse.ArgumentParser(description="Stitch a synthetic slide imaged with stage errors")
+    parser.add_argument("--grid", type=int, nargs=2, default=[6, 4], help="Fields in x and y")
+    parser.add_argument("--frame", type=int, nargs=2, default=[640, 480], help="Frame width and height in pixels")
+    parser.add_argument("--overlap", type=float, default=0.15, help="Fraction of a frame adjacent fields overlap")
+    parser.add_argument("--mm-per-pixel", type=float, default=0.001)
+    parser.add_argument("--stage-error", type=float, default=0.012, help="Standard deviation of the stage position error (mm)")
+    args = parser.parse_args()
+    (nx, ny), (w, h) = args.grid, args.frame
+    step_x, step_y = round(w * (1 - args.overlap)), round(h * (1 - args.overlap))
+    margin = 4 * round(args.stage_error / args.mm_per_pixel) + 1
+    slide = _synthetic_slide(step_y * (ny - 1) + h + 2 * margin, step_x * (nx - 1) + w + 2 * margin)
+    rng = np.random.default_rng(1)
+    fields, frames, truth = [], [], []
+    for j in range(ny):
+        for i in (range(nx) if j % 2 == 0 else reversed(range(nx))):
+            # Where the stage was asked to go and where it really went (the camera sees the real one)
+            fields.append({"x": (margin + i * step_x + w // 2) * args.mm_per_pixel, "y": (margin + j * step_y + h // 2) * args.mm_per_pixel, "z": 0.0})
+            ey, ex = np.clip(rng.normal(0, args.stage_error / args.mm_per_pixel, 2).round().astype(int), -margin + 1, margin - 1)
+            y0, x0 = margin + j * step_y + ey, margin + i * step_x + ex
+            frames.append(np.repeat(slide[y0:y0 + h, x0:x0 + w, None], 3, axis=2))
+            truth.append((ey, ex))
+    with tempfile.TemporaryDirectory() as tmp:
+        stitcher = Stitcher(Path(tmp, "mosaic.npy"), fields, frames[0].shape, args.mm_per_pixel, max_shift=margin)
+        t0 = time.perf_counter()
+        for frame, field in zip(frames, fields):
+            stitcher.submit(frame, field)
+        placements = stitcher.finish()
+        elapsed = time.perf_counter() - t0
+        # Placements are only defined up to where the first frame went, compare relative to it
+        first = np.array(truth[0]) - np.array(placements[0].correction)
+        stage_error = [np.abs(np.array(t) - np.array(truth[0])).max() for t in truth]
+        stitch_error = [np.abs(np.array(t) - np.array(p.correction) - first).max() for t, p in zip(truth, placements)]
+        print(f"{len(frames)} {w}x{h} frames into a {stitcher.canvas.shape[1]}x{stitcher.canvas.shape[0]} canvas in {elapsed:.2f}s "
+              f"({elapsed / len(frames) * 1000:.0f}ms/frame)")
+        print(f"placement error, stage only: max {max(stage_error)}px, mean {np.mean(stage_error):.1f}px")
+        print(f"placement error, stitched:   max {max(stitch_error)}px, mean {np.mean(stitch_error):.1f}px "
+              f"({sum(p.peak is not None and p.correction != (0, 0) for p in placements)} frames corrected)")
+
+if __name__ == "__main__":
+    main()
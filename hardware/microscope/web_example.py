@@ -4,84 +4,382 @@ from __future__ import annotations
 import os
 import requests
 import base64
+import binascii
+import numpy as np
 from PIL import Image
 import io
+import sys
+import time
+from pathlib import Path
 from typing import Optional
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+if __name__ == "__main__":
+    # Run as a script from this folder: tracing and position_tracking live one folder up
+    sys.path.append(Path(__file__).resolve().parent.parent.as_posix())
+
+import tracing
+from position_tracking import PositionTracker, StalenessPolicy
+
+# Seconds before we give up on a request. Blocking moves only answer once the stage got there and images only
+# once the exposure is done, so those get (a lot) more time than simple queries.
+DEFAULT_TIMEOUT = 5.0
+ENDPOINT_TIMEOUTS = {
+    "/get/position": 2.0,
+    "/run/move_absolute": 60.0,
+    "/run/move_relative": 60.0,
+    "/get/image": 30.0,
+}
+# mm, how close to its target (and how still) the stage has to be to count as settled. This has to be above what
+# the stage can actually hold (its step size and repeatability, plus the jitter of the position readout) or the
+# wait runs into its timeout; tens of microns is well inside a field of view. Set it per scope with
+# `PyuscopeHTTPClient(settle_tolerance=...)` when the stage is known to do better or worse.
+DEFAULT_SETTLE_TOLERANCE = 0.02
+# Retries when we could not reach the scope at all, the n-th retry waits backoff * 2 ** (n - 1) seconds
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF = 0.1
+# Only 503 (unavailable, the request was not handled) is safe to retry: a 502/504 can come from something in
+# between after it already forwarded the request, and a move that runs twice moves the stage twice
+RETRY_STATUSES = (503,)
+
+def resolve_address(host: Optional[str] = None, port: Optional[int] = None) -> tuple[str, int]:
+    """Fill in the scope host and port from the environment (or the defaults) when they are not given."""
+    if host is None:
+        if "SCOPE_IP" in os.environ:
+            host = os.environ['SCOPE_IP']
+        else:
+            host = "localhost"
+    if port is None:
+        if "SCOPE_PORT" in os.environ:
+            port = int(os.environ['SCOPE_PORT'])
+        else:
+            port = 8080
+    assert port is not None
+    assert host is not None
+    return host, port
+
+# These build the query arguments for and parse the responses of each endpoint. They are shared by the sync
+# and the async (async_client.py) clients so both always talk to the scope in exactly the same way.
+def move_query(pos: dict[str, float], block: bool = True) -> dict[str, float]:
+    # Positions should be in the format {"x": float, "y": float, etc...}
+    # though any of these keys could also be missing
+    qargs = {"block": int(block)}
+    for k, v in pos.items():
+        qargs["axis." + k] = float(v)
+    return qargs
+
+def image_query(wait_imaging_ok: bool = True, raw: bool = False) -> dict[str, int]:
+    return {
+        "wait_imaging_ok": int(wait_imaging_ok),
+        "raw": int(raw)
+    }
+
+def parse_position(ret: dict) -> dict[str, float]:
+    pos = ret["data"]
+    for k, v in pos.items():
+        pos[k] = float(v)
+    return pos
+
+def decode_image(ret: dict) -> Image.Image:
+    with tracing.span("decode.image", "scope"):
+        buf = base64.b64decode(ret["data"]["base64"])
+        im = Image.open(io.BytesIO(buf))
+        # Decode now (PIL is lazy) so the span covers it
+        im.load()
+        return im
+
+# Bytes of the response body we look at at a time when streaming images
+IMAGE_CHUNK_SIZE = 256 * 1024
+
+class _MemoryReader(io.RawIOBase):
+    """A read-only file over a memoryview so PIL can decode straight out of our buffer (io.BytesIO would copy it)."""
+    def __init__(self, view: memoryview):
+        self.view = view
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, b):
+        n = max(0, min(len(b), len(self.view) - self.pos))
+        b[:n] = self.view[self.pos:self.pos + n]
+        self.pos += n
+        return n
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self.pos = offset
+        elif whence == io.SEEK_CUR:
+            self.pos += offset
+        else:
+            self.pos = len(self.view) + offset
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+# PIL stores these modes with the same memory layout as a NumPy array of (mode it maps to, bands)
+# (RGB is stored padded to 4 bytes per pixel, hence RGBX)
+_ARRAY_MODES = {"L": ("L", 1), "RGB": ("RGBX", 4), "RGBA": ("RGBA", 4)}
+
+def pil_to_array(im: Image.Image) -> np.ndarray:
+    """Copy a decoded PIL image into a new NumPy array exactly once.
+
+    `np.asarray(im)` goes through `im.tobytes()`, which builds the frame from chunks and joins them, so it
+    briefly needs twice the frame size. Instead we let PIL paste directly into memory owned by the array.
+    """
+    if im.mode not in _ARRAY_MODES:
+        return np.asarray(im)
+    mode, bands = _ARRAY_MODES[im.mode]
+    width, height = im.size
+    arr = np.empty((height, width, bands) if bands > 1 else (height, width), dtype=np.uint8)
+    target = Image.frombuffer(mode, im.size, arr, "raw", mode, 0, 1)
+    # frombuffer images are read-only so that PIL never writes to memory it does not own, but writing is the point
+    target.readonly = 0
+    target.paste(im)
+    return arr[..., :3] if im.mode == "RGB" else arr
+
+def decode_array(data: memoryview) -> np.ndarray:
+    """Decode an encoded image (see `PyuscopeHTTPClient.image_encoded`) into an array with a single copy."""
+    with tracing.span("decode.image", "scope", bytes=len(data)), Image.open(_MemoryReader(data)) as im:
+        im.load()
+        return pil_to_array(im)
+
+def stream_base64_field(chunks, size_hint: Optional[int] = None, field: bytes = b'"base64"') -> tuple[bytearray, int]:
+    """Decode the base64 string value of `field` out of a streamed JSON body without ever holding the whole body.
+
+    The decoded bytes go into one buffer that is allocated up front (from `size_hint`, the body length, when we
+    know it), so besides that buffer we only ever hold one chunk. Returns the buffer and how much of it is used.
+    """
+    out = bytearray((size_hint * 3) // 4 + 3 if size_hint else 0)
+    n = 0
+    head = b""
+    carry = b""
+    in_value = False
+    for chunk in chunks:
+        if not in_value:
+            # Look for `"base64": "` (keeping the tail in case the marker is split across chunks)
+            head += chunk
+            start = head.find(field)
+            if start < 0:
+                head = head[-len(field):]
+                continue
+            quote = head.find(b'"', start + len(field))
+            if quote < 0:
+                head = head[start:]
+                continue
+            in_value = True
+            chunk = head[quote + 1:]
+            head = b""
+        end = chunk.find(b'"')
+        data = carry + (chunk if end < 0 else chunk[:end])
+        tail = b""
+        if b"\\" in data:
+            # JSON may escape '/' as '\/', a backslash right at the end of a chunk belongs to the next one
+            if end < 0 and data.endswith(b"\\"):
+                data, tail = data[:-1], b"\\"
+            data = data.replace(b"\\/", b"/")
+        # Only decode whole groups of 4 characters and carry the rest over to the next chunk
+        cut = len(data) if end >= 0 else len(data) - len(data) % 4
+        carry = data[cut:] + tail
+        decoded = binascii.a2b_base64(data[:cut])
+        if n + len(decoded) > len(out):
+            out.extend(bytes(n + len(decoded) - len(out)))
+        out[n:n + len(decoded)] = decoded
+        n += len(decoded)
+        if end >= 0:
+            return out, n
+    raise ValueError(f"Response did not contain a complete {field.decode()} field")
+
+def make_session(retries: int = DEFAULT_RETRIES, backoff: float = DEFAULT_BACKOFF, pool_size: int = 4) -> requests.Session:
+    """A session keeps the TCP connection to the scope alive between calls instead of opening a new one every time.
+
+    Retries (with exponential backoff) only happen when we could not connect at all or the server said it was
+    temporarily unavailable (503, see RETRY_STATUSES). We never retry once the request may have reached the
+    scope: a relative move that gets sent twice moves the stage twice.
+    """
+    retry = Retry(
+        total=retries,
+        connect=retries,
+        read=0,
+        status=retries,
+        backoff_factor=backoff,
+        status_forcelist=RETRY_STATUSES,
+        allowed_methods=frozenset(["GET"]),
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
 
 # TODO(Adriano) write a simple library to let you define your movements in markdown and support robustness.
 class PyuscopeHTTPClient:
     """A class to help you make basic moves of a microscope. This is copied (with only minor modifications) from
     https://github.com/Labsmore/pyuscope/blob/main/examples/web_example.py
+
+    The client keeps track of where the stage is (see position_tracking): `get_position` is answered locally
+    while `position_policy` trusts the last known position, and relative moves are sent as absolute ones.
+    Use `get_position(verify=True)` when you need to know where the stage really is (e.g. if it may have been
+    moved by hand). `settle_tolerance` (mm) is what `wait_until_settled` uses by default for this stage.
     """
-    def __init__(self, host: Optional[str]=None, port: Optional[int]=None, debug: bool = False):
-        if host is None:
-            if "SCOPE_IP" in os.environ:
-                host = os.environ['SCOPE_IP']
-            else:
-                host = "localhost"
-        self.host = host
-        if port is None:
-            if "SCOPE_PORT" in os.environ:
-                port = int(os.environ['SCOPE_PORT'])
-            else:
-                port = 8080
-        self.port = port
-        assert self.port is not None
-        assert self.host is not None
+    def __init__(self, host: Optional[str]=None, port: Optional[int]=None, debug: bool = False, session: Optional[requests.Session] = None, timeouts: Optional[dict[str, float]] = None,
+                 position_policy: Optional[StalenessPolicy] = None, settle_tolerance: float = DEFAULT_SETTLE_TOLERANCE):
+        self.host, self.port = resolve_address(host, port)
         self.base_url = f"http://{self.host}:{self.port}"
 
         # Adds logging
         self.debug = debug
-        
+
+        # One pooled keep-alive session for every call (tile scans make hundreds of these per slide)
+        self.session = make_session() if session is None else session
+        self.timeouts = dict(ENDPOINT_TIMEOUTS)
+        if timeouts is not None:
+            self.timeouts.update(timeouts)
+        self.position = PositionTracker(position_policy)
+        self.settle_tolerance = settle_tolerance
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
 
     def request(self, page: str, query_args: dict[str, str]={}):
-        query_str = ""
-        if len(query_args):
-            query_str = "?" + "&".join(f"{k}={v}"
-                                       for k, v in query_args.items())
-        response = requests.get(self.base_url + page + query_str)
-        response.raise_for_status() # TODO
-        return response.json()
-
-    def get_position(self):
+        with tracing.span("http." + page, "scope", **query_args):
+            response = self.session.get(
+                self.base_url + page,
+                params=query_args,
+                timeout=self.timeouts.get(page, DEFAULT_TIMEOUT),
+            )
+            response.raise_for_status() # TODO
+            return response.json()
+
+    def get_position(self, verify: bool = False) -> dict[str, float]:
+        if not verify:
+            pos = self.position.local()
+            if pos is not None:
+                return dict(pos)
         if self.debug:
             print("DEBUG: GETTING POSITION")
-        ret = self.request("/get/position")
-        pos = ret["data"]
-        for k, v in pos.items():
-            pos[k] = float(v)
+        pos = parse_position(self.request("/get/position"))
+        self.position.confirm(dict(pos))
         return pos
 
+    def _target(self, pos: dict[str, float]) -> Optional[dict[str, float]]:
+        # Where an absolute move to `pos` (which may leave out axes) ends up, None if we can't tell
+        expected = self.position.expected()
+        if expected is not None:
+            return dict(expected, **pos)
+        confirmed = self.position.confirmed
+        if confirmed is not None and set(pos) >= set(confirmed):
+            return dict(pos)
+        return None
+
+    def _move(self, page: str, qargs: dict, target: Optional[dict[str, float]], block: bool):
+        try:
+            self.request(page, qargs)
+        except BaseException:
+            # We don't know if (or how far) it moved
+            self.position.invalidate()
+            raise
+        self.position.moved(target, reached=block)
+
     def move_absolute(self, pos: dict[str, float], block=True):
-        # Positions should be in the format {"x": float, "y": float, etc...}
-        # though any of these keys could also be missing
-        qargs = {"block": int(block)}
-        for k, v in pos.items():
-            qargs["axis." + k] = float(v)
+        qargs = move_query(pos, block)
         if self.debug:
             print(f"DEBUG: MOVE ABSOLUTE WITH {qargs}")
-        # print("move_absolute", qargs)
-        self.request("/run/move_absolute", qargs)
+        self._move("/run/move_absolute", qargs, self._target(pos), block)
 
     def move_relative(self, pos: dict[str, float], block: bool=True):
-        qargs = {"block": int(block)}
-        for k, v in pos.items():
-            qargs["axis." + k] = v
+        # If we know where we are this is just an absolute move, which tells us where we end up (and is safe to
+        # retry). Not while a non-blocking move is still running, relative to what would be ambiguous.
+        current = self.position.local()
+        if current is not None and all(k in current for k in pos):
+            return self.move_absolute({k: current[k] + v for k, v in pos.items()}, block)
+        qargs = move_query(pos, block)
         if self.debug:
             print(f"DEBUG: MOVE RELATIVE WITH {qargs}")
-        self.request("/run/move_relative", qargs)
+        self._move("/run/move_relative", qargs, None, block)
 
     def image(self, wait_imaging_ok: bool=True, raw: bool=False):
         # NOTE that it is also possible to setup an RTSP (https://en.wikipedia.org/wiki/Real-Time_Streaming_Protocol)
         # server but you are going to have to ask the Labsmore guys
         if self.debug:
             print("DEBUG: IMAGE")
-        response = self.request("/get/image", {
-            "wait_imaging_ok": int(wait_imaging_ok),
-            "raw": int(raw)
-        })
-        buf = base64.b64decode(response["data"]["base64"])
-        return Image.open(io.BytesIO(buf))
+        return decode_image(self.request("/get/image", image_query(wait_imaging_ok, raw)))
+
+    def wait_until_settled(self, target: Optional[dict[str, float]] = None, tolerance: Optional[float] = None,
+                           stable_reads: int = 2, interval: float = 0.005, timeout: Optional[float] = None) -> dict[str, float]:
+        """Poll the stage position until it is within `tolerance` (mm, on every axis, by default the client's
+        `settle_tolerance`) of `target` (by default where the last move was headed) and has not moved by more
+        than that for `stable_reads` reads in a row. Returns the settled position. Use this after non-blocking
+        moves instead of sleeping for a fixed time.
+        """
+        target = self.position.commanded if target is None else target
+        tolerance = self.settle_tolerance if tolerance is None else tolerance
+        timeout = self.timeouts.get("/run/move_absolute", DEFAULT_TIMEOUT) if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        last = None
+        stable = 0
+        with tracing.span("scope.settle", "scope"):
+            while True:
+                pos = self.get_position(verify=True)
+                near = target is None or all(abs(pos[k] - v) <= tolerance for k, v in target.items() if k in pos)
+                still = last is None or all(abs(pos[k] - last[k]) <= tolerance for k in pos if k in last)
+                stable = stable + 1 if near and still else (1 if near else 0)
+                if stable >= stable_reads:
+                    self.position.reached_target()
+                    return pos
+                if time.monotonic() > deadline:
+                    raise TimeoutError(f"Stage did not settle at {target} within {timeout}s, last at {pos}")
+                last = pos
+                time.sleep(interval)
+
+    def image_encoded(self, wait_imaging_ok: bool=True, raw: bool=False) -> memoryview:
+        """The frame as the scope sent it (the encoded image, or the raw buffer with `raw=True`) without decoding
+        it, see `image_array`. Decode it later with `decode_array`, e.g. while the stage is already on its way to
+        the next field.
+        """
+        page = "/get/image"
+        query = image_query(wait_imaging_ok, raw)
+        with tracing.span("http." + page, "scope", stream=1, **query), self.session.get(
+            self.base_url + page,
+            params=query,
+            timeout=self.timeouts.get(page, DEFAULT_TIMEOUT),
+            stream=True,
+        ) as response:
+            response.raise_for_status()
+            size_hint = response.headers.get("Content-Length")
+            buf, n = stream_base64_field(
+                response.iter_content(IMAGE_CHUNK_SIZE),
+                size_hint=int(size_hint) if size_hint is not None else None,
+            )
+        return memoryview(buf)[:n]
+
+    def image_array(self, wait_imaging_ok: bool=True, raw: bool=False) -> np.ndarray:
+        """Like `image` but returns a NumPy array and keeps copies of the frame to a minimum (the Jetson does not
+        have a lot of memory). The response is streamed and its base64 is decoded chunk by chunk into one
+        preallocated buffer.
+
+        With `raw=True` the result is a flat uint8 array that is a view of that buffer (no copy at all), with
+        `raw=False` the encoded image is decoded by PIL straight out of the buffer and copied once into the array
+        (RGB frames come back as a view with a 4th padding byte per pixel, see `pil_to_array`).
+        """
+        if self.debug:
+            print("DEBUG: IMAGE ARRAY")
+        data = self.image_encoded(wait_imaging_ok, raw)
+        if raw:
+            return np.frombuffer(data, dtype=np.uint8)
+        return decode_array(data)
 
 
 def main():
@@ -0,0 +1,107 @@
+"""Client-side position tracking so that reading the position does not need a round trip to the hardware.
+
+The clients (`PyuscopeHTTPClient`, `PA3400`) tell their tracker about every move they command and every
+position they read back, and serve position reads from it as long as the `StalenessPolicy` says the last
+known position can still be trusted. Anything that makes the position uncertain (a failed or timed out move,
+a move we can not resolve to a target, a non-blocking move that is still running) makes the next read go to
+the hardware again.
+"""
+from __future__ import annotations
+
+import threading
+import time
+from typing import Optional
+
+class StalenessPolicy:
+    """When to stop trusting the tracked position and read it from the hardware again.
+
+    `max_age` is how long (seconds) the last contact that told us where we are (a position read or a finished
+    blocking move) is good for, None means forever. `max_moves` is how many moves we trust without reading the
+    position back, None means any number. Use `StalenessPolicy.always_verify()` to never serve reads locally.
+    """
+    def __init__(self, max_age: Optional[float] = 60.0, max_moves: Optional[int] = None):
+        self.max_age = max_age
+        self.max_moves = max_moves
+
+    @classmethod
+    def always_verify(cls) -> "StalenessPolicy":
+        return cls(max_age=0.0, max_moves=0)
+
+    def fresh(self, age: float, moves: int) -> bool:
+        return (self.max_age is None or age <= self.max_age) and (self.max_moves is None or moves <= self.max_moves)
+
+
+class PositionTracker:
+    """The last commanded and the last confirmed (read back) position of one device. Positions are whatever
+    the client uses (a dict of stage axes, a list of arm coordinates) and are never modified, so they are
+    copied on the way in and out by the clients.
+    """
+    def __init__(self, policy: Optional[StalenessPolicy] = None):
+        self.policy = StalenessPolicy() if policy is None else policy
+        self._lock = threading.Lock()
+        # Where we last told the device to go and where it last said it was
+        self.commanded = None
+        self.confirmed = None
+        # Best knowledge of where the device is now (None if we don't know)
+        self._known = None
+        self._in_motion = False
+        self._updated_at = 0.0
+        self._moves_since_confirmed = 0
+        # Reads served locally / from the hardware, to see what this saves
+        self.local_reads = 0
+        self.remote_reads = 0
+
+    def moved(self, target, reached: bool = True):
+        """A move to `target` was commanded (None if we can not tell where it goes). `reached` means the move
+        finished (a blocking move), otherwise the device is on its way until `reached_target` is called.
+        """
+        with self._lock:
+            self.commanded = target
+            self._known = target
+            self._in_motion = not reached
+            self._moves_since_confirmed += 1
+            if reached:
+                self._updated_at = time.monotonic()
+
+    def reached_target(self):
+        """The last (non-blocking) move is done."""
+        with self._lock:
+            self._in_motion = False
+            self._updated_at = time.monotonic()
+
+    def confirm(self, pos):
+        """The device said it is at `pos`."""
+        with self._lock:
+            self.confirmed = pos
+            # A read while a non-blocking move is running is just somewhere along the way, we are still
+            # headed for (and the next move starts from) the target
+            if self._in_motion and pos == self.commanded:
+                self._in_motion = False
+            if not self._in_motion:
+                self._known = pos
+            self._updated_at = time.monotonic()
+            self._moves_since_confirmed = 0
+            self.remote_reads += 1
+
+    def invalidate(self):
+        with self._lock:
+            self._known = None
+
+    def expected(self):
+        """Where the device is, or is going to if a move is running, if the policy still trusts that. For
+        working out the target of the next move, so it does not count as a read.
+        """
+        with self._lock:
+            if self._known is None or not self.policy.fresh(time.monotonic() - self._updated_at, self._moves_since_confirmed):
+                return None
+            return self._known
+
+    def local(self):
+        """The position if it can be served without asking the device, None if it has to be read."""
+        with self._lock:
+            if self._known is None or self._in_motion:
+                return None
+            if not self.policy.fresh(time.monotonic() - self._updated_at, self._moves_since_confirmed):
+                return None
+            self.local_reads += 1
+            return self._known
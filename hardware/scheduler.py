@@ -0,0 +1,132 @@
+from __future__ import annotations
+
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Callable, Iterable, Optional
+
+import tracing
+
+# Resources that steps can lock. A step only runs once every resource it needs is free, so the
+# arm can work on the next slide while the scope is busy with the current one.
+ARM = "arm"
+SCOPE = "scope"
+# The area right above/around the stage: the arm reaching in and the stage moving must never overlap
+STAGE_AREA = "scope stage area"
+
+
+def phase(name: str) -> str:
+    """The kind of step, e.g. `fetch` for `fetch-3`."""
+    return re.sub(r"-\d+$", "", name)
+
+
+class Step:
+    """One node of the instruction DAG.
+
+    `fn` is called with no arguments, `resources` are held for the whole duration of the call and
+    `after` lists the names of the steps that must have finished before this one may start.
+    """
+    def __init__(self, name: str, fn: Callable[[], object], resources: Iterable[str], after: Iterable[str] = (), actor: Optional[str] = None, slide: Optional[int] = None):
+        self.name = name
+        self.fn = fn
+        self.resources = frozenset(resources)
+        self.after = tuple(after)
+        self.actor = actor
+        self.slide = slide
+        # Filled in when run (seconds, relative to the start of the run)
+        self.start: Optional[float] = None
+        self.end: Optional[float] = None
+
+    def __repr__(self) -> str:
+        return f"Step({self.name!r}, resources={sorted(self.resources)}, after={list(self.after)})"
+
+
+class Scheduler:
+    """Runs a DAG of steps, starting every step as soon as its dependencies are done and its resources
+    are free. Steps are considered in the order they were added so that ties are broken the same way
+    the old linear `INSTR_SEQUENCE` would have.
+    """
+    def __init__(self, max_workers: int = 4, debug: bool = False):
+        self.max_workers = max_workers
+        self.debug = debug
+        self.steps: dict[str, Step] = {}
+
+    def add(self, name: str, fn: Callable[[], object], resources: Iterable[str], after: Iterable[str] = (), actor: Optional[str] = None, slide: Optional[int] = None) -> Step:
+        if name in self.steps:
+            raise ValueError(f"Duplicate step name: {name}")
+        for dep in after:
+            # Only allowing backwards references means the graph is acyclic by construction
+            if dep not in self.steps:
+                raise ValueError(f"Step {name} depends on unknown (or later) step {dep}")
+        step = Step(name, fn, resources, after=after, actor=actor, slide=slide)
+        self.steps[name] = step
+        return step
+
+    def _ready(self, done: set[str], running: set[str], held: set[str]) -> list[Step]:
+        ready = []
+        claimed = set(held)
+        for step in self.steps.values():
+            if step.name in done or step.name in running:
+                continue
+            if not all(dep in done for dep in step.after):
+                continue
+            if step.resources & claimed:
+                continue
+            claimed |= step.resources
+            ready.append(step)
+        return ready
+
+    def run(self) -> float:
+        """Run every step. Returns the total wall-clock time in seconds. If a step raises, no new steps
+        are started, the ones in flight are allowed to finish and the first error is re-raised.
+        """
+        done: set[str] = set()
+        running: set[str] = set()
+        held: set[str] = set()
+        futures = {}
+        error: Optional[BaseException] = None
+        t0 = time.monotonic()
+
+        def _call(step: Step):
+            step.start = time.monotonic() - t0
+            # Everything the analyzer (critical_path.py) needs to rebuild the DAG goes into the trace
+            span = tracing.span("step." + phase(step.name), step.actor or "cell", name=step.name, slide=step.slide,
+                                after=list(step.after), resources=sorted(step.resources))
+            try:
+                with span:
+                    return step.fn()
+            finally:
+                step.end = time.monotonic() - t0
+
+        with tracing.span("schedule.run", "cell", steps=len(self.steps)), ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            while len(done) < len(self.steps):
+                if error is None:
+                    for step in self._ready(done, running, held):
+                        if self.debug:
+                            print(f"(debug) [{time.monotonic() - t0:8.2f}s] starting {step.name}")
+                        running.add(step.name)
+                        held |= step.resources
+                        futures[pool.submit(_call, step)] = step
+                if not futures:
+                    if error is not None:
+                        break
+                    pending = [name for name in self.steps if name not in done]
+                    raise RuntimeError(f"Scheduler is stuck, nothing can run. Pending: {pending}")
+                finished, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for fut in finished:
+                    step = futures.pop(fut)
+                    running.discard(step.name)
+                    held -= step.resources
+                    done.add(step.name)
+                    if self.debug:
+                        print(f"(debug) [{time.monotonic() - t0:8.2f}s] finished {step.name}")
+                    exc = fut.exception()
+                    if exc is not None and error is None:
+                        error = exc
+        if error is not None:
+            raise error
+        return time.monotonic() - t0
+
+    def timeline(self) -> list[Step]:
+        """Steps that ran, sorted by start time (useful for printing where the time went)."""
+        return sorted((s for s in self.steps.values() if s.start is not None), key=lambda s: s.start)
@@ -0,0 +1,6 @@
+import sys
+from pathlib import Path
+
+# The hardware modules import each other by file name, put their folders on the path like main.py does
+_HARDWARE_DIR = Path(__file__).resolve().parent.parent
+sys.path.extend([_HARDWARE_DIR.as_posix(), (_HARDWARE_DIR / "arm").as_posix(), (_HARDWARE_DIR / "microscope").as_posix()])
@@ -0,0 +1,91 @@
+import math
+
+import numpy as np
+import pytest
+
+from gcode import ARC, LINEAR, RAPID, arc_points, read_blocks, tokenize
+
+
+def test_tokenize():
+    assert tokenize("g1 x10 Y-2.5 z.5 (cut) ; the rest") == [("G", 1.0), ("X", 10.0), ("Y", -2.5), ("Z", 0.5)]
+    assert tokenize("G0X1Y+2") == [("G", 0.0), ("X", 1.0), ("Y", 2.0)]
+    assert tokenize("(only a comment)") == []
+
+
+def test_modal_state():
+    blocks = list(read_blocks(["G21 G90", "G0 X10", "Y5", "G1 Z-1", "G91 X1 Y1", "G20 X1", "G90 G21 X0 Y0 Z0"]))
+    assert [b.kind for b in blocks] == [RAPID, RAPID, LINEAR, LINEAR, LINEAR, LINEAR]
+    assert [b.end for b in blocks] == [[10, 0, 0], [10, 5, 0], [10, 5, -1], [11, 6, -1], [36.4, 6, -1], [0, 0, 0]]
+    # Every block starts where the one before ended
+    assert all(a.end == b.start for a, b in zip(blocks, blocks[1:]))
+    assert [b.line for b in blocks] == [2, 3, 4, 5, 6, 7]
+
+
+def test_start_position_and_neutral_codes():
+    blocks = list(read_blocks(["G17 G40 G54 G1 X1", "G4 P0.5", "G92"], start=[1, 2, 3, 0, 0, 0]))
+    assert len(blocks) == 1
+    assert blocks[0].start == [1, 2, 3] and blocks[0].end == [1, 2, 3]
+
+
+@pytest.mark.parametrize("program", [["G1 X10 Y10", "G92 X0 Y0"], ["G28 X0"], ["G28"], ["G53 G0 Z0"],
+                                     ["G10 L2 P1 X0"], ["G81 X1 Y1 Z-1 R1"]])
+def test_unsupported_g_codes(program):
+    with pytest.raises(ValueError, match=f"line {len(program)}"):
+        list(read_blocks(program))
+
+
+def test_ij_arc():
+    (block,) = read_blocks(["G3 X0 Y10 I0 J5"])
+    assert block.kind == ARC and not block.clockwise
+    assert block.center == [0, 5, 0]
+
+
+def test_r_arc():
+    (half,) = read_blocks(["G2 X20 Y0 R10"])
+    assert half.center == pytest.approx([10, 0, 0])
+    # Positive R is the short way round, negative the long way: the centers are mirrored over the chord
+    (short,) = read_blocks(["G2 X10 Y0 R10"])
+    (long,) = read_blocks(["G2 X10 Y0 R-10"])
+    assert short.center == pytest.approx([5, -math.sqrt(75), 0])
+    assert long.center == pytest.approx([5, math.sqrt(75), 0])
+    (ccw,) = read_blocks(["G3 X10 Y0 R10"])
+    assert ccw.center == pytest.approx([5, math.sqrt(75), 0])
+    with pytest.raises(ValueError, match="line 1"):
+        list(read_blocks(["G2 X10 Y0 R1"]))
+    with pytest.raises(ValueError, match="line 1"):
+        list(read_blocks(["G2 X0 Y0 R1"]))
+
+
+def test_arc_outside_xy_plane():
+    with pytest.raises(ValueError, match="line 2"):
+        list(read_blocks(["G18", "G2 X1 I1"]))
+
+
+def _arcs(*arcs):
+    starts, ends, centers, clockwise = zip(*arcs)
+    return (np.array(starts, dtype=float), np.array(ends, dtype=float), np.array(centers, dtype=float),
+            np.array(clockwise, dtype=bool))
+
+
+def test_arc_points_stay_on_the_arc():
+    tolerance = 0.01
+    (points,) = arc_points(*_arcs(([10, 0, 0], [0, 10, 2], [0, 0, 0], False)), tolerance=tolerance)
+    assert points[-1] == pytest.approx([0, 10, 2])
+    assert np.hypot(points[:, 0], points[:, 1]) == pytest.approx(10)
+    # Counterclockwise from (10, 0) to (0, 10) stays in the first quadrant, Z goes up evenly
+    assert (points[:, :2] >= -1e-9).all()
+    assert np.all(np.diff(points[:, 2]) > 0)
+    # Chords within the tolerance: the angle between points is at most 2 acos(1 - tolerance / r)
+    angles = np.unwrap(np.arctan2(points[:, 1], points[:, 0]))
+    assert np.diff(np.concatenate([[0.0], angles])).max() <= 2 * math.acos(1 - tolerance / 10) + 1e-9
+
+
+def test_arc_points_direction_and_full_circle():
+    clockwise, circle = arc_points(*_arcs(([10, 0, 0], [0, 10, 0], [0, 0, 0], True),
+                                          ([1, 0, 0], [1, 0, 0], [0, 0, 0], False)))
+    # Clockwise from (10, 0) to (0, 10) is three quarters of a turn through the other quadrants
+    assert clockwise[len(clockwise) // 3][1] < 0
+    assert clockwise[-1] == pytest.approx([0, 10, 0])
+    assert circle[-1] == pytest.approx([1, 0, 0])
+    assert circle[:, 0].min() == pytest.approx(-1, abs=1e-3)
+    assert arc_points(*(np.empty((0, 3)),) * 3, np.empty(0, dtype=bool)) == []
@@ -0,0 +1,46 @@
+import time
+
+import pytest
+
+from fake_pyuscope import FakeScope, serve_in_background
+from position_tracking import PositionTracker
+from web_example import PyuscopeHTTPClient
+
+
+def test_read_during_move_keeps_target():
+    tracker = PositionTracker()
+    tracker.moved({"x": 5.0}, reached=False)
+    tracker.confirm({"x": 0.97})
+    assert tracker.confirmed == {"x": 0.97}
+    assert tracker.expected() == {"x": 5.0}
+    assert tracker.local() is None
+    tracker.reached_target()
+    assert tracker.local() == {"x": 5.0}
+
+
+def test_read_at_target_ends_move():
+    tracker = PositionTracker()
+    tracker.moved({"x": 5.0}, reached=False)
+    tracker.confirm({"x": 5.0})
+    assert tracker.local() == {"x": 5.0}
+
+
+@pytest.fixture
+def scope_client():
+    server = serve_in_background(scope=FakeScope(stage_speed=10.0, stage_accel=100.0))
+    client = PyuscopeHTTPClient(host="127.0.0.1", port=server.server_port)
+    yield client
+    client.close()
+    server.shutdown()
+
+
+def test_partial_move_after_read_during_move(scope_client):
+    scope_client.move_absolute({"x": 0.0, "y": 0.0, "z": 0.0})
+    scope_client.move_absolute({"x": 5.0, "y": 0.0, "z": 0.0}, block=False)
+    time.sleep(0.1)
+    partway = scope_client.get_position(verify=True)
+    assert 0.0 < partway["x"] < 5.0
+    # Only moves z, the tracker has to fill in x from where the last move was headed
+    scope_client.move_absolute({"z": 0.5})
+    assert scope_client.get_position() == pytest.approx(scope_client.get_position(verify=True))
+    assert scope_client.get_position()["x"] == pytest.approx(5.0)
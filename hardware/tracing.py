@@ -0,0 +1,244 @@
+"""Low overhead latency tracing for the hot paths (GPL commands, gripper actions, scope HTTP requests, image
+decodes and saves).
+
+Every traced call becomes a span: its kind (e.g. "gpl.movec" or "http./get/image"), the actor that did it,
+start/end timestamps and its arguments. Span durations always go into per-kind histograms (`summary()` gives
+p50/p95/p99); if a trace file is configured spans are also written to it as JSON lines, rotated like
+`logging.handlers.RotatingFileHandler` does. Recording a span only takes the clock twice and puts a tuple on
+a queue, the JSON encoding and file writing happen on a background thread, so this can stay on in production.
+
+Use `configure(path)` (or set the HARDWARE_TRACE environment variable to a file name) to write a trace and
+`span(kind, actor, **args)` as a context manager to record one:
+
+    with tracing.span("gpl.movec", "arm", cmd=cmd):
+        ...
+"""
+from __future__ import annotations
+
+import atexit
+import json
+import math
+import os
+import queue
+import threading
+import time
+from pathlib import Path
+from typing import Optional, Union
+
+DEFAULT_MAX_BYTES = 16 * 1024 * 1024
+DEFAULT_BACKUPS = 3
+
+class Histogram:
+    """Durations in logarithmic buckets (8 per factor of 2, so percentiles are within ~5%) from 1us up. Constant
+    memory no matter how many samples go in.
+    """
+    BUCKETS_PER_OCTAVE = 8
+    MIN = 1e-6
+
+    def __init__(self):
+        self.counts: dict[int, int] = {}
+        self.n = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds: float):
+        b = 0 if seconds <= self.MIN else int(math.log2(seconds / self.MIN) * self.BUCKETS_PER_OCTAVE) + 1
+        self.counts[b] = self.counts.get(b, 0) + 1
+        self.n += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def _bucket_value(self, b: int) -> float:
+        if b == 0:
+            return self.MIN
+        # Geometric middle of the bucket
+        return self.MIN * 2 ** ((b - 0.5) / self.BUCKETS_PER_OCTAVE)
+
+    def percentile(self, p: float) -> float:
+        if self.n == 0:
+            return 0.0
+        rank = p / 100 * self.n
+        seen = 0
+        for b in sorted(self.counts):
+            seen += self.counts[b]
+            if seen >= rank:
+                return min(self._bucket_value(b), self.max)
+        return self.max
+
+    def summary(self) -> dict[str, float]:
+        return {
+            "count": self.n,
+            "mean": self.total / self.n if self.n else 0.0,
+            "p50": self.percentile(50),
+            "p95": self.percentile(95),
+            "p99": self.percentile(99),
+            "max": self.max,
+        }
+
+
+class _Span:
+    __slots__ = ("tracer", "kind", "actor", "args", "start", "t0")
+
+    def __init__(self, tracer: "Tracer", kind: str, actor: str, args: dict):
+        self.tracer = tracer
+        self.kind = kind
+        self.actor = actor
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.time()
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        duration = time.perf_counter() - self.t0
+        if exc_type is not None:
+            self.args["error"] = exc_type.__name__
+        self.tracer.record(self.kind, self.actor, self.start, duration, self.args)
+        return False
+
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NULL_SPAN = _NullSpan()
+
+
+class Tracer:
+    """Collects spans into histograms and (if `path` is set) a rotating JSONL trace. Lines look like
+    `{"kind": ..., "actor": ..., "start": <unix time>, "end": <unix time>, "duration": <s>, "thread": ..., "args": {...}}`.
+    """
+    def __init__(self, path: Optional[Union[str, Path]] = None, max_bytes: int = DEFAULT_MAX_BYTES, backups: int = DEFAULT_BACKUPS,
+                 enabled: bool = True):
+        self.enabled = enabled
+        self.path = Path(path) if path is not None else None
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.histograms: dict[str, Histogram] = {}
+        self._lock = threading.Lock()
+        self._queue: Optional[queue.SimpleQueue] = None
+        self._writer: Optional[threading.Thread] = None
+        self._file = None
+        if self.path is not None:
+            self._queue = queue.SimpleQueue()
+            self._writer = threading.Thread(target=self._write_loop, name="trace-writer", daemon=True)
+            self._writer.start()
+
+    def span(self, kind: str, actor: str, **args):
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, kind, actor, args)
+
+    def record(self, kind: str, actor: str, start: float, duration: float, args: Optional[dict] = None):
+        """Record a span that was timed elsewhere (`start` is unix time, `duration` seconds)."""
+        if not self.enabled:
+            return
+        with self._lock:
+            hist = self.histograms.get(kind)
+            if hist is None:
+                hist = self.histograms[kind] = Histogram()
+            hist.add(duration)
+        if self._queue is not None:
+            self._queue.put((kind, actor, start, duration, threading.current_thread().name, args))
+
+    def _open(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._file = open(self.path, "a", buffering=64 * 1024)
+
+    def _rotate(self):
+        self._file.close()
+        for i in range(self.backups - 1, 0, -1):
+            older = self.path.with_name(f"{self.path.name}.{i}")
+            if older.exists():
+                os.replace(older, self.path.with_name(f"{self.path.name}.{i + 1}"))
+        if self.backups > 0:
+            os.replace(self.path, self.path.with_name(f"{self.path.name}.1"))
+        else:
+            self.path.unlink()
+        self._open()
+
+    def _write_loop(self):
+        self._open()
+        while True:
+            item = self._queue.get()
+            if isinstance(item, threading.Event):
+                # A flush (or close) request, everything before it is written now
+                self._file.flush()
+                item.set()
+                continue
+            if item is None:
+                self._file.close()
+                return
+            kind, actor, start, duration, thread, args = item
+            line = json.dumps({"kind": kind, "actor": actor, "start": start, "end": start + duration, "duration": duration,
+                               "thread": thread, "args": args}, default=str)
+            self._file.write(line + "\n")
+            if self._file.tell() >= self.max_bytes:
+                self._rotate()
+
+    def flush(self, timeout: float = 5.0):
+        """Wait until every span recorded so far is in the trace file."""
+        if self._queue is None:
+            return
+        done = threading.Event()
+        self._queue.put(done)
+        done.wait(timeout)
+
+    def close(self):
+        if self._queue is None:
+            return
+        self.flush()
+        self._queue.put(None)
+        self._writer.join(timeout=5.0)
+        self._queue = None
+
+    def summary(self) -> dict[str, dict[str, float]]:
+        with self._lock:
+            return {kind: hist.summary() for kind, hist in sorted(self.histograms.items())}
+
+    def format_summary(self) -> str:
+        """One line per kind, times in ms."""
+        lines = [f"{'kind':<28} {'count':>7} {'mean':>9} {'p50':>9} {'p95':>9} {'p99':>9} {'max':>9}"]
+        for kind, s in self.summary().items():
+            ms = " ".join(f"{s[k] * 1000:9.3f}" for k in ("mean", "p50", "p95", "p99", "max"))
+            lines.append(f"{kind:<28} {s['count']:>7} {ms}")
+        return "\n".join(lines)
+
+    def reset(self):
+        with self._lock:
+            self.histograms = {}
+
+
+# The process wide tracer used by the hardware modules
+_tracer = Tracer(os.environ.get("HARDWARE_TRACE") or None)
+
+def configure(path: Optional[Union[str, Path]] = None, max_bytes: int = DEFAULT_MAX_BYTES, backups: int = DEFAULT_BACKUPS,
+              enabled: bool = True) -> Tracer:
+    """Replace the process wide tracer, e.g. to start writing a trace file."""
+    global _tracer
+    old = _tracer
+    _tracer = Tracer(path, max_bytes, backups, enabled)
+    old.close()
+    return _tracer
+
+def tracer() -> Tracer:
+    return _tracer
+
+def span(kind: str, actor: str, **args):
+    return _tracer.span(kind, actor, **args)
+
+def record(kind: str, actor: str, start: float, duration: float, args: Optional[dict] = None):
+    _tracer.record(kind, actor, start, duration, args)
+
+def summary() -> dict[str, dict[str, float]]:
+    return _tracer.summary()
+
+def format_summary() -> str:
+    return _tracer.format_summary()
+
+atexit.register(lambda: _tracer.close())
@@ -0,0 +1,530 @@
+#!/usr/bin/env python3
+"""Uploads the images the scopes save to the `online` storage service, in the background, while the cell runs.
+
+The uploader polls the image output folder (recursively). A file is uploaded once it has not been modified
+for `min_age` seconds, so we never send a frame the writer is still writing. Uploading works like this:
+- Every file is identified by the sha256 of its content. Files with the same content as something already
+  uploaded (by us, see the manifest, or by anyone, the server is asked which hashes it is missing) are not
+  sent again.
+- The rest go in batches (up to `batch_files` files / `batch_bytes` bytes) as one multipart POST each, over a
+  small pool of keep-alive connections (`max_connections` batches in flight). Failed batches are retried with
+  exponential backoff. Uploads are keyed by hash, so sending one twice is harmless.
+- Every file the server has is appended to a local manifest (JSON lines of path, size, mtime and hash). On
+  restart the manifest is read back and only files that are new or changed since are looked at again.
+- Uploads are throttled by a token bucket (`rate` bytes/s). While the scopes are acquiring (a new image showed
+  up in the last `quiet_time` seconds, or `busy()` says so) the rate drops to `busy_rate` (0: no new requests
+  are started until acquisition is over), so the uploads never compete with the scope traffic on the Jetson's
+  link.
+
+The storage API is `POST /api/images/missing` (`{"sha256": [...]}` -> `{"missing": [...]}`) and
+`POST /api/images` (multipart: a JSON `manifest` part, then the files), see `fake_storage.py` for a local
+stand-in.
+
+Run with python3 uploader.py images/ --url http://host:port [--once] to upload a folder, or
+python3 uploader.py --fake to try it (and a restart) against the local stand-in.
+"""
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, Iterator, Optional, Union
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import tracing
+
+DEFAULT_MANIFEST_NAME = ".upload_manifest.jsonl"
+DEFAULT_SUFFIXES = (".jpg", ".jpeg", ".png", ".tif", ".tiff")
+DEFAULT_BATCH_FILES = 32
+DEFAULT_BATCH_BYTES = 64 * 1024 * 1024
+DEFAULT_MAX_CONNECTIONS = 2
+# Bytes/s, normally and while the scopes are acquiring
+DEFAULT_RATE = 20 * 1024 * 1024
+DEFAULT_BUSY_RATE = 0
+# Seconds since the last new image after which we assume acquisition is over
+DEFAULT_QUIET_TIME = 5.0
+# Files modified less than this many seconds ago may still be being written
+DEFAULT_MIN_AGE = 1.0
+DEFAULT_POLL_INTERVAL = 2.0
+DEFAULT_RETRIES = 5
+DEFAULT_BACKOFF = 0.5
+DEFAULT_TIMEOUT = 60.0
+CHUNK_SIZE = 256 * 1024
+# How many hashes to ask the server about at once
+MISSING_QUERY_SIZE = 1000
+
+def file_sha256(path: Union[str, Path]) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(1024 * 1024):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class Manifest:
+    """The files the server is known to have, as an append-only JSON lines file (one line per file, the last
+    line for a path wins), so a crash loses at most the line being written.
+    """
+    def __init__(self, path: Union[str, Path]):
+        self.path = Path(path)
+        self.lock = threading.Lock()
+        # relative path -> (size, mtime_ns, sha256)
+        self.files: dict[str, tuple[int, int, str]] = {}
+        self.hashes: set[str] = set()
+        n_lines = 0
+        if self.path.exists():
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # A line cut short by a crash
+                        continue
+                    n_lines += 1
+                    self.files[entry["path"]] = (entry["size"], entry["mtime_ns"], entry["sha256"])
+            self.hashes = {sha for _, _, sha in self.files.values()}
+        if n_lines > len(self.files):
+            self.compact()
+        self._f = open(self.path, "a")
+
+    def is_current(self, name: str, size: int, mtime_ns: int) -> bool:
+        known = self.files.get(name)
+        return known is not None and known[:2] == (size, mtime_ns)
+
+    def add(self, entries: list[tuple[str, int, int, str]]):
+        """Record (relative path, size, mtime_ns, sha256) entries the server has."""
+        with self.lock:
+            for name, size, mtime_ns, sha in entries:
+                self.files[name] = (size, mtime_ns, sha)
+                self.hashes.add(sha)
+                self._f.write(json.dumps({"path": name, "size": size, "mtime_ns": mtime_ns, "sha256": sha}) + "\n")
+            self._f.flush()
+
+    def compact(self):
+        """Rewrite the file with one line per path."""
+        tmp = self.path.with_name(self.path.name + ".tmp")
+        with open(tmp, "w") as f:
+            for name, (size, mtime_ns, sha) in self.files.items():
+                f.write(json.dumps({"path": name, "size": size, "mtime_ns": mtime_ns, "sha256": sha}) + "\n")
+        os.replace(tmp, self.path)
+
+    def close(self):
+        self._f.close()
+
+
+class RateLimiter:
+    """A token bucket shared by every upload. `rate()` is asked for the current rate (bytes/s) every time, so
+    it can change while an upload is running. A rate of 0 pauses the uploads, but only between requests (see
+    `wait_until_open`): a request that is already being sent is finished unthrottled rather than left hanging
+    half way until the server times it out.
+    """
+    def __init__(self, rate: Callable[[], float], burst: int = CHUNK_SIZE):
+        self.rate = rate
+        self.burst = burst
+        self.lock = threading.Lock()
+        self.tokens = float(burst)
+        self.last = time.monotonic()
+        self.waited = 0.0
+
+    def wait_until_open(self):
+        """Block while the rate is 0, before starting a request."""
+        t0 = time.monotonic()
+        while self.rate() <= 0:
+            time.sleep(0.05)
+        with self.lock:
+            self.waited += time.monotonic() - t0
+
+    def acquire(self, n: int):
+        t0 = time.monotonic()
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                rate = self.rate()
+                self.tokens = min(self.burst, self.tokens + (now - self.last) * rate)
+                self.last = now
+                if rate <= 0:
+                    break
+                if self.tokens >= n or self.tokens >= self.burst:
+                    self.tokens -= n
+                    break
+                wait = (n - self.tokens) / rate
+            time.sleep(min(wait, 0.05))
+        with self.lock:
+            self.waited += time.monotonic() - t0
+
+
+class MultipartBody:
+    """A multipart/form-data body streamed from the files, through the rate limiter. It has a length so requests
+    sends a Content-Length instead of chunking, and http.client reads it with `read`.
+    """
+    def __init__(self, manifest: list[dict], paths: list[Path], limiter: Optional[RateLimiter] = None):
+        self.boundary = uuid.uuid4().hex
+        self.limiter = limiter
+        self.parts: list[Union[bytes, Path]] = [self._header("manifest", "manifest.json", "application/json"),
+                                                 json.dumps(manifest).encode(), b"\r\n"]
+        for entry, path in zip(manifest, paths):
+            self.parts += [self._header(entry["sha256"], entry["name"], "application/octet-stream"), path, b"\r\n"]
+        self.parts.append(f"--{self.boundary}--\r\n".encode())
+        self.length = sum(len(p) if isinstance(p, bytes) else p.stat().st_size for p in self.parts)
+        self._chunks = self._iter_chunks()
+        self._pending = b""
+
+    @property
+    def content_type(self) -> str:
+        return f"multipart/form-data; boundary={self.boundary}"
+
+    def _header(self, field: str, filename: str, content_type: str) -> bytes:
+        return (f'--{self.boundary}\r\nContent-Disposition: form-data; name="{field}"; filename="{filename}"\r\n'
+                f"Content-Type: {content_type}\r\n\r\n").encode()
+
+    def _iter_chunks(self) -> Iterator[bytes]:
+        for part in self.parts:
+            if isinstance(part, bytes):
+                yield part
+                continue
+            with open(part, "rb") as f:
+                while chunk := f.read(CHUNK_SIZE):
+                    yield chunk
+
+    def __len__(self) -> int:
+        return self.length
+
+    def read(self, size: int = -1) -> bytes:
+        while not self._pending:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                return b""
+            self._pending = chunk
+        n = len(self._pending) if size is None or size < 0 else min(size, len(self._pending))
+        data, self._pending = self._pending[:n], self._pending[n:]
+        if self.limiter is not None:
+            self.limiter.acquire(len(data))
+        return data
+
+
+class UploadStats:
+    def __init__(self):
+        self.uploaded = 0
+        self.deduplicated = 0
+        self.bytes = 0
+        self.batches = 0
+        self.retries = 0
+        self.failed = 0
+        self.elapsed = 0.0
+        self.throttled = 0.0
+
+    def __str__(self) -> str:
+        rate = self.bytes / self.elapsed / 1e6 if self.elapsed else 0.0
+        return (f"{self.uploaded} files uploaded ({self.bytes / 1e6:.1f}MB in {self.batches} batches, {rate:.1f}MB/s), "
+                f"{self.deduplicated} already on the server, {self.retries} retries, {self.failed} failed, "
+                f"{self.throttled:.2f}s waiting for the rate limit (all connections) in {self.elapsed:.2f}s")
+
+
+class _File:
+    def __init__(self, name: str, path: Path, size: int, mtime_ns: int):
+        self.name = name
+        self.path = path
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.sha256 = ""
+
+    def entry(self) -> tuple[str, int, int, str]:
+        return self.name, self.size, self.mtime_ns, self.sha256
+
+
+class Uploader:
+    """Uploads the images under `root` to the storage service at `url`, see the module docstring. Use `sync()`
+    to upload what is there now or `run()` to keep watching the folder.
+    """
+    def __init__(self, root: Union[str, Path], url: str, manifest: Optional[Union[str, Path]] = None,
+                 suffixes: tuple[str, ...] = DEFAULT_SUFFIXES, batch_files: int = DEFAULT_BATCH_FILES,
+                 batch_bytes: int = DEFAULT_BATCH_BYTES, max_connections: int = DEFAULT_MAX_CONNECTIONS,
+                 rate: float = DEFAULT_RATE, busy_rate: float = DEFAULT_BUSY_RATE, quiet_time: float = DEFAULT_QUIET_TIME,
+                 busy: Optional[Callable[[], bool]] = None, min_age: float = DEFAULT_MIN_AGE,
+                 retries: int = DEFAULT_RETRIES, backoff: float = DEFAULT_BACKOFF, timeout: float = DEFAULT_TIMEOUT):
+        self.root = Path(root)
+        self.url = url.rstrip("/")
+        self.manifest = Manifest(self.root / DEFAULT_MANIFEST_NAME if manifest is None else manifest)
+        self.suffixes = tuple(s.lower() for s in suffixes)
+        self.batch_files = batch_files
+        self.batch_bytes = batch_bytes
+        self.rate = rate
+        self.busy_rate = busy_rate
+        self.quiet_time = quiet_time
+        self.busy = busy
+        self.min_age = min_age
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.limiter = RateLimiter(self.current_rate)
+        self.stats = UploadStats()
+        # Only connection failures are retried by the adapter, uploads are retried by `_upload_batch` since their
+        # body is a stream that has to be rebuilt
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_connections,
+                              max_retries=Retry(total=retries, connect=retries, read=0, status=0, backoff_factor=backoff))
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.executor = ThreadPoolExecutor(max_workers=max_connections, thread_name_prefix="uploader")
+        self.lock = threading.Lock()
+        # Relative paths (and hashes) of files in batches that are still uploading
+        self.in_flight: set[str] = set()
+        self.hashes_in_flight: set[str] = set()
+        self.pending: set[Future] = set()
+        # Relative path -> mtime_ns of every image we have seen, to notice new ones
+        self.seen: dict[str, int] = {}
+        self.last_new_image = float("-inf")
+        self._first_scan = True
+
+    def acquiring(self) -> bool:
+        """Whether the scopes look busy: a new image showed up recently, or `busy()` says so."""
+        return time.monotonic() - self.last_new_image < self.quiet_time or (self.busy is not None and self.busy())
+
+    def current_rate(self) -> float:
+        return self.busy_rate if self.acquiring() else self.rate
+
+    def _scan(self) -> list[_File]:
+        """Images that are done being written and not in the manifest (or changed since)."""
+        now = time.time()
+        found = []
+        stack = [self.root]
+        while stack:
+            with os.scandir(stack.pop()) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(Path(entry.path))
+                        continue
+                    if not entry.name.lower().endswith(self.suffixes):
+                        continue
+                    st = entry.stat()
+                    name = Path(entry.path).relative_to(self.root).as_posix()
+                    if self.seen.get(name) != st.st_mtime_ns:
+                        self.seen[name] = st.st_mtime_ns
+                        # What is already there when we start is a backlog, not a sign of acquisition
+                        if not self._first_scan:
+                            self.last_new_image = time.monotonic()
+                    if (now - st.st_mtime < self.min_age or name in self.in_flight
+                            or self.manifest.is_current(name, st.st_size, st.st_mtime_ns)):
+                        continue
+                    found.append(_File(name, Path(entry.path), st.st_size, st.st_mtime_ns))
+        self._first_scan = False
+        return found
+
+    def _missing(self, hashes: list[str]) -> set[str]:
+        missing = set()
+        for i in range(0, len(hashes), MISSING_QUERY_SIZE):
+            r = self.session.post(f"{self.url}/api/images/missing", json={"sha256": hashes[i:i + MISSING_QUERY_SIZE]}, timeout=self.timeout)
+            r.raise_for_status()
+            missing.update(r.json()["missing"])
+        return missing
+
+    def _batches(self, files: list[_File]) -> Iterator[list[_File]]:
+        batch, size = [], 0
+        for f in files:
+            if batch and (len(batch) >= self.batch_files or size + f.size > self.batch_bytes):
+                yield batch
+                batch, size = [], 0
+            batch.append(f)
+            size += f.size
+        if batch:
+            yield batch
+
+    def _upload_batch(self, batch: list[_File], duplicates: list[_File]):
+        """Upload one batch (one file per hash) and record it and the `duplicates` of its files in the manifest."""
+        start = time.time()
+        t0 = time.perf_counter()
+        waited = self.limiter.waited
+        manifest = [{"name": f.name, "sha256": f.sha256, "size": f.size} for f in batch]
+        try:
+            for attempt in range(self.retries + 1):
+                # Paused (the scopes are acquiring with a busy rate of 0): wait before sending anything
+                self.limiter.wait_until_open()
+                body = MultipartBody(manifest, [f.path for f in batch], self.limiter)
+                try:
+                    r = self.session.post(f"{self.url}/api/images", data=body, timeout=self.timeout,
+                                          headers={"Content-Type": body.content_type})
+                    r.raise_for_status()
+                    break
+                except (requests.ConnectionError, requests.Timeout, requests.HTTPError) as e:
+                    status = getattr(e.response, "status_code", None)
+                    # A 4xx other than too many requests won't get better by asking again
+                    if attempt == self.retries or (status is not None and 400 <= status < 500 and status != 429):
+                        raise
+                    with self.lock:
+                        self.stats.retries += 1
+                    time.sleep(self.backoff * 2 ** attempt)
+            self.manifest.add([f.entry() for f in batch + duplicates])
+            with self.lock:
+                self.stats.uploaded += len(batch)
+                self.stats.deduplicated += len(duplicates)
+                self.stats.bytes += len(body)
+                self.stats.batches += 1
+        except Exception:
+            with self.lock:
+                self.stats.failed += len(batch) + len(duplicates)
+            raise
+        finally:
+            tracing.record("upload.batch", "uploader", start, time.perf_counter() - t0,
+                           {"files": len(batch), "bytes": sum(f.size for f in batch),
+                            "throttled": round(self.limiter.waited - waited, 3)})
+            with self.lock:
+                for f in batch + duplicates:
+                    self.in_flight.discard(f.name)
+                for f in batch:
+                    self.hashes_in_flight.discard(f.sha256)
+
+    def submit(self) -> int:
+        """Look for new images and start uploading them. Returns how many were found."""
+        files = self._scan()
+        if not files:
+            return 0
+        for f in files:
+            f.sha256 = file_sha256(f.path)
+        # Content the server already has (per our manifest, or because it is in a batch that is uploading
+        # right now) is never sent again
+        with self.lock:
+            in_flight = set(self.hashes_in_flight)
+        known = [f for f in files if f.sha256 in self.manifest.hashes]
+        unknown = [f for f in files if f.sha256 not in self.manifest.hashes and f.sha256 not in in_flight]
+        missing = self._missing(sorted({f.sha256 for f in unknown})) if unknown else set()
+        known += [f for f in unknown if f.sha256 not in missing]
+        if known:
+            self.manifest.add([f.entry() for f in known])
+            with self.lock:
+                self.stats.deduplicated += len(known)
+        # One upload per hash, the other files with the same content are recorded with it
+        by_hash: dict[str, list[_File]] = {}
+        for f in unknown:
+            if f.sha256 in missing:
+                by_hash.setdefault(f.sha256, []).append(f)
+        to_send = [same[0] for same in by_hash.values()]
+        with self.lock:
+            self.in_flight.update(f.name for same in by_hash.values() for f in same)
+            self.hashes_in_flight.update(by_hash)
+        for batch in self._batches(to_send):
+            duplicates = [f for first in batch for f in by_hash[first.sha256][1:]]
+            future = self.executor.submit(self._upload_batch, batch, duplicates)
+            self.pending.add(future)
+            future.add_done_callback(self._done)
+        return len(files)
+
+    def _done(self, future: Future):
+        with self.lock:
+            self.pending.discard(future)
+        if future.exception() is not None:
+            print(f"Upload failed (will retry on the next scan): {future.exception()}")
+
+    def wait(self):
+        """Wait for every upload that was started."""
+        while True:
+            with self.lock:
+                pending = list(self.pending)
+            if not pending:
+                return
+            for future in pending:
+                # Failures are reported by `_done`, the files stay out of the manifest and are tried again
+                future.exception()
+
+    def sync(self) -> UploadStats:
+        """Upload everything that is in the folder now and wait for it."""
+        t0 = time.perf_counter()
+        self.submit()
+        self.wait()
+        self.stats.elapsed += time.perf_counter() - t0
+        self.stats.throttled = self.limiter.waited
+        return self.stats
+
+    def run(self, stop: Optional[threading.Event] = None, poll_interval: float = DEFAULT_POLL_INTERVAL):
+        """Keep uploading new images (the folder is scanned every `poll_interval`, also while uploads are
+        running, so new images throttle them right away) until `stop` is set.
+        """
+        stop = threading.Event() if stop is None else stop
+        t0 = time.perf_counter()
+        try:
+            while not stop.is_set():
+                try:
+                    self.submit()
+                except requests.RequestException as e:
+                    print(f"Could not reach the storage service: {e}")
+                stop.wait(poll_interval)
+            self.wait()
+        finally:
+            self.stats.elapsed += time.perf_counter() - t0
+            self.stats.throttled = self.limiter.waited
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.session.close()
+        self.manifest.close()
+
+    def __enter__(self) -> "Uploader":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _fake_demo(n_images: int, image_size: int):
+    """Upload a folder of fake images to the local stand-in, then 'restart' with a few new and duplicate files."""
+    import tempfile
+    from fake_storage import FakeStorage, serve_in_background
+    storage = FakeStorage(fail_every=4)
+    server = serve_in_background(storage=storage)
+    url = f"http://127.0.0.1:{server.server_port}"
+    with tempfile.TemporaryDirectory() as tmp:
+        root = Path(tmp)
+        for i in range(n_images):
+            slide = root / f"slide_{i % 4}"
+            slide.mkdir(exist_ok=True)
+            # Every 10th image is a copy of the one before it (e.g. the same field imaged again)
+            seed = i - 1 if i % 10 == 9 else i
+            (slide / f"img_{i:04d}.jpg").write_bytes(hashlib.sha256(str(seed).encode()).digest() * (image_size // 32))
+        with Uploader(root, url, min_age=0.0, backoff=0.05) as uploader:
+            print(f"first run: {uploader.sync()}")
+        print(f"\tserver: {len(storage.objects)} objects, {storage.n_uploads} upload requests, {storage.bytes_received / 1e6:.1f}MB received")
+        for i in range(n_images, n_images + 5):
+            (root / f"img_{i:04d}.jpg").write_bytes(hashlib.sha256(str(i).encode()).digest() * (image_size // 32))
+        (root / "copy.jpg").write_bytes((root / "slide_0" / "img_0000.jpg").read_bytes())
+        with Uploader(root, url, min_age=0.0, backoff=0.05) as uploader:
+            print(f"after a restart: {uploader.sync()}")
+        print(f"\tserver: {len(storage.objects)} objects, {storage.n_uploads} upload requests, {storage.bytes_received / 1e6:.1f}MB received")
+    server.shutdown()
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="Upload the scope images to the online storage service")
+    parser.add_argument("root", nargs="?", default="images", help="The image output folder")
+    parser.add_argument("--url", default=None, help="The storage service, e.g. http://host:port")
+    parser.add_argument("--once", action="store_true", help="Upload what is there now and exit instead of watching")
+    parser.add_argument("--rate", type=float, default=DEFAULT_RATE / 1e6, help="MB/s")
+    parser.add_argument("--busy-rate", type=float, default=DEFAULT_BUSY_RATE / 1e6, help="MB/s while the scopes are acquiring")
+    parser.add_argument("--connections", type=int, default=DEFAULT_MAX_CONNECTIONS)
+    parser.add_argument("--fake", action="store_true", help="Try it on fake images against a local stand-in server")
+    parser.add_argument("--images", type=int, default=200, help="With --fake, how many images")
+    parser.add_argument("--image-size", type=int, default=512 * 1024, help="With --fake, bytes per image")
+    args = parser.parse_args()
+    if args.fake:
+        _fake_demo(args.images, args.image_size)
+        return
+    assert args.url is not None, "--url is needed (or --fake)"
+    with Uploader(args.root, args.url, rate=args.rate * 1e6, busy_rate=args.busy_rate * 1e6, max_connections=args.connections) as uploader:
+        if args.once:
+            print(uploader.sync())
+            return
+        try:
+            uploader.run()
+        except KeyboardInterrupt:
+            uploader.wait()
+        print(uploader.stats)
+
+if __name__ == "__main__":
+    main()
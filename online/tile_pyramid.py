@@ -0,0 +1,392 @@
+#!/usr/bin/env python3
+"""Tile pyramids of the stored microscope images, so a slide can be browsed without pulling whole frames.
+
+Every image (a single frame, or a stitched `.npy` mosaic from hardware/microscope/stitching.py) gets a
+pyramid of `tile_size` JPEG tiles: level 0 is full resolution and every level after that is half the size of
+the one before, down to the level that fits in a single tile. Plus a thumbnail. Nothing is made up front, a
+level is built the first time one of its tiles is asked for (all its tiles at once, in a process pool so big
+mosaics don't hold up the server) and a thumbnail the first time it is asked for. JPEG sources are decoded
+straight at the reduced size (`Image.draft`, the decoder skips the detail the level does not need), so low
+levels of a large frame are cheap. `.npy` mosaics are memory mapped and cut one row of tiles at a time, so
+they never have to fit in memory.
+
+Built levels are kept on disk under `cache_dir` and evicted least recently used first once the cache is over
+`max_bytes`. The cache survives restarts: it is keyed by the image name, size and modification time (so
+an image that changes gets a new pyramid) and the recency is the modification time of the level folders.
+
+`serve_in_background` serves it over HTTP:
+    GET /info/<image>                 {"width", "height", "tile_size", "levels"}
+    GET /tile/<level>/<x>/<y>/<image> a JPEG tile (x, y count tiles from the top left)
+    GET /thumb/<image>                a JPEG thumbnail
+
+Run with python3 tile_pyramid.py images/ [--port 8600] to serve a folder, or python3 tile_pyramid.py --demo to
+time it on a fake mosaic.
+"""
+from __future__ import annotations
+
+import hashlib
+import json
+import math
+import multiprocessing
+import os
+import shutil
+import threading
+import time
+import urllib.parse
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Union
+
+import numpy as np
+from PIL import Image
+
+DEFAULT_TILE_SIZE = 256
+DEFAULT_THUMBNAIL_SIZE = 256
+DEFAULT_QUALITY = 85
+DEFAULT_MAX_CACHE_BYTES = 2 * 1024 ** 3
+DEFAULT_WORKERS = max(1, (os.cpu_count() or 2) - 1)
+DEFAULT_PORT = 8600
+THUMBNAIL = "thumb"
+# How much of a .npy mosaic (as float32) is read at once when building its lower levels
+NPY_READ_BYTES = 64 * 1024 * 1024
+
+# Stitched mosaics are legitimately bigger than Pillow's decompression bomb limit
+Image.MAX_IMAGE_PIXELS = None
+
+def n_levels(width: int, height: int, tile_size: int = DEFAULT_TILE_SIZE) -> int:
+    """Levels down to (and including) the one that fits in one tile."""
+    return max(0, math.ceil(math.log2(max(width, height) / tile_size))) + 1
+
+def image_size(source: Union[str, Path]) -> tuple[int, int]:
+    """(width, height) without decoding the image."""
+    if str(source).endswith(".npy"):
+        height, width = np.load(source, mmap_mode="r").shape[:2]
+        return width, height
+    return Image.open(source).size
+
+def _reduced_rows(mosaic: np.ndarray, factor: int, row0: int, row1: int) -> np.ndarray:
+    """Rows `row0` to `row1` of `mosaic` (a memory mapped .npy) shrunk `factor` times, every pixel the mean of a
+    `factor` x `factor` block. The mosaic is read a few rows at a time (at most `NPY_READ_BYTES` of them as
+    floats), so only those and the result are ever in memory.
+    """
+    height, width = mosaic.shape[:2]
+    out_width = math.ceil(width / factor)
+    out = np.empty((row1 - row0, out_width) + mosaic.shape[2:], dtype=mosaic.dtype)
+    row_bytes = factor * width * math.prod(mosaic.shape[2:]) * 4
+    step = max(1, NPY_READ_BYTES // row_bytes)
+    for r in range(row0, row1, step):
+        r_end = min(r + step, row1)
+        chunk = np.asarray(mosaic[r * factor:min(r_end * factor, height)], dtype=np.float32)
+        # Repeat the last row/column so the blocks along the bottom and right edge are full
+        pad = ((0, (r_end - r) * factor - chunk.shape[0]), (0, out_width * factor - width)) + ((0, 0),) * (chunk.ndim - 2)
+        chunk = np.pad(chunk, pad, mode="edge")
+        blocks = chunk.reshape((r_end - r, factor, out_width, factor) + chunk.shape[2:]).mean(axis=(1, 3))
+        out[r - row0:r_end - row0] = np.clip(blocks + 0.5, 0, 255).astype(mosaic.dtype)
+    return out
+
+def _open_reduced(source: str, factor: int) -> Image.Image:
+    """`source` shrunk `factor` times, whole. For JPEGs the decoder does most of the shrinking. Only for images
+    that fit in memory at that size (`build_level` cuts `.npy` mosaics without this).
+    """
+    if source.endswith(".npy"):
+        mosaic = np.load(source, mmap_mode="r")
+        return Image.fromarray(_reduced_rows(mosaic, factor, 0, math.ceil(mosaic.shape[0] / factor)))
+    img = Image.open(source)
+    width, height = img.size
+    size = (max(1, math.ceil(width / factor)), max(1, math.ceil(height / factor)))
+    if factor > 1:
+        img.draft("RGB", size)
+    img = img.convert("RGB") if img.mode not in ("RGB", "L") else img
+    if img.size != size:
+        img = img.resize(size, Image.Resampling.BOX)
+    return img
+
+def _write_atomically(tmp: Path, target: Path):
+    """Move a finished `tmp` folder to `target` (if another worker got there first theirs is kept)."""
+    try:
+        os.rename(tmp, target)
+    except OSError:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+def build_level(source: str, target: str, level: int, tile_size: int = DEFAULT_TILE_SIZE, quality: int = DEFAULT_QUALITY) -> int:
+    """Cut level `level` of `source` into `target`/<x>_<y>.jpg tiles. Runs in the worker processes. Returns
+    the bytes written.
+    """
+    tmp = Path(f"{target}.{os.getpid()}.tmp")
+    tmp.mkdir(parents=True, exist_ok=True)
+    n_bytes = 0
+
+    def save(tile: Union[Image.Image, np.ndarray], x: int, y: int):
+        nonlocal n_bytes
+        path = tmp / f"{x // tile_size}_{y // tile_size}.jpg"
+        (tile if isinstance(tile, Image.Image) else Image.fromarray(np.ascontiguousarray(tile))).save(path, "JPEG", quality=quality)
+        n_bytes += path.stat().st_size
+
+    if source.endswith(".npy"):
+        # Mosaics can be bigger than RAM: one row of tiles at a time, full resolution tiles are read straight
+        # from their window of the memory map and lower levels are block-reduced a strip at a time
+        mosaic = np.load(source, mmap_mode="r")
+        factor = 2 ** level
+        height, width = math.ceil(mosaic.shape[0] / factor), math.ceil(mosaic.shape[1] / factor)
+        for y in range(0, height, tile_size):
+            strip = mosaic[y:y + tile_size] if factor == 1 else _reduced_rows(mosaic, factor, y, min(y + tile_size, height))
+            for x in range(0, width, tile_size):
+                save(strip[:, x:x + tile_size], x, y)
+    else:
+        img = _open_reduced(source, 2 ** level)
+        width, height = img.size
+        for y in range(0, height, tile_size):
+            for x in range(0, width, tile_size):
+                save(img.crop((x, y, min(x + tile_size, width), min(y + tile_size, height))), x, y)
+    _write_atomically(tmp, Path(target))
+    return n_bytes
+
+def build_thumbnail(source: str, target: str, size: int = DEFAULT_THUMBNAIL_SIZE, quality: int = DEFAULT_QUALITY) -> int:
+    width, height = image_size(source)
+    factor = max(1, 2 ** int(math.log2(max(width, height) / size))) if max(width, height) > size else 1
+    img = _open_reduced(source, factor)
+    img.thumbnail((size, size), Image.Resampling.LANCZOS)
+    tmp = Path(f"{target}.{os.getpid()}.tmp")
+    tmp.mkdir(parents=True, exist_ok=True)
+    img.save(tmp / "thumb.jpg", "JPEG", quality=quality)
+    n_bytes = (tmp / "thumb.jpg").stat().st_size
+    _write_atomically(tmp, Path(target))
+    return n_bytes
+
+
+class TilePyramid:
+    """Lazily built, disk cached tile pyramids of the images under `source_dir`, see the module docstring.
+    Image names are paths relative to `source_dir`.
+    """
+    def __init__(self, source_dir: Union[str, Path], cache_dir: Union[str, Path], tile_size: int = DEFAULT_TILE_SIZE,
+                 thumbnail_size: int = DEFAULT_THUMBNAIL_SIZE, quality: int = DEFAULT_QUALITY,
+                 max_bytes: int = DEFAULT_MAX_CACHE_BYTES, workers: int = DEFAULT_WORKERS):
+        self.source_dir = Path(source_dir).resolve()
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.tile_size = tile_size
+        self.thumbnail_size = thumbnail_size
+        self.quality = quality
+        self.max_bytes = max_bytes
+        # Spawn like cell.py: the server threads must not be forked into the workers
+        self.pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+        self.lock = threading.Lock()
+        # (image key, level) -> bytes, least recently used first
+        self.levels: OrderedDict[tuple[str, str], int] = OrderedDict()
+        self.total_bytes = 0
+        # Levels being built, so concurrent requests for one level wait for the same build
+        self.building: dict[tuple[str, str], Future] = {}
+        self.n_builds = 0
+        self.n_evictions = 0
+        self._load_cache()
+
+    def _load_cache(self):
+        found = []
+        for image_dir in self.cache_dir.iterdir():
+            if not image_dir.is_dir():
+                continue
+            for level_dir in image_dir.iterdir():
+                if level_dir.name.endswith(".tmp"):
+                    # Left behind by a worker that died
+                    shutil.rmtree(level_dir, ignore_errors=True)
+                    continue
+                n_bytes = sum(f.stat().st_size for f in level_dir.iterdir())
+                found.append((level_dir.stat().st_mtime, (image_dir.name, level_dir.name), n_bytes))
+        for _, key, n_bytes in sorted(found):
+            self.levels[key] = n_bytes
+            self.total_bytes += n_bytes
+
+    def _source(self, name: str) -> Path:
+        path = (self.source_dir / name).resolve()
+        if not path.is_relative_to(self.source_dir) or not path.is_file():
+            raise FileNotFoundError(name)
+        return path
+
+    def _key(self, path: Path) -> str:
+        st = path.stat()
+        return hashlib.sha1(f"{path.relative_to(self.source_dir)}:{st.st_size}:{st.st_mtime_ns}".encode()).hexdigest()
+
+    def info(self, name: str) -> dict:
+        width, height = image_size(self._source(name))
+        return {"width": width, "height": height, "tile_size": self.tile_size, "levels": n_levels(width, height, self.tile_size)}
+
+    def _ensure(self, name: str, level: str) -> Path:
+        """The cache folder of `level` of `name`, built first if needed."""
+        source = self._source(name)
+        key = (self._key(source), level)
+        target = self.cache_dir / key[0] / level
+        with self.lock:
+            if key in self.levels and target.exists():
+                self.levels.move_to_end(key)
+                # The folder's mtime is the recency after a restart
+                os.utime(target)
+                return target
+            future = self.building.get(key)
+            if future is None:
+                target.parent.mkdir(exist_ok=True)
+                if level == THUMBNAIL:
+                    future = self.pool.submit(build_thumbnail, source.as_posix(), target.as_posix(), self.thumbnail_size, self.quality)
+                else:
+                    future = self.pool.submit(build_level, source.as_posix(), target.as_posix(), int(level), self.tile_size, self.quality)
+                self.building[key] = future
+                future.add_done_callback(lambda f, key=key: self._built(key, f))
+        future.result()
+        return target
+
+    def _built(self, key: tuple[str, str], future: Future):
+        with self.lock:
+            self.building.pop(key, None)
+            if future.exception() is not None:
+                return
+            self.n_builds += 1
+            self.total_bytes += future.result() - self.levels.pop(key, 0)
+            self.levels[key] = future.result()
+            self._evict(keep=key)
+
+    def _evict(self, keep: tuple[str, str]):
+        """Drop least recently used levels until the cache fits (never the one just built)."""
+        while self.total_bytes > self.max_bytes and len(self.levels) > 1:
+            key = next(iter(self.levels))
+            if key == keep:
+                self.levels.move_to_end(key)
+                key = next(iter(self.levels))
+            n_bytes = self.levels.pop(key)
+            self.total_bytes -= n_bytes
+            self.n_evictions += 1
+            shutil.rmtree(self.cache_dir / key[0] / key[1], ignore_errors=True)
+
+    def _read(self, name: str, level: str, filename: str) -> bytes:
+        for _ in range(2):
+            try:
+                return (self._ensure(name, level) / filename).read_bytes()
+            except FileNotFoundError:
+                # Evicted between building and reading it, build it again. Or the tile does not exist
+                if not (self.cache_dir / self._key(self._source(name)) / level).exists():
+                    continue
+                raise
+        raise FileNotFoundError(f"{name} level {level} {filename}")
+
+    def tile(self, name: str, level: int, x: int, y: int) -> bytes:
+        """The JPEG of tile (x, y) of `level` of `name`. Raises FileNotFoundError for tiles outside the image."""
+        # Checked before anything is built, so made up levels can't fill the cache
+        if not 0 <= level < n_levels(*image_size(self._source(name)), self.tile_size):
+            raise FileNotFoundError(f"{name} has no level {level}")
+        return self._read(name, str(level), f"{x}_{y}.jpg")
+
+    def thumbnail(self, name: str) -> bytes:
+        return self._read(name, THUMBNAIL, "thumb.jpg")
+
+    def close(self):
+        self.pool.shutdown(wait=True, cancel_futures=True)
+
+    def __enter__(self) -> "TilePyramid":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class TileHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    wbufsize = -1
+    disable_nagle_algorithm = True
+    pyramid: TilePyramid = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, body: bytes, content_type: str, code: int = 200):
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        if code == 200:
+            # URLs are by image name and an image that changes gets a new pyramid, so only cache briefly
+            self.send_header("Cache-Control", "max-age=300")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        parts = urllib.parse.unquote(urllib.parse.urlparse(self.path).path).lstrip("/").split("/")
+        try:
+            if parts[0] == "info" and len(parts) > 1:
+                self._reply(json.dumps(self.pyramid.info("/".join(parts[1:]))).encode(), "application/json")
+            elif parts[0] == "thumb" and len(parts) > 1:
+                self._reply(self.pyramid.thumbnail("/".join(parts[1:])), "image/jpeg")
+            elif parts[0] == "tile" and len(parts) > 4:
+                level, x, y = (int(p) for p in parts[1:4])
+                self._reply(self.pyramid.tile("/".join(parts[4:]), level, x, y), "image/jpeg")
+            else:
+                raise FileNotFoundError(self.path)
+        except (FileNotFoundError, ValueError) as e:
+            self._reply(json.dumps({"error": f"not found: {e}"}).encode(), "application/json", code=404)
+
+
+def serve_in_background(pyramid: TilePyramid, host: str = "127.0.0.1", port: int = 0) -> ThreadingHTTPServer:
+    """Serve `pyramid` on a daemon thread. Use port 0 to get a free port (see `server.server_port`)."""
+    handler = type("BoundTileHandler", (TileHandler,), {"pyramid": pyramid})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def _demo(size: int, workers: int):
+    """Time a first (building) and a second (cached) request per level on a fake mosaic, against reading the
+    whole image.
+    """
+    import tempfile
+    with tempfile.TemporaryDirectory() as tmp:
+        source = Path(tmp, "images")
+        source.mkdir()
+        yy, xx = np.mgrid[0:size, 0:size]
+        pixels = np.stack([(xx // 7) % 256, (yy // 5) % 256, ((xx + yy) // 11) % 256], axis=-1).astype(np.uint8)
+        Image.fromarray(pixels).save(source / "mosaic.jpg", quality=90)
+        full = (source / "mosaic.jpg").stat().st_size
+        print(f"mosaic: {size}x{size}, {full / 1e6:.1f}MB")
+        with TilePyramid(source, Path(tmp, "cache"), workers=workers) as pyramid:
+            info = pyramid.info("mosaic.jpg")
+            for level in reversed(range(info["levels"])):
+                t0 = time.perf_counter()
+                tile = pyramid.tile("mosaic.jpg", level, 0, 0)
+                first = time.perf_counter() - t0
+                t0 = time.perf_counter()
+                pyramid.tile("mosaic.jpg", level, 0, 0)
+                cached = time.perf_counter() - t0
+                print(f"level {level}: first tile {first * 1000:.0f}ms, cached {cached * 1e6:.0f}us, {len(tile) / 1e3:.1f}kB")
+            t0 = time.perf_counter()
+            thumb = pyramid.thumbnail("mosaic.jpg")
+            print(f"thumbnail: {(time.perf_counter() - t0) * 1000:.0f}ms, {len(thumb) / 1e3:.1f}kB")
+            t0 = time.perf_counter()
+            Image.open(source / "mosaic.jpg").load()
+            print(f"decoding the whole mosaic: {(time.perf_counter() - t0) * 1000:.0f}ms")
+            print(f"cache: {pyramid.total_bytes / 1e6:.1f}MB in {len(pyramid.levels)} levels")
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="Serve tile pyramids of the stored images")
+    parser.add_argument("source", nargs="?", default="images", help="The image folder")
+    parser.add_argument("--cache", default=None, help="Where to keep the tiles (default: <source>/../tile_cache)")
+    parser.add_argument("--max-cache", type=float, default=DEFAULT_MAX_CACHE_BYTES / 1e9, help="GB")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--demo", action="store_true", help="Time it on a fake mosaic")
+    parser.add_argument("--demo-size", type=int, default=8192)
+    args = parser.parse_args()
+    if args.demo:
+        _demo(args.demo_size, args.workers)
+        return
+    cache = args.cache or Path(args.source).resolve().parent / "tile_cache"
+    with TilePyramid(args.source, cache, max_bytes=int(args.max_cache * 1e9), workers=args.workers) as pyramid:
+        server = serve_in_background(pyramid, args.host, args.port)
+        print(f"Serving tiles of {args.source} on http://{args.host}:{server.server_port} (Ctrl+C to stop)")
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            server.shutdown()
+
+if __name__ == "__main__":
+    main()